@@ -6,6 +6,34 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 
+def _migrate_seq_reps_to_binary_(db):
+
+    '''
+    Re-encodes sequence representations stored in the text form of
+    krstring.edits_to_string in the binary form of krstring.edits_to_bytes.
+    '''
+
+    import sqlite3
+    from krpy import krstring
+
+    select_str = str(
+        'SELECT id, representation FROM sequence_representations '
+        "WHERE id > ? AND typeof(representation) = 'text' "
+        'ORDER BY id LIMIT 10000;')
+
+    last_id = 0
+
+    while True:
+        rows = db.execute(select_str, (last_id,)).fetchall()
+        if not rows:
+            break
+        db.executemany(
+            'UPDATE sequence_representations SET representation = ? WHERE id = ?;',
+            [(sqlite3.Binary(krstring.edits_to_bytes(
+                krstring.string_to_edits(str(x[1])))), x[0]) for x in rows])
+        last_id = rows[-1][0]
+
+
 class KRSequenceDatabase:
 
 
@@ -135,6 +163,92 @@ class KRSequenceDatabase:
 
     '''
 
+    # Number of distinct SQL strings the connection keeps compiled. db_select
+    # and friends build a handful of statements per table and column set.
+    _DB_CACHED_STATEMENTS = 512
+
+    # Most values bound to one statement, below the SQLITE_MAX_VARIABLE_NUMBER
+    # of 999 of older SQLite builds.
+    _DB_MAX_VARIABLES = 900
+
+    # Sequences, alphabets and representations of an alignment in one query,
+    # instead of several queries for every aligned sequence.
+    _DB_ALIGNMENT_SQL = str('''
+        SELECT sequences.rec_id AS rec_id, sequence, alphabet, representation
+        FROM sequence_representations
+        JOIN sequences ON sequences.id=sequence_representations.seq_id
+        JOIN sequence_alphabets ON sequence_alphabets.id=sequences.seq_alpha_id
+        WHERE sequence_representations.aln_id = ?
+        ORDER BY sequence_representations.id;
+        ''')
+
+    # Inner joins (every annotation has a type and a value), so the lookup
+    # can start from the type and value indexes.
+    _DB_ANNOTATION_SQL = str('''
+        SELECT rec_id
+        FROM record_annotations
+        JOIN record_annotation_types ON record_annotation_types.id=rec_ann_type_id
+        JOIN record_annotation_values ON record_annotation_values.id=rec_ann_value_id
+        WHERE type IS ? AND value IS ?;
+        ''')
+
+    # Schema migrations. Migration i takes a database from schema version i
+    # (PRAGMA user_version) to i + 1. New databases are created with
+    # _DB_SCRIPT at version 0 and then migrated like existing ones. A
+    # migration is an SQL script or a function called with the connection
+    # inside the migration's transaction. Every applied migration is also
+    # recorded in the schema_migrations table.
+    # Append new migrations to the end of the list, never edit applied ones.
+    _DB_MIGRATIONS = [
+
+    ('indexes for record, organism, blacklist and feature lookups', '''
+
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied TEXT NOT NULL
+        );
+
+    CREATE INDEX records_ncbi_gi_idx ON records(ncbi_gi);
+    CREATE INDEX records_ncbi_version_idx ON records(ncbi_version);
+    CREATE INDEX records_internal_reference_idx ON records(internal_reference);
+    CREATE INDEX records_org_id_idx ON records(org_id);
+
+    CREATE INDEX blacklist_ncbi_gi_idx ON blacklist(ncbi_gi);
+    CREATE INDEX blacklist_ncbi_version_idx ON blacklist(ncbi_version);
+    CREATE INDEX blacklist_internal_reference_idx ON blacklist(internal_reference);
+
+    CREATE INDEX organisms_name_idx ON organisms(genus, species, subspecies, variety, hybrid, other);
+    CREATE INDEX organisms_taxonomy_id_idx ON organisms(taxonomy_id);
+
+    CREATE INDEX ncbi_tax_ids_org_id_idx ON ncbi_tax_ids(org_id, ncbi_tax_id);
+    CREATE INDEX ncbi_tax_ids_ncbi_tax_id_idx ON ncbi_tax_ids(ncbi_tax_id);
+
+    CREATE INDEX record_ancestry_rec_id_idx ON record_ancestry(rec_id, parent_rec_id);
+    CREATE INDEX record_ancestry_parent_rec_id_idx ON record_ancestry(parent_rec_id);
+
+    CREATE INDEX record_action_history_rec_id_idx ON record_action_history(rec_id);
+
+    CREATE INDEX record_features_rec_id_idx ON record_features(rec_id);
+    CREATE INDEX record_features_type_idx ON record_features(type);
+
+    CREATE INDEX record_feature_qualifiers_rec_feat_id_idx ON record_feature_qualifiers(rec_feat_id);
+    CREATE INDEX record_feature_qualifiers_type_idx ON record_feature_qualifiers(type);
+
+    CREATE INDEX record_annotations_rec_id_idx ON record_annotations(rec_id, rec_ann_type_id, rec_ann_value_id);
+    CREATE INDEX record_annotations_type_value_idx ON record_annotations(rec_ann_type_id, rec_ann_value_id, rec_id);
+
+    CREATE INDEX sequences_rec_id_idx ON sequences(rec_id);
+
+    CREATE INDEX sequence_representations_seq_id_idx ON sequence_representations(seq_id);
+    CREATE INDEX sequence_representations_aln_id_idx ON sequence_representations(aln_id);
+
+    '''),
+
+    ('binary sequence representations', _migrate_seq_reps_to_binary_),
+
+    ]
+
     # CREATE TABLE record_features(
     #     id INTEGER PRIMARY KEY AUTOINCREMENT,
     #     rec_id INTEGER NOT NULL REFERENCES records(id) ON DELETE CASCADE,
@@ -177,12 +291,17 @@ class KRSequenceDatabase:
 
 
     def _adapt_seq_edits(self, e):
+        import sqlite3
         from krpy import krstring
-        return krstring.edits_to_string(e)
+        return sqlite3.Binary(krstring.edits_to_bytes(e))
 
 
     def _convert_seq_edits(self, e):
         from krpy import krstring
+        # Representations written before the binary migration, or by an
+        # older version of this class, are still in the text form.
+        if krstring.is_binary_edits(e):
+            return self._KRSeqEdits(krstring.bytes_to_edits(e))
         return self._KRSeqEdits(krstring.string_to_edits(e))
 
 
@@ -199,18 +318,24 @@ class KRSequenceDatabase:
         if not os.path.exists(self._DB_FILE):
             self._db_prepare()
 
+        self._db_migrate()
+
         sqlite3.register_adapter(self._KRSeqEdits, self._adapt_seq_edits)
         sqlite3.register_converter(b'SEQREP', self._convert_seq_edits)
 
         self._DB_CONN = sqlite3.connect(
             database=self._DB_FILE,
             timeout=3600,
-            detect_types=sqlite3.PARSE_DECLTYPES)
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=self._DB_CACHED_STATEMENTS)
         self._DB_CONN.row_factory = sqlite3.Row
         self._DB_CONN.text_factory = str
 
         self._DB_CURSOR = self._DB_CONN.cursor()
 
+        # WHERE clauses built by _db_where, by where_dict shape
+        self._DB_WHERE_CACHE = dict()
+
         self._DB_CONN.execute('PRAGMA foreign_keys = ON;')
         self._DB_CONN.execute('PRAGMA synchronous = NORMAL;')
         self._DB_CONN.execute('PRAGMA journal_mode = WAL;')
@@ -237,27 +362,138 @@ class KRSequenceDatabase:
         db.close()
 
 
-    def db_select(self, table_name_list, column_list, where_dict=None, join_rules_str=None, order_by_column_list=None):
+    def _db_migrate(self):
 
         import sys
         import sqlite3
+        import datetime
 
-        columns_str = ', '.join(column_list)
+        db = sqlite3.connect(self._DB_FILE, timeout=3600)
+        # Transactions are started and committed explicitly below.
+        db.isolation_level = None
 
-        if where_dict:
-            where_str = ' WHERE ' + ' AND '.join(
-                [str(x) + ' IS :' + str(x.replace('.', '_')) for x in where_dict.keys()])
+        version = db.execute('PRAGMA user_version;').fetchone()[0]
 
-            # This solves the issue where sqlite3 interpolator freaks out if
-            # there are periods in value placeholders
-            new_where_dict = dict()
-            for key in where_dict.keys():
-                new_where_dict[key.replace('.', '_')] = where_dict[key]
-            where_dict = new_where_dict
+        # Each migration and the version change are applied in one
+        # transaction, so an interrupted upgrade leaves the database at the
+        # last completed version.
+        for i in range(version, len(self._DB_MIGRATIONS)):
+
+            description, script = self._DB_MIGRATIONS[i]
+
+            record_str = str(
+                'INSERT INTO schema_migrations VALUES (' + str(i + 1) + ', ' +
+                "'" + description.replace("'", "''") + "', " +
+                "'" + datetime.datetime.now().isoformat() + "');")
+
+            try:
+                if callable(script):
+                    db.execute('BEGIN;')
+                    script(db)
+                    db.execute(record_str)
+                    db.execute('PRAGMA user_version = ' + str(i + 1) + ';')
+                    db.execute('COMMIT;')
+                else:
+                    db.executescript(
+                        'BEGIN;\n' + script + '\n' + record_str + '\n' +
+                        'PRAGMA user_version = ' + str(i + 1) + ';\n' +
+                        'COMMIT;')
+            except sqlite3.Error as error:
+                print(error, file=sys.stderr)
+                db.rollback()
+                db.close()
+                raise
+
+        db.close()
+
+
+    def get_schema_version(self):
+
+        results = self._DB_CURSOR.execute('PRAGMA user_version;').fetchone()
+
+        return results[0]
 
-        else:
-            where_str = ''
-            where_dict = {}
+
+    def _db_where(self, where_dict):
+
+        '''
+        WHERE clause and its parameters for a where_dict of column: value
+        pairs. Columns are compared with = to a value, with IN to a list,
+        tuple or set of values, and with IS NULL to None.
+
+        Columns are sorted, so the same columns and value kinds always give
+        the same SQL string, which sqlite3 then finds in its statement cache
+        instead of compiling it again. The clause itself is cached by the
+        same shape, so a repeated lookup only binds its values.
+        '''
+
+        if not where_dict:
+            return ('', dict())
+
+        # Exact types only: subclasses such as _KRSeqEdits are single values
+        # with an sqlite3 adapter.
+        list_types = (list, tuple, set, frozenset)
+
+        # Shape of every column: None, the length of a list, or -1 for a
+        # value
+        shape = tuple([
+            (column, None if value is None else
+             len(value) if type(value) in list_types else -1)
+            for column, value in where_dict.items()])
+
+        cached = self._DB_WHERE_CACHE.get(shape, None)
+
+        if cached is None:
+
+            conditions = list()
+            names = list()
+
+            for column, kind in sorted(shape):
+
+                # This solves the issue where sqlite3 interpolator freaks out
+                # if there are periods in value placeholders
+                name = str(column).replace('.', '_') + '_where'
+
+                if kind is None:
+                    conditions.append(str(column) + ' IS NULL')
+
+                elif kind == -1:
+                    conditions.append(str(column) + ' = :' + name)
+                    names.append((column, name, None))
+
+                elif kind == 0:
+                    conditions.append('0')
+
+                else:
+                    item_names = [name + '_' + str(i) for i in range(kind)]
+                    conditions.append(
+                        str(column) + ' IN (:' + ', :'.join(item_names) + ')')
+                    names.append((column, None, item_names))
+
+            cached = (str(' WHERE ' + ' AND '.join(conditions)), names)
+            self._DB_WHERE_CACHE[shape] = cached
+
+        where_str, names = cached
+
+        parameters = dict()
+
+        for column, name, item_names in names:
+            if item_names is None:
+                parameters[name] = where_dict[column]
+            else:
+                parameters.update(zip(item_names, where_dict[column]))
+
+        return (where_str, parameters)
+
+
+    def db_select(self, table_name_list, column_list, where_dict=None, join_rules_str=None, order_by_column_list=None):
+
+        import sys
+        import sqlite3
+
+        columns_str = ', '.join(column_list)
+
+        where_str, where_dict = self._db_where(where_dict)
 
         order_by_str = ''
         if order_by_column_list:
@@ -316,8 +552,8 @@ class KRSequenceDatabase:
         row_id = None
         already_in_db = False
 
-        columns_str = ', '.join(values_dict.keys())
-        values_str = ':' + ', :'.join(values_dict.keys())
+        columns_str = ', '.join(sorted(values_dict.keys()))
+        values_str = ':' + ', :'.join(sorted(values_dict.keys()))
 
         exists = False
         if check_exists:
@@ -348,24 +584,10 @@ class KRSequenceDatabase:
         import sys
         import sqlite3
 
-        values_str_list = [str(x) + '=:' + str(x) for x in values_dict.keys()]
+        values_str_list = [str(x) + '=:' + str(x) for x in sorted(values_dict.keys())]
         values_str = ', '.join(values_str_list)
 
-        where_str = ''
-        if where_dict:
-            where_str = ' WHERE ' + ' AND '.join(
-                [str(x) + ' IS :' + str(x) + '_where_string' for x in where_dict.keys()])
-
-            # This solves the issue where sqlite3 interpolator freaks out if
-            # there are periods in value placeholders
-            new_where_dict = dict()
-            for key in where_dict.keys():
-                new_where_dict[str(key) + str('_where_string')] = where_dict[key]
-            where_dict = new_where_dict
-
-        else:
-            where_str = ''
-            where_dict = {}
+        where_str, where_dict = self._db_where(where_dict)
 
         update_str = str(
             'UPDATE ' + table_name + ' SET ' + values_str + where_str + ';')
@@ -387,13 +609,7 @@ class KRSequenceDatabase:
         import sys
         import sqlite3
 
-        where_str = ''
-        if where_dict:
-            where_str = ' WHERE ' + ' AND '.join(
-                [str(x) + ' IS :' + str(x) for x in where_dict.keys()])
-        else:
-            where_str = ''
-            where_dict = {}
+        where_str, where_dict = self._db_where(where_dict)
 
         delete_string = str(
             'DELETE FROM  ' + table_name + where_str + ';')
@@ -1219,6 +1435,270 @@ class KRSequenceDatabase:
         return row_id
 
 
+    # Indexes that are not needed while records are bulk loaded and can be
+    # built once at the end of a large load. records_ncbi_version_idx is
+    # kept, it is used to skip records already in the database.
+    _BULK_DEFERRED_INDEX_TABLES = ['records', 'record_action_history',
+        'sequences', 'sequence_representations', 'record_features',
+        'record_feature_qualifiers', 'record_annotations']
+
+
+    def _next_row_id(self, table_name):
+
+        # Rows are inserted with explicit ids so that executemany can be
+        # used for tables whose ids are referenced by other tables. Ids
+        # continue from the AUTOINCREMENT sequence, so deleted ids are not
+        # reused.
+
+        results = self._DB_CURSOR.execute(
+            'SELECT seq FROM sqlite_sequence WHERE name=?;',
+            [table_name]).fetchone()
+        seq = 0
+        if results and results[0]:
+            seq = results[0]
+
+        results = self._DB_CURSOR.execute(
+            str('SELECT MAX(id) FROM ' + table_name + ';')).fetchone()
+        max_id = 0
+        if results and results[0]:
+            max_id = results[0]
+
+        return max(seq, max_id) + 1
+
+
+    def add_genbank_records(self, records, action_str='Genbank record',
+        annotations=None, batch_size=1000, defer_indexes=False,
+        log_func=None, log_file_path=None):
+
+        '''
+        Bulk version of add_genbank_record for an iterable of GenBank
+        SeqRecords.
+
+        Records are added in batches of batch_size, each in one transaction
+        (pending changes are saved first). Records whose version is already
+        in the database, or that appeared earlier in records, are skipped.
+
+        annotations - list of (type, annotation) tuples added to every new
+            record, as add_record_annotation would.
+
+        defer_indexes - drop the secondary indexes of the record tables for
+            the duration of the load and build them again at the end. Faster
+            for loads that are large compared to the database.
+
+        Returns the number of records added.
+        '''
+
+        import sys
+        import time
+        import sqlite3
+        from krpy import krbionames
+        from krpy import krncbi
+
+        def log(msg):
+            if log_func and log_file_path:
+                log_func(msg, log_file_path)
+
+        self._DB_CONN.commit()
+
+        deferred_indexes = list()
+        if defer_indexes:
+            table_str = ', '.join(["'" + x + "'" for x in self._BULK_DEFERRED_INDEX_TABLES])
+            deferred_indexes = self._DB_CURSOR.execute(str(
+                'SELECT name, sql FROM sqlite_master WHERE type=\'index\' ' +
+                'AND sql IS NOT NULL AND name!=\'records_ncbi_version_idx\' ' +
+                'AND tbl_name IN (' + table_str + ');')).fetchall()
+            deferred_indexes = [(x[0], x[1]) for x in deferred_indexes]
+            for name, sql in deferred_indexes:
+                self._DB_CURSOR.execute(str('DROP INDEX ' + name + ';'))
+            self._DB_CONN.commit()
+
+        # Caches of ids looked up or added during this load
+        org_ids = dict()
+        org_tax_ids = set()
+        seq_alpha_ids = dict()
+        seen_versions = set()
+
+        start_time = time.time()
+        added_count = 0
+
+        def add_batch(batch):
+
+            # Versions already in the database
+            versions = list(set([x.id for x in batch]))
+            in_db = set()
+            for i in range(0, len(versions), 500):
+                chunk = versions[i:i + 500]
+                results = self._DB_CURSOR.execute(str(
+                    'SELECT ncbi_version FROM records WHERE ncbi_version IN (' +
+                    ', '.join(['?'] * len(chunk)) + ');'), chunk).fetchall()
+                in_db.update([x[0] for x in results])
+
+            new_records = list()
+            for record in batch:
+                if record.id in in_db or record.id in seen_versions:
+                    continue
+                seen_versions.add(record.id)
+                new_records.append(record)
+
+            if not new_records:
+                return 0
+
+            # Organisms, looked up or added once per organism
+            record_org_ids = list()
+            for record in new_records:
+                org_dict = krbionames.parse_organism_name(
+                    record.annotations['organism'], sep=' ',
+                    ncbi_authority=False)
+                org_key = tuple([org_dict[x] or None for x in [
+                    'genus', 'species', 'subspecies', 'variety', 'hybrid',
+                    'other']])
+                ncbi_tax_id = int(krncbi.get_ncbi_tax_id_for_record(record))
+
+                if org_key not in org_ids:
+                    taxonomy_list = [('name=' + x) for x in
+                                     record.annotations['taxonomy']]
+                    org_ids[org_key] = self.add_organism(
+                        organism_dict=org_dict,
+                        taxonomy_list=taxonomy_list,
+                        ncbi_tax_id_list=[ncbi_tax_id])[0]
+                    org_tax_ids.add((org_ids[org_key], ncbi_tax_id))
+
+                org_id = org_ids[org_key]
+                if (org_id, ncbi_tax_id) not in org_tax_ids:
+                    self.db_insert('ncbi_tax_ids', {
+                        'org_id': org_id, 'ncbi_tax_id': ncbi_tax_id})
+                    org_tax_ids.add((org_id, ncbi_tax_id))
+
+                record_org_ids.append(org_id)
+
+            rec_id = self._next_row_id('records')
+            action_id = self._next_row_id('record_action_history')
+            seq_id = self._next_row_id('sequences')
+            seq_rep_id = self._next_row_id('sequence_representations')
+            rec_feat_id = self._next_row_id('record_features')
+
+            records_rows = list()
+            action_rows = list()
+            sequences_rows = list()
+            seq_rep_rows = list()
+            feature_rows = list()
+            qualifier_rows = list()
+            annotation_rows = list()
+
+            annotation_ids = list()
+            if annotations:
+                for type_str, annotation_str in annotations:
+                    self._DB_CURSOR.execute(
+                        'INSERT OR IGNORE INTO record_annotation_types (type) VALUES (?);',
+                        [type_str])
+                    self._DB_CURSOR.execute(
+                        'INSERT OR IGNORE INTO record_annotation_values (value) VALUES (?);',
+                        [annotation_str])
+                    rec_ann_type_id = self.db_get_row_ids(
+                        'record_annotation_types', {'type': type_str})[0]
+                    rec_ann_value_id = self.db_get_row_ids(
+                        'record_annotation_values', {'value': annotation_str})[0]
+                    annotation_ids.append((rec_ann_type_id, rec_ann_value_id))
+
+            for record, org_id in zip(new_records, record_org_ids):
+
+                records_rows.append((rec_id, org_id, 1, record.id,
+                                     record.id, record.description))
+                action_rows.append((action_id, rec_id, action_str))
+                action_id = action_id + 1
+
+                sequence_str = str(record.seq).upper()
+                sequence_alphabet_str = self._sequence_alphabet(record.seq).upper()
+                if sequence_alphabet_str not in seq_alpha_ids:
+                    seq_alpha_ids[sequence_alphabet_str] = self.db_get_row_ids(
+                        'sequence_alphabets',
+                        {'alphabet': sequence_alphabet_str})[0]
+
+                sequences_rows.append((seq_id, rec_id,
+                    seq_alpha_ids[sequence_alphabet_str], sequence_str))
+                seq_rep_rows.append((seq_rep_id, seq_id, rec_id,
+                    self.produce_seq_edits(sequence_str, sequence_str)))
+                seq_id = seq_id + 1
+                seq_rep_id = seq_rep_id + 1
+
+                for feature in record.features:
+                    feature_rows.append((rec_feat_id, feature.type, rec_id,
+                                         str(feature.location)))
+                    for qualifier in feature.qualifiers:
+                        fqual = feature.qualifiers[qualifier]
+                        if isinstance(fqual, list):
+                            fqual = fqual[0]
+                        qualifier_rows.append((qualifier, rec_feat_id,
+                                               str(fqual)))
+                    rec_feat_id = rec_feat_id + 1
+
+                for rec_ann_type_id, rec_ann_value_id in annotation_ids:
+                    annotation_rows.append((rec_id, rec_ann_type_id,
+                                            rec_ann_value_id))
+
+                rec_id = rec_id + 1
+
+            self._DB_CURSOR.executemany(
+                'INSERT INTO records (id, org_id, active, ncbi_gi, ncbi_version, description) VALUES (?, ?, ?, ?, ?, ?);',
+                records_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO record_action_history (id, rec_id, action) VALUES (?, ?, ?);',
+                action_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO sequences (id, rec_id, seq_alpha_id, sequence) VALUES (?, ?, ?, ?);',
+                sequences_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO sequence_representations (id, seq_id, rec_id, representation) VALUES (?, ?, ?, ?);',
+                seq_rep_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO record_features (id, type, rec_id, location) VALUES (?, ?, ?, ?);',
+                feature_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO record_feature_qualifiers (type, rec_feat_id, qualifier) VALUES (?, ?, ?);',
+                qualifier_rows)
+            self._DB_CURSOR.executemany(
+                'INSERT INTO record_annotations (rec_id, rec_ann_type_id, rec_ann_value_id) VALUES (?, ?, ?);',
+                annotation_rows)
+
+            return len(new_records)
+
+        try:
+            batch = list()
+            records = iter(records)
+            while True:
+                record = next(records, None)
+                if record is not None:
+                    batch.append(record)
+                if batch and (len(batch) == batch_size or record is None):
+                    # Holding the write lock for the whole batch keeps the
+                    # explicit ids free
+                    self._DB_CURSOR.execute('BEGIN IMMEDIATE;')
+                    added_count = added_count + add_batch(batch)
+                    self._DB_CONN.commit()
+                    batch = list()
+                    elapsed = time.time() - start_time
+                    log('Added ' + str(added_count) + ' records, ' +
+                        '%.1f' % (added_count / max(elapsed, 1e-6)) +
+                        ' records/second.')
+                if record is None:
+                    break
+
+        except sqlite3.Error as error:
+            print(error, file=sys.stderr)
+            self._DB_CONN.rollback()
+            raise
+
+        finally:
+            if deferred_indexes:
+                msg = 'Building ' + str(len(deferred_indexes)) + ' indexes.'
+                log(msg)
+                for name, sql in deferred_indexes:
+                    self._DB_CURSOR.execute(str(sql + ';'))
+                self._DB_CONN.commit()
+
+        return added_count
+
+
     # def _align_sequence_reps(self, seq_rep_id_list, program, options='', program_executable=''):
 
     #     from Bio import SeqRecord
@@ -1326,28 +1806,20 @@ class KRSequenceDatabase:
         #     where_dict=where_dict,
         #     join_rules_str=None)[0]
 
-        table_name_list = ['sequence_representations']
-        column_list = ['id', 'seq_id', 'rec_id', 'aln_id', 'representation']
-        where_dict = {'aln_id': alignment_id}
-        seq_reps = self.db_select(
-            table_name_list=table_name_list,
-            column_list=column_list,
-            where_dict=where_dict,
-            join_rules_str=None)
+        seq_reps = self._DB_CURSOR.execute(
+            self._DB_ALIGNMENT_SQL, (alignment_id,)).fetchall()
 
         seq_record_list = list()
 
         for seq_rep in seq_reps:
 
-            rec_id = self.db_select(
-                table_name_list=['sequences'],
-                column_list=['rec_id'],
-                where_dict={'id': seq_rep[b'seq_id']},
-                join_rules_str=None,
-                order_by_column_list=None)[0][b'rec_id']
+            rec_id = seq_rep[b'rec_id']
 
-            seq_rep_id = seq_rep[b'id']
-            seq = self._get_sequence_from_representation(seq_rep_id=seq_rep_id)
+            seq_alphabet = self.string_to_bio_alphabet(
+                str_alphabet=seq_rep[b'alphabet'])
+            seq_str = self.apply_seq_edits(
+                e=seq_rep[b'representation'], s=str(seq_rep[b'sequence']))
+            seq = Seq.Seq(data=seq_str, alphabet=seq_alphabet)
 
             seq_record = SeqRecord(
                 seq=seq,
@@ -1511,17 +1983,96 @@ class KRSequenceDatabase:
         return seq_list
 
 
-    def get_record(
+    def _record_chunk_sql(self, where_dict_key, reference_count):
+
+        '''
+        Query for records, with their organisms and sequences, matching
+        reference_count references in column where_dict_key.
+        '''
+
+        references_str = ', '.join(['?'] * reference_count)
+
+        select_records_str = str('''
+            SELECT records.id AS id, records.active AS active,
+                records.org_id AS org_id, ncbi_gi, ncbi_version,
+                internal_reference, description,
+                genus, species, subspecies, variety, hybrid, other, authority,
+                common_name, taxonomy,
+                representation, sequence, alphabet
+            FROM records
+            LEFT OUTER JOIN organisms ON organisms.id=records.org_id
+            LEFT OUTER JOIN taxonomies ON taxonomies.id=organisms.taxonomy_id
+            LEFT OUTER JOIN sequence_representations ON sequence_representations.rec_id=records.id
+            LEFT OUTER JOIN sequences ON sequences.id=sequence_representations.seq_id
+            LEFT OUTER JOIN sequence_alphabets ON sequence_alphabets.id=sequences.seq_alpha_id
+            WHERE records.''' + where_dict_key + ''' IN (''' + references_str + ''')
+            ORDER BY records.id;
+            ''')
+
+        return select_records_str
+
+
+    def _record_features_sql(self, record_count):
+
+        '''
+        Queries for the features and the feature qualifiers of record_count
+        records.
+        '''
+
+        records_str = ', '.join(['?'] * record_count)
+
+        # Ordered by rec_id first, so the rec_id index gives the order and
+        # SQLite does not scan all features in id order instead.
+        select_features_str = str('''
+            SELECT record_features.id AS id, rec_id, type, location
+            FROM record_features
+            WHERE record_features.rec_id IN (''' + records_str + ''')
+            ORDER BY record_features.rec_id, record_features.id;
+            ''')
+
+        select_qualifiers_str = str('''
+            SELECT rec_feat_id, record_feature_qualifiers.type AS type, qualifier
+            FROM record_features
+            JOIN record_feature_qualifiers ON record_feature_qualifiers.rec_feat_id=record_features.id
+            WHERE record_features.rec_id IN (''' + records_str + ''')
+            ORDER BY record_feature_qualifiers.rec_feat_id, record_feature_qualifiers.id;
+            ''')
+
+        return (select_features_str, select_qualifiers_str)
+
+
+    def iter_records(
         self,
-        record_reference,
-        record_reference_type='gi'  # gi version internal raw
+        record_reference_list,
+        record_reference_type='gi',  # gi version internal raw
+        active=True,
+        inactive=False,
+        chunk_size=_DB_MAX_VARIABLES
         ):
 
+        '''
+        Yields SeqRecords (as get_record) for an iterable of record
+        references, in the same order. References that are not in the
+        database are skipped.
+
+        References are read chunk_size (at most _DB_MAX_VARIABLES) at a
+        time. Every chunk is loaded with the queries of _record_chunk_sql
+        and _record_features_sql, with the chunk's references and record ids bound
+        as IN lists, so memory use depends on chunk_size only. Nothing is
+        written, so no transaction is left open on the shared connection.
+        '''
+
         from Bio.SeqRecord import SeqRecord
         from Bio.SeqFeature import SeqFeature
+        from Bio import Seq
         from krpy import krbionames
         from krpy import krseq
 
+        if (not active) and (not inactive):
+            return
+
+        chunk_size = max(1, min(chunk_size, self._DB_MAX_VARIABLES))
+
         where_dict_key = ''
 
         if record_reference_type == 'gi':
@@ -1533,89 +2084,159 @@ class KRSequenceDatabase:
         elif record_reference_type == 'raw':
             where_dict_key = 'id'
 
-        where_dict = {where_dict_key: record_reference}
-        results = self.db_select(
-            table_name_list=['records'],
-            column_list=['active', 'id', 'org_id', 'ncbi_gi', 'ncbi_version', 'internal_reference',
-                         'description'],
-            where_dict=where_dict,
-            join_rules_str=None)[0]
-
-        where_dict = {b'organisms.id': results[b'org_id']}
-
-        org_dict = self.get_organisms(where_dict=where_dict)[0]
-        org_flat = krbionames.flatten_organism_name(
-                parsed_name=org_dict, sep=' ')
-
-        seq_rep_id = self.get_seq_rep_id_for_record(
-            record_reference=record_reference,
-            record_reference_type=record_reference_type)
+        def reference_key(ref):
+            # The value the reference has after SQLite applies the affinity
+            # of the column (INTEGER for id, TEXT otherwise) in the IN list
+            if where_dict_key == 'id':
+                if isinstance(ref, basestring):
+                    try:
+                        return int(ref)
+                    except ValueError:
+                        return ref
+                return ref
+            if isinstance(ref, (int, long, float)):
+                return str(ref)
+            return ref
+
+        def load_chunk(chunk):
+
+            select_records_str = self._record_chunk_sql(
+                where_dict_key, len(chunk))
+
+            # Only the first record found for a reference is used
+            rows_by_reference = dict()
+            for row in self._DB_CURSOR.execute(
+                    select_records_str, chunk).fetchall():
+                key = row[str(where_dict_key)]
+                if key not in rows_by_reference:
+                    rows_by_reference[key] = row
+
+            record_rows = list()
+            for ref in chunk:
+                row = rows_by_reference.get(reference_key(ref), None)
+                if row is not None:
+                    record_rows.append(row)
+
+            rec_ids = sorted(set([x[b'id'] for x in record_rows]))
+
+            features = dict()
+            qualifiers = dict()
 
-        seq = self._get_sequence_from_representation(seq_rep_id=seq_rep_id)
+            if rec_ids:
+
+                select_features_str, select_qualifiers_str = \
+                    self._record_features_sql(len(rec_ids))
+
+                for row in self._DB_CURSOR.execute(
+                        select_features_str, rec_ids).fetchall():
+                    if row[b'rec_id'] not in features:
+                        features[row[b'rec_id']] = list()
+                    features[row[b'rec_id']].append(row)
+
+                for row in self._DB_CURSOR.execute(
+                        select_qualifiers_str, rec_ids).fetchall():
+                    if row[b'rec_feat_id'] not in qualifiers:
+                        qualifiers[row[b'rec_feat_id']] = dict()
+                    qualifiers[row[b'rec_feat_id']][row[b'type']] = [row[b'qualifier']]
+
+            record_list = list()
+
+            for results in record_rows:
+
+                active_state = int(results[b'active'])
+
+                if not (active and inactive):
+                    if active and active_state != 1:
+                        continue
+                    if inactive and active_state != 0:
+                        continue
+
+                org_dict = {
+                    'genus': results[b'genus'],
+                    'species': results[b'species'],
+                    'subspecies': results[b'subspecies'],
+                    'variety': results[b'variety'],
+                    'hybrid': results[b'hybrid'],
+                    'other': results[b'other']}
+                org_flat = krbionames.flatten_organism_name(
+                        parsed_name=org_dict, sep=' ')
+
+                seq_alphabet = self.string_to_bio_alphabet(
+                    str_alphabet=results[b'alphabet'])
+                seq_str = self.apply_seq_edits(
+                    e=results[b'representation'], s=str(results[b'sequence']))
+                seq = Seq.Seq(data=seq_str, alphabet=seq_alphabet)
+
+                feature_list = list()
+
+                for feat_raw in features.get(results[b'id'], list()):
+
+                    location = krseq.location_from_string(
+                        location_string=feat_raw[b'location'])
+
+                    feat = SeqFeature(
+                        location=location,
+                        type=feat_raw[b'type'],
+                        qualifiers=qualifiers.get(feat_raw[b'id'], dict())
+                        )
+
+                    feature_list.append(feat)
+
+                rec_id = results[b'ncbi_version']
+                if not rec_id:
+                    rec_id = ''
+
+                rec_name = results[b'ncbi_version']
+                if not rec_name:
+                    rec_name = ''
+
+                rec_description = results[b'description']
+                if not rec_description:
+                    rec_description = ''
+
+                record = SeqRecord(
+                    seq=seq,
+                    id=rec_id,
+                    name=rec_name,
+                    description=rec_description,
+                    features=feature_list)
+
+                record.annotations[b'gi'] = str(results[b'ncbi_gi'])
+                record.annotations[b'organism'] = str(org_flat)
+                record.annotations[b'common_name'] = str(results[b'common_name'])
+                record.annotations[b'lineage'] = str(results[b'taxonomy'])
+                record.annotations[b'internal_reference'] = str(results[b'internal_reference'])
+                record.annotations[b'kr_seq_db_org_id'] = str(results[b'org_id'])
+                record.annotations[b'kr_seq_db_id'] = str(results[b'id'])
+                record.annotations[b'kr_seq_db_active'] = str(results[b'active'])
 
-        features_temp = self.db_select(
-            # table_name_list=['record_features', 'record_feature_types'],
-            table_name_list=['record_features'],
-            column_list=['record_features.id', 'location', 'type'],
-            where_dict={'rec_id': results[b'id']},
-            # join_rules_str='record_features.rec_feat_type_id=record_feature_types.id',
-            order_by_column_list=None)
+                record_list.append(record)
 
-        features = list()
+            return record_list
 
-        for feat_raw in features_temp:
+        chunk = list()
+        for ref in record_reference_list:
+            chunk.append(ref)
+            if len(chunk) == chunk_size:
+                for record in load_chunk(chunk):
+                    yield record
+                chunk = list()
+        if chunk:
+            for record in load_chunk(chunk):
+                yield record
 
-            location_string = feat_raw[b'location']
-            location = krseq.location_from_string(
-                location_string=location_string)
 
-            qualifiers_temp = self.db_select(
-                # table_name_list=['record_feature_qualifiers', 'record_feature_qualifier_types'],
-                table_name_list=['record_feature_qualifiers'],
-                column_list=['qualifier', 'type'],
-                where_dict={'rec_feat_id': feat_raw[b'id']},
-                # join_rules_str='record_feature_qualifiers.rec_feat_qual_type_id=record_feature_qualifier_types.id',
-                order_by_column_list=None)
+    def get_record(
+        self,
+        record_reference,
+        record_reference_type='gi'  # gi version internal raw
+        ):
 
-            qualifiers = dict()
-            for qualifier in qualifiers_temp:
-                qualifiers[qualifier[b'type']] = [qualifier[b'qualifier']]
-
-            feat = SeqFeature(
-                location=location,
-                type=feat_raw[b'type'],
-                qualifiers=qualifiers
-                )
-
-            features.append(feat)
-
-        rec_id = results[b'ncbi_version']
-        if not rec_id:
-            rec_id = ''
-
-        rec_name = results[b'ncbi_version']
-        if not rec_name:
-            rec_name = ''
-
-        rec_description = results[b'description']
-        if not rec_description:
-            rec_description = ''
-
-        record = SeqRecord(
-            seq=seq,
-            id=rec_id,
-            name=rec_name,
-            description=rec_description,
-            features=features)
-
-        record.annotations[b'gi'] = str(results[b'ncbi_gi'])
-        record.annotations[b'organism'] = str(org_flat)
-        record.annotations[b'common_name'] = str(org_dict['common_name'])
-        record.annotations[b'lineage'] = str(org_dict['taxonomy'])
-        record.annotations[b'internal_reference'] = str(results[b'internal_reference'])
-        record.annotations[b'kr_seq_db_org_id'] = str(results[b'org_id'])
-        record.annotations[b'kr_seq_db_id'] = str(results[b'id'])
-        record.annotations[b'kr_seq_db_active'] = str(results[b'active'])
+        record = list(self.iter_records(
+            record_reference_list=[record_reference],
+            record_reference_type=record_reference_type,
+            active=True,
+            inactive=True))[0]
 
         return record
 
@@ -1625,33 +2246,19 @@ class KRSequenceDatabase:
         record_reference_list,
         record_reference_type='gi',  # gi version internal raw
         active=True,
-        inactive=False
+        inactive=False,
+        chunk_size=_DB_MAX_VARIABLES
         ):
 
         if (not active) and (not inactive):
             return None
 
-        record_list = list()
-
-        for ref in record_reference_list:
-            record = self.get_record(
-                record_reference=ref,
-                record_reference_type=record_reference_type  # gi version internal raw
-                )
-
-            active_state = int(record.annotations[b'kr_seq_db_active'])
-
-            accept = False
-
-            if active and inactive:
-                accept = True
-            elif active and active_state==1:
-                accept = True
-            elif inactive and active_state==0:
-                accept = True
-
-            if accept:
-                record_list.append(record)
+        record_list = list(self.iter_records(
+            record_reference_list=record_reference_list,
+            record_reference_type=record_reference_type,
+            active=active,
+            inactive=inactive,
+            chunk_size=chunk_size))
 
         return record_list
 
@@ -1671,6 +2278,9 @@ class KRSequenceDatabase:
             table_name = 'records',
             where_dict = None)
 
+        if not record_reference_list:
+            return list()
+
         records = self.get_records(
             record_reference_list=record_reference_list,
             record_reference_type='raw',
@@ -1686,16 +2296,9 @@ class KRSequenceDatabase:
         import sys
         import sqlite3
 
-        sql_string = '''
-            SELECT rec_id
-            FROM record_annotations
-            LEFT OUTER JOIN record_annotation_types ON record_annotation_types.id=rec_ann_type_id
-            LEFT OUTER JOIN record_annotation_values ON record_annotation_values.id=rec_ann_value_id
-            WHERE type IS ? AND value IS ?;
-            '''
-
         try:
-            self._DB_CURSOR.execute(sql_string, [annotation_type, annotation])
+            self._DB_CURSOR.execute(self._DB_ANNOTATION_SQL,
+                                    [annotation_type, annotation])
         except sqlite3.Error as error:
             print(error, file=sys.stderr)
             self._DB_CONN.rollback()
@@ -88,16 +88,13 @@ def concatenate(alignments, padding_length=0, partitions=None):
     return((result_alignment, partitions))
 
 
-def align(records, program, options='', program_executable=''):
+def _aligner_args_(program, options, program_executable, record_count):
 
-    import subprocess
-    from StringIO import StringIO
-    from Bio import AlignIO
-    from Bio import SeqIO
-    import shlex
+    '''
+    Command line for an alignment program reading FASTA from stdin.
+    '''
 
-    input_handle = StringIO()
-    SeqIO.write(records, input_handle, 'fasta')
+    import shlex
 
     args = None
 
@@ -111,7 +108,7 @@ def align(records, program, options='', program_executable=''):
 
     elif program == 'mafft':
 
-        if (len(records) > 5999) and ('--maxiterate' in options):
+        if (record_count > 5999) and ('--maxiterate' in options):
             maxiterate_index = options.index('--maxiterate')
             options.pop(maxiterate_index+1)
             options.pop(maxiterate_index)
@@ -121,34 +118,395 @@ def align(records, program, options='', program_executable=''):
     if program == 'clustalo':
         args = [program_executable] + options + ['-i', '-']
 
+    return(args)
+
+
+def _run_aligner_(args, fasta):
+
+    import subprocess
+
+    pipe = subprocess.Popen(
+        args=args,
+        bufsize=0,
+        executable=None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        preexec_fn=None,
+        close_fds=False,
+        shell=False,
+        cwd=None,
+        env=None,
+        universal_newlines=True,
+        startupinfo=None,
+        creationflags=0)
+
+    data = pipe.communicate(input=fasta)
+
+    return(data[0])
+
+
+def _banded_alignments_(center, reads, band, match, mismatch, gap_open,
+                        gap_extend, min_identity):
+
+    '''
+    Align each read to center with a banded global alignment, affine gap
+    penalties, and free end gaps at the 3' ends. All reads are aligned at
+    once, the dynamic programming matrices are stored per center position
+    as (read, diagonal) arrays. Returns a list of CIGAR strings, or None if
+    an alignment reaches the edge of the band or has less than min_identity
+    identical sites among aligned sites.
+    '''
+
+    import numpy
+
+    neg = -(2 ** 40)
+    go = gap_open + gap_extend
+    ge = gap_extend
+
+    n = len(center)
+    nr = len(reads)
+    kk = 2 * band + 1
+    k_range = numpy.arange(kk)
+
+    c = numpy.frombuffer(center.upper(), dtype=numpy.uint8)
+    m = numpy.array([len(x) for x in reads])
+
+    # Read bases, padded so that row i, diagonal k reads column i + k
+    width = max(m.max() + band + 2, n + kk + 1)
+    q = numpy.zeros((nr, width), dtype=numpy.uint8)
+    for r, x in enumerate(reads):
+        q[r, band + 1:band + 1 + len(x)] = numpy.frombuffer(
+            x.upper(), dtype=numpy.uint8)
+    unknown = ord('N')
+
+    hptr = numpy.zeros((n + 1, nr, kk), dtype=numpy.bool_)
+    gptr = numpy.zeros((n + 1, nr, kk), dtype=numpy.bool_)
+    eptr = numpy.zeros((n + 1, nr, kk), dtype=numpy.bool_)
+    fptr = numpy.zeros((n + 1, nr, kk), dtype=numpy.bool_)
+
+    # Row 0: leading insertions
+    j = k_range - band
+    valid = (j[numpy.newaxis, :] >= 0) & (j[numpy.newaxis, :] <= m[:, numpy.newaxis])
+    h = numpy.where(valid & (j > 0), go + (j - 1) * ge, neg)
+    h[:, band] = 0
+    f = numpy.zeros((nr, kk), dtype=numpy.int_) + neg
+    hptr[0] = valid & (j > 0)
+    eptr[0] = valid & (j > 1)
+
+    best = numpy.zeros(nr, dtype=numpy.int_) + neg
+    best_i = numpy.zeros(nr, dtype=numpy.int_)
+    best_k = numpy.zeros(nr, dtype=numpy.int_)
+    rows = numpy.arange(nr)
+
+    def update_best(i, h):
+        k_end = m - i + band
+        inside = (k_end >= 0) & (k_end < kk)
+        k_end = numpy.clip(k_end, 0, kk - 1)
+        v = numpy.where(inside, h[rows, k_end], neg)
+        better = v >= best
+        best[better] = v[better]
+        best_i[better] = i
+        best_k[better] = k_end[better]
+
+    update_best(0, h)
+
+    for i in range(1, n + 1):
+        j = i + k_range - band
+        valid = (j[numpy.newaxis, :] >= 0) & (j[numpy.newaxis, :] <= m[:, numpy.newaxis])
+
+        # Diagonal move
+        b = q[:, i:i + kk]
+        s = numpy.where(b == c[i - 1], match, mismatch)
+        s[(b == unknown) | (c[i - 1] == unknown)] = 0
+        diag = h + s
+        diag[:, j < 1] = neg
+
+        # Vertical move, gap in the read
+        f_ext = numpy.zeros((nr, kk), dtype=numpy.int_) + neg
+        f_open = numpy.zeros((nr, kk), dtype=numpy.int_) + neg
+        f_ext[:, :-1] = f[:, 1:] + ge
+        f_open[:, :-1] = h[:, 1:] + go
+        f = numpy.maximum(f_ext, f_open)
+        fptr[i] = f_ext > f_open
+
+        g = numpy.maximum(diag, f)
+        gptr[i] = f > diag
+        g[~valid] = neg
+        f[~valid] = neg
+
+        # Horizontal move, gap in the center
+        e = numpy.zeros((nr, kk), dtype=numpy.int_) + neg
+        acc = numpy.maximum.accumulate(g - k_range * ge, axis=1)
+        e[:, 1:] = acc[:, :-1] + go + (k_range[1:] - 1) * ge
+        e[~valid] = neg
+        eptr[i][:, 1:] = e[:, :-1] + ge > g[:, :-1] + go
+
+        h = numpy.maximum(g, e)
+        hptr[i] = e > g
+
+        update_best(i, h)
+
+    # Reads longer than the center end with free insertions
+    last = numpy.where(valid, h, neg)
+    k_last = last.argmax(axis=1)
+    better = last[rows, k_last] > best
+    best_i[better] = n
+    best_k[better] = k_last[better]
+
+    cigars = list()
+
+    for r in range(nr):
+        i = int(best_i[r])
+        k = int(best_k[r])
+        ops = ['I'] * (m[r] - (i + k - band))
+        state = 'H'
+        sites = 0
+        identical = 0
+        while i > 0 or i + k - band > 0:
+            if k == 0 or k == kk - 1:
+                return(None)
+            if state == 'H':
+                if hptr[i, r, k]:
+                    state = 'E'
+                else:
+                    state = 'G'
+            elif state == 'G':
+                if gptr[i, r, k]:
+                    state = 'F'
+                else:
+                    ops.append('M')
+                    sites = sites + 1
+                    if q[r, i + k] == c[i - 1]:
+                        identical = identical + 1
+                    i = i - 1
+                    state = 'H'
+            elif state == 'E':
+                ops.append('I')
+                if not eptr[i, r, k]:
+                    state = 'G'
+                k = k - 1
+            else:
+                ops.append('D')
+                if not fptr[i, r, k]:
+                    state = 'H'
+                i = i - 1
+                k = k + 1
+
+        if identical < min_identity * sites:
+            return(None)
+
+        ops.reverse()
+        cigar = ''
+        count = 0
+        for o, op in enumerate(ops):
+            count = count + 1
+            if o == len(ops) - 1 or ops[o + 1] != op:
+                cigar = cigar + str(count) + op
+                count = 0
+        cigars.append(cigar)
+
+    return(cigars)
+
+
+def center_star_alignment(sequences, band=10, match=2, mismatch=-3,
+                          gap_open=-5, gap_extend=-2, min_identity=0.9):
+
+    '''
+    Align similar sequences without an external program. The most common
+    sequence (the longest one if there is a tie) is the center, every other
+    sequence is aligned to it with a banded global alignment and the
+    pairwise alignments are merged. A gap of length L scores
+    gap_open + L * gap_extend, gaps at the 3' ends are free. Returns aligned
+    sequences in the input order, or None if an alignment does not fit in
+    the band or is less than min_identity identical, so the sequences
+    should be aligned by other means.
+    '''
+
+    import krnextgen
+
+    copies = dict()
+    for s in sequences:
+        copies[s.upper()] = copies.get(s.upper(), 0) + 1
+    center = max(sequences, key=lambda x: (copies[x.upper()], len(x)))
+
+    others = list()
+    for s in sequences:
+        if s.upper() != center.upper() and s not in others:
+            others.append(s)
+
+    cigars = dict()
+    if others:
+        aligned = _banded_alignments_(center, others, band, match, mismatch,
+                                      gap_open, gap_extend, min_identity)
+        if aligned is None:
+            return(None)
+        for s, cigar in zip(others, aligned):
+            cigars[s] = cigar
+
+    reads = [(0, str(len(center)) + 'M', center)]
+    for s in sequences:
+        if s.upper() == center.upper():
+            reads.append((0, str(len(s)) + 'M', s))
+        else:
+            reads.append((0, cigars[s], s))
+
+    return(krnextgen.alignment_from_CIGAR(reads)[1:])
+
+
+def _use_builtin_aligner_(sequences, builtin_max_records, builtin_max_length):
+
+    return(len(sequences) <= builtin_max_records and
+           max([len(x) for x in sequences]) <= builtin_max_length)
+
+
+def align(records, program, options='', program_executable='',
+          builtin_max_records=0, builtin_max_length=300):
+
+    '''
+    Align Bio SeqRecord objects with an external program. Sets of at most
+    builtin_max_records records no longer than builtin_max_length are
+    aligned with center_star_alignment instead, the external program is
+    used if they do not fit in the band.
+    '''
+
+    from StringIO import StringIO
+    from Bio import AlignIO
+    from Bio import SeqIO
+    from Bio.Align import MultipleSeqAlignment
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+
+    if _use_builtin_aligner_(records, builtin_max_records, builtin_max_length):
+        aligned = center_star_alignment([str(x.seq) for x in records])
+        if aligned is not None:
+            return MultipleSeqAlignment(
+                [SeqRecord(Seq(s), id=x.id, name='', description='')
+                 for x, s in zip(records, aligned)])
+
+    input_handle = StringIO()
+    SeqIO.write(records, input_handle, 'fasta')
+
+    args = _aligner_args_(program, options, program_executable, len(records))
+
     alignment = None
 
     if args:
         # print(args)
-        pipe = subprocess.Popen(
-            args=args,
-            bufsize=0,
-            executable=None,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=None,
-            close_fds=False,
-            shell=False,
-            cwd=None,
-            env=None,
-            universal_newlines=True,
-            startupinfo=None,
-            creationflags=0)
-
-        data = pipe.communicate(input=input_handle.getvalue())
-        alignment_string = StringIO(data[0])
+        alignment_string = StringIO(_run_aligner_(args, input_handle.getvalue()))
         # print(alignment_string.getvalue())
         alignment = AlignIO.read(alignment_string, 'fasta')
 
     return alignment
 
 
+def align_sequences(sequences, program, options='', program_executable='',
+                    builtin_max_records=0, builtin_max_length=300):
+
+    '''
+    Align sequences given as a list of (id, sequence) string tuples. Returns
+    a list of (id, aligned sequence) in the order produced by the program.
+    A single sequence, or sequences that are all identical, are returned as
+    they are, without running the program. Small sets of sequences are
+    aligned with center_star_alignment, as in align.
+    '''
+
+    if len(sequences) == 1:
+        return(list(sequences))
+
+    first = sequences[0][1].upper()
+    identical = True
+    for s in sequences:
+        if s[1].upper() != first:
+            identical = False
+            break
+    if identical:
+        return(list(sequences))
+
+    if _use_builtin_aligner_(sequences, builtin_max_records,
+                             builtin_max_length):
+        aligned = center_star_alignment([x[1] for x in sequences])
+        if aligned is not None:
+            return(zip([x[0] for x in sequences], aligned))
+
+    args = _aligner_args_(program, options, program_executable, len(sequences))
+
+    if not args:
+        return(None)
+
+    fasta = ''.join(['>' + x[0] + '\n' + x[1] + '\n' for x in sequences])
+
+    aligned = list()
+    for record in _run_aligner_(args, fasta).split('>')[1:]:
+        lines = record.split('\n')
+        aligned.append((lines[0].split()[0], ''.join(lines[1:])))
+
+    return(aligned)
+
+
+def _align_sequences_batch_(args):
+
+    (batch, program, options, program_executable, builtin_max_records,
+     builtin_max_length) = args
+
+    result = list()
+    for key, sequences in batch:
+        result.append(
+            (key, align_sequences(sequences, program, options,
+                                  program_executable, builtin_max_records,
+                                  builtin_max_length)))
+
+    return(result)
+
+
+def align_sequences_batches(batches, program, options='',
+                            program_executable='', processes=1,
+                            builtin_max_records=0, builtin_max_length=300):
+
+    '''
+    Align many small sets of sequences. batches is an iterable of lists of
+    (key, sequences) tuples, sequences as in align_sequences. Batches are
+    aligned by a pool of processes worker processes, at most two batches
+    per process are queued at a time. Yields (key, aligned sequences) in
+    input order as soon as they are available.
+    '''
+
+    from collections import deque
+    from multiprocessing import Pool
+
+    if processes <= 1:
+        for batch in batches:
+            for x in _align_sequences_batch_(
+                    (batch, program, options, program_executable,
+                     builtin_max_records, builtin_max_length)):
+                yield(x)
+        return
+
+    pool = Pool(processes=processes)
+
+    try:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(
+                _align_sequences_batch_,
+                ((batch, program, options, program_executable,
+                  builtin_max_records, builtin_max_length),)))
+            while len(pending) >= 2 * processes:
+                for x in pending.popleft().get():
+                    yield(x)
+        while pending:
+            for x in pending.popleft().get():
+                yield(x)
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+
 # def pairwise_identity(
 
 #     alignment,
@@ -124,102 +124,639 @@ def write_alignment_file(alignment, file_path, file_format):
     return count_written
 
 
+def _fastq_record_start_(handle, offset):
+
+    '''
+    Return the byte offset of the first FASTQ record that starts at or after
+    offset. A line that starts with '@' may also be a quality line, so a
+    record start is a line starting with '@' that is followed, two lines
+    later, by a line starting with '+'. Sequence lines never start with '+'.
+    '''
+
+    if offset == 0:
+        return 0
+
+    handle.seek(offset - 1)
+    handle.readline()
+
+    positions = list()
+    lines = list()
+
+    while True:
+        position = handle.tell()
+        line = handle.readline()
+        if not line:
+            break
+        positions.append(position)
+        lines.append(line)
+        if (len(lines) >= 3 and lines[-3].startswith(b'@') and
+                lines[-1].startswith(b'+')):
+            return positions[-3]
+
+    return handle.tell()
+
+
+def _fastq_count_lines_(args):
+
+    '''
+    Count lines in the byte range [start, end) of a file.
+    '''
+
+    file_path, start, end, block_size = args
+
+    lines = 0
+    last = b'\n'
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            lines = lines + block.count(b'\n')
+            last = block[-1:]
+            remaining = remaining - len(block)
+
+    # Last line of a file does not always end with a newline
+    if last != b'\n':
+        lines = lines + 1
+
+    return lines
+
+
+def _fastq_line_offsets_(file_path, line_numbers, block_size):
+
+    '''
+    Return byte offsets at which given (sorted) zero-based line numbers
+    start. Line numbers past the end of the file get the size of the file.
+    '''
+
+    offsets = list()
+    targets = list(line_numbers)
+
+    while targets and targets[0] == 0:
+        offsets.append(0)
+        targets.pop(0)
+
+    lines = 0
+    position = 0
+
+    with open(file_path, 'rb') as f:
+        while targets:
+            block = f.read(block_size)
+            if not block:
+                break
+            n = block.count(b'\n')
+            while targets and lines + n >= targets[0]:
+                i = -1
+                for k in range(0, targets[0] - lines):
+                    i = block.find(b'\n', i + 1)
+                offsets.append(position + i + 1)
+                targets.pop(0)
+            lines = lines + n
+            position = position + len(block)
+
+    for t in targets:
+        offsets.append(position)
+
+    return offsets
+
+
+def _copy_byte_range_(args):
+
+    '''
+    Copy the byte range [start, end) of one file into a new file. If compress
+    is True, the new file is BGZF compressed.
+    '''
+
+    import os
+    import krio
+
+    input_file_path, output_file_path, start, end, block_size, compress = args
+
+    if compress:
+        dst = krio.BGZFWriter(output_file_path)
+        with open(input_file_path, 'rb') as src:
+            src.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = src.read(min(block_size, remaining))
+                if not block:
+                    break
+                dst.write(block)
+                remaining = remaining - len(block)
+        dst.close()
+        return end - start
+
+    with open(input_file_path, 'rb') as src:
+        with open(output_file_path, 'wb') as dst:
+            remaining = end - start
+            if hasattr(os, 'sendfile'):
+                offset = start
+                while remaining > 0:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset,
+                                       min(block_size, remaining))
+                    if sent == 0:
+                        break
+                    offset = offset + sent
+                    remaining = remaining - sent
+            else:
+                src.seek(start)
+                while remaining > 0:
+                    block = src.read(min(block_size, remaining))
+                    if not block:
+                        break
+                    dst.write(block)
+                    remaining = remaining - len(block)
+
+    return end - start
+
+
 def split_fastq_file(pieces, output_dir, forward_reads_file_path,
                      reverse_reads_file_path=None, log_func=None,
-                     log_file_path=None):
+                     log_file_path=None, processes=None,
+                     block_size=16777216, compress=False):
+
+    '''
+    Split FASTQ file (and optionally a matching reverse reads file) into
+    pieces. Forward file is split at byte offsets aligned to record
+    boundaries, reverse file is split at the same record indexes, so forward
+    and reverse pieces stay paired. Pieces are copied in parallel using
+    processes worker processes (pieces by default).
+
+    gzip or BGZF compressed input files are first decompressed into
+    output_dir (BGZF blocks in parallel), the decompressed copies are removed
+    when done. If compress is True, pieces are written BGZF compressed, with
+    extension fastq.gz.
+    '''
 
     import os
+    from multiprocessing import Pool
     import krio
 
-    msg = 'Splitting FASTQ file into ' + str(pieces) + ' pieces.'
-    print(msg)
-    if log_func and log_file_path:
-        log_func(msg, log_file_path)
+    def log(msg):
+        print(msg)
+        if log_func and log_file_path:
+            log_func(msg, log_file_path)
+
+    log('Splitting FASTQ file into ' + str(pieces) + ' pieces.')
 
-    krio.prepare_directory(output_dir)
-    print('Counting reads, this may take some time...')
-    num_lines = krio.num_lines_in_file(forward_reads_file_path, print_every=400000)
-    msg = 'There are ' + str(num_lines / 4) + ' records.'
-    print(msg)
-    if log_func and log_file_path:
-        log_func(msg, log_file_path)
-    records_per_file = num_lines / 4 / pieces
+    if not processes:
+        processes = pieces
 
-    forward_file_handles = list()
-    reverse_file_handles = list()
+    krio.prepare_directory(output_dir)
 
+    # Byte offsets can not be used in compressed files
+    decompressed = list()
+    for direction in ['f', 'r']:
+        file_path = forward_reads_file_path
+        if direction == 'r':
+            file_path = reverse_reads_file_path
+        if not file_path or not krio.is_gzip_file(file_path):
+            continue
+        log('Decompressing ' + file_path)
+        decompressed_file_path = (output_dir + os.path.sep + direction +
+                                  '_decompressed.fastq.tmp')
+        krio.decompress_file(file_path, decompressed_file_path,
+                             processes=processes)
+        decompressed.append(decompressed_file_path)
+        if direction == 'f':
+            forward_reads_file_path = decompressed_file_path
+        else:
+            reverse_reads_file_path = decompressed_file_path
+
+    ext = '.fastq'
+    if compress:
+        ext = '.fastq.gz'
+
+    # Forward reads: byte offsets aligned to record boundaries
+    f_size = os.path.getsize(forward_reads_file_path)
+    f_offsets = list()
+    with open(forward_reads_file_path, 'rb') as f:
+        for piece in range(0, pieces):
+            f_offsets.append(_fastq_record_start_(f, f_size * piece // pieces))
+    f_offsets.append(f_size)
+
+    f_ranges = list()
     for piece in range(0, pieces):
-        handle = open(output_dir + os.path.sep + 'f_' + str(piece + 1) +
-                      '.fastq', 'wa')
-        forward_file_handles.append(handle)
+        f_ranges.append((f_offsets[piece], f_offsets[piece + 1]))
+
+    pool = Pool(processes=processes)
+
+    try:
+        # Count records in forward pieces
+        f_lines = pool.map(
+            _fastq_count_lines_,
+            [(forward_reads_file_path, x[0], x[1], block_size)
+             for x in f_ranges])
+
+        records = [x // 4 for x in f_lines]
+        log('There are ' + str(sum(records)) + ' records.')
+
+        # Reverse reads: offsets of the same records as in the forward pieces
+        r_ranges = list()
         if reverse_reads_file_path:
-            handle = open(output_dir + os.path.sep + 'r_' + str(piece + 1) +
-                          '.fastq', 'wa')
-            reverse_file_handles.append(handle)
-
-    forward_file_handles.reverse()
-    reverse_file_handles.reverse()
-
-    msg = '\nSplitting forward reads.\n'
-    print(msg)
-    if log_func and log_file_path:
-        log_func(msg, log_file_path)
-    with open(forward_reads_file_path) as f:
-        write_handle = None
-        lines_written = 0
-        for i, l in enumerate(f):
-            if (len(forward_file_handles) and
-                    ((float(i) / 4) % records_per_file == 0)):
-                if lines_written != 0:
-                    msg = '\tWritten ' + str(lines_written / 4) + ' records.'
-                    print(msg)
-                    if log_func and log_file_path:
-                        log_func(msg, log_file_path)
-                    lines_written = 0
-                msg = ('\t' + str(len(forward_file_handles)) +
-                       ' files remaining.')
-                print(msg)
-                if log_func and log_file_path:
-                    log_func(msg, log_file_path)
-                write_handle = forward_file_handles.pop()
-            write_handle.write(l)
-            lines_written = lines_written + 1
-            if num_lines == i + 1:
-                msg = '\tWritten ' + str(lines_written / 4) + ' records.'
-                print(msg)
-                if log_func and log_file_path:
-                    log_func(msg, log_file_path)
-
-    if reverse_reads_file_path:
-        msg = '\nSplitting reverse reads.\n'
-        print(msg)
-        if log_func and log_file_path:
-            log_func(msg, log_file_path)
-        with open(reverse_reads_file_path) as f:
-            write_handle = None
-            lines_written = 0
-            for i, l in enumerate(f):
-                if (len(reverse_file_handles) and
-                        ((float(i) / 4) % records_per_file == 0)):
-                    if lines_written != 0:
-                        msg = '\tWritten ' + str(lines_written / 4) + ' records.'
-                        print(msg)
-                        if log_func and log_file_path:
-                            log_func(msg, log_file_path)
-                        lines_written = 0
-                    msg = ('\t' + str(len(reverse_file_handles)) +
-                           ' files remaining.')
-                    print(msg)
-                    if log_func and log_file_path:
-                        log_func(msg, log_file_path)
-                    write_handle = reverse_file_handles.pop()
-                write_handle.write(l)
-                lines_written = lines_written + 1
-                if num_lines == i + 1:
-                    msg = '\tWritten ' + str(lines_written / 4) + ' records.'
-                    print(msg)
-                    if log_func and log_file_path:
-                        log_func(msg, log_file_path)
+            line_numbers = list()
+            for piece in range(0, pieces):
+                line_numbers.append(sum(f_lines[0:piece]))
+            r_offsets = _fastq_line_offsets_(
+                reverse_reads_file_path, line_numbers, block_size)
+            r_offsets.append(os.path.getsize(reverse_reads_file_path))
+            for piece in range(0, pieces):
+                r_ranges.append((r_offsets[piece], r_offsets[piece + 1]))
+
+        jobs = list()
+        for piece in range(0, pieces):
+            jobs.append((
+                forward_reads_file_path,
+                output_dir + os.path.sep + 'f_' + str(piece + 1) + ext,
+                f_ranges[piece][0], f_ranges[piece][1], block_size,
+                compress))
+            if reverse_reads_file_path:
+                jobs.append((
+                    reverse_reads_file_path,
+                    output_dir + os.path.sep + 'r_' + str(piece + 1) + ext,
+                    r_ranges[piece][0], r_ranges[piece][1], block_size,
+                    compress))
+
+        pool.map(_copy_byte_range_, jobs)
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+        for file_path in decompressed:
+            os.remove(file_path)
+
+    for piece in range(0, pieces):
+        log('\tPiece ' + str(piece + 1) + ': written ' +
+            str(records[piece]) + ' records.')
+
+    return records
+
+
+# Binary reads files ----------------------------------------------------------
+#
+# A compact container for reads exchanged between pipeline steps.
+#
+#   header  'KRBR', version (uint8), flags (uint8, 1 - has qualities)
+#   blocks  'B', payload size (uint32), record count (uint32),
+#           zlib compressed payload
+#   index   'I', block count (uint32), then for every block its file offset
+#           (uint64) and record count (uint32)
+#   trailer index offset (uint64), 'KRBE'
+#
+# Block payload, all integers are little endian uint32:
+#
+#   record count, exception count
+#   title lengths, titles
+#   sequence lengths
+#   bases, 2 bits per base: A 0, C 1, G 2, T 3, anything else 0
+#   N mask, 1 bit per base
+#   exceptions: positions and values of bases other than ACGTN
+#   qualities, one byte per base, if the file has qualities
+
+_BINARY_READS_MAGIC_ = b'KRBR'
+_BINARY_READS_END_ = b'KRBE'
+_BINARY_READS_VERSION_ = 1
+
+
+def _bytes_to_array_(data, dtype):
+    import numpy
+    if not data:
+        return(numpy.zeros(0, dtype=dtype))
+    return(numpy.frombuffer(data, dtype=dtype))
+
+
+def encode_reads_block(records, has_qualities=True, compression_level=6):
+
+    '''
+    Encode (title, seq, qual) records as a block of a binary reads file.
+    Blocks can be encoded in worker processes and written with
+    BinaryReadsWriter.write_block.
+    '''
+
+    import struct
+    import zlib
+    import numpy
+
+    titles = [r[0] for r in records]
+    seqs = [r[1] for r in records]
+
+    title_lengths = numpy.array([len(x) for x in titles], dtype='<u4')
+    seq_lengths = numpy.array([len(x) for x in seqs], dtype='<u4')
+
+    seq = _bytes_to_array_(b''.join(seqs), numpy.uint8)
+    length = len(seq)
+
+    codes = numpy.zeros(256, dtype=numpy.uint8)
+    known = numpy.zeros(256, dtype=bool)
+    for code, base in enumerate('ACGT'):
+        codes[ord(base)] = code
+        known[ord(base)] = True
+    known[ord('N')] = True
+
+    packed = numpy.zeros(((length + 3) // 4) * 4, dtype=numpy.uint8)
+    packed[:length] = codes[seq]
+    packed = packed.reshape(-1, 4)
+    packed = (packed[:, 0] | (packed[:, 1] << 2) | (packed[:, 2] << 4) |
+              (packed[:, 3] << 6)).astype(numpy.uint8)
+
+    n_mask = numpy.packbits(seq == ord('N'))
+
+    exceptions = numpy.nonzero(~known[seq])[0].astype('<u4')
+
+    payload = [
+        struct.pack('<II', len(records), len(exceptions)),
+        title_lengths.tobytes(),
+        b''.join(titles),
+        seq_lengths.tobytes(),
+        packed.tobytes(),
+        n_mask.tobytes(),
+        exceptions.tobytes(),
+        seq[exceptions].tobytes()]
+
+    if has_qualities:
+        qual = b''.join([r[2] for r in records])
+        if len(qual) != length:
+            raise ValueError(
+                'Sequence and quality strings differ in length.')
+        payload.append(qual)
+
+    payload = zlib.compress(b''.join(payload), compression_level)
+
+    block = (b'B' + struct.pack('<II', len(payload), len(records)) +
+             payload)
+
+    return(block)
+
+
+def decode_reads_block(payload, has_qualities=True):
+
+    '''
+    Decode the compressed payload of a binary reads file block. Returns a list
+    of (title, seq, qual) records, qual is None if the file has no qualities.
+    '''
+
+    import struct
+    import zlib
+    import numpy
+
+    payload = zlib.decompress(payload)
+
+    count, exception_count = struct.unpack('<II', payload[0:8])
+    i = 8
+
+    def take(size):
+        start = i
+        return(payload[start:start + size], start + size)
+
+    data, i = take(4 * count)
+    title_lengths = _bytes_to_array_(data, '<u4')
+    data, i = take(int(title_lengths.sum()))
+    titles = data
+    data, i = take(4 * count)
+    seq_lengths = _bytes_to_array_(data, '<u4')
+    length = int(seq_lengths.sum())
+    data, i = take((length + 3) // 4)
+    packed = _bytes_to_array_(data, numpy.uint8)
+    data, i = take((length + 7) // 8)
+    n_mask = _bytes_to_array_(data, numpy.uint8)
+    data, i = take(4 * exception_count)
+    exceptions = _bytes_to_array_(data, '<u4')
+    data, i = take(exception_count)
+    exception_values = _bytes_to_array_(data, numpy.uint8)
+    qual = None
+    if has_qualities:
+        qual, i = take(length)
+
+    codes = numpy.zeros(len(packed) * 4, dtype=numpy.uint8)
+    for shift in range(0, 4):
+        codes[shift::4] = (packed >> (2 * shift)) & 3
+
+    seq = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)[codes[:length]]
+    seq[numpy.unpackbits(n_mask)[:length].astype(bool)] = ord('N')
+    seq[exceptions] = exception_values
+    seq = seq.tobytes()
+
+    records = list()
+    title_start = 0
+    seq_start = 0
+    for title_length, seq_length in zip(title_lengths.tolist(),
+                                        seq_lengths.tolist()):
+        title = titles[title_start:title_start + title_length]
+        record_seq = seq[seq_start:seq_start + seq_length]
+        record_qual = None
+        if has_qualities:
+            record_qual = qual[seq_start:seq_start + seq_length]
+        records.append((title, record_seq, record_qual))
+        title_start = title_start + title_length
+        seq_start = seq_start + seq_length
+
+    return(records)
+
+
+class BinaryReadsWriter:
+
+    '''
+    Write (title, seq, qual) records to a binary reads file, block_size
+    records per block. close() writes the block index.
+    '''
+
+    def __init__(self, file_path, has_qualities=True, block_size=10000,
+                 compression_level=6):
+
+        import struct
+
+        self.has_qualities = has_qualities
+        self.block_size = block_size
+        self.compression_level = compression_level
+        self.records = list()
+        self.index = list()
+        self.handle = open(file_path, 'wb')
+        self.handle.write(_BINARY_READS_MAGIC_ + struct.pack(
+            '<BB', _BINARY_READS_VERSION_, int(bool(has_qualities))))
+
+    def write(self, records):
+        for record in records:
+            self.records.append(record)
+            if len(self.records) >= self.block_size:
+                self.flush()
+
+    def write_block(self, block):
+        import struct
+        self.flush()
+        count = struct.unpack('<I', block[5:9])[0]
+        self.index.append((self.handle.tell(), count))
+        self.handle.write(block)
+
+    def flush(self):
+        if self.records:
+            block = encode_reads_block(
+                records=self.records,
+                has_qualities=self.has_qualities,
+                compression_level=self.compression_level)
+            self.records = list()
+            self.write_block(block)
+
+    def close(self):
+        import struct
+        self.flush()
+        index_offset = self.handle.tell()
+        self.handle.write(b'I' + struct.pack('<I', len(self.index)))
+        for offset, count in self.index:
+            self.handle.write(struct.pack('<QI', offset, count))
+        self.handle.write(struct.pack('<Q', index_offset) +
+                          _BINARY_READS_END_)
+        self.handle.close()
+
+
+class BinaryReadsReader:
+
+    '''
+    Iterate over (title, seq, qual) records of a binary reads file. Blocks
+    can also be read in any order using the index, see read_index and
+    read_block.
+    '''
+
+    def __init__(self, file_path):
+
+        import struct
+
+        self.handle = open(file_path, 'rb')
+        header = self.handle.read(6)
+        if len(header) < 6 or header[0:4] != _BINARY_READS_MAGIC_:
+            self.handle.close()
+            raise ValueError('Not a binary reads file: ' + file_path)
+        version, flags = struct.unpack('<BB', header[4:6])
+        if version > _BINARY_READS_VERSION_:
+            self.handle.close()
+            raise ValueError('Unsupported binary reads file version: ' +
+                             str(version))
+        self.has_qualities = bool(flags & 1)
+        self.records = list()
+        self.position = 6
+
+    def _read_block_at_(self, offset):
+        import struct
+        self.handle.seek(offset)
+        kind = self.handle.read(1)
+        if kind != b'B':
+            return(None)
+        size, count = struct.unpack('<II', self.handle.read(8))
+        records = decode_reads_block(self.handle.read(size),
+                                     self.has_qualities)
+        return(records)
+
+    def next(self):
+        while not self.records:
+            if self.position is None:
+                raise StopIteration
+            records = self._read_block_at_(self.position)
+            if records is None:
+                self.position = None
+                raise StopIteration
+            self.position = self.handle.tell()
+            records.reverse()
+            self.records = records
+        return(self.records.pop())
+
+    def __iter__(self):
+        return self
+
+    def read_index(self):
+
+        '''
+        Returns a list of (offset, record count) tuples, one per block.
+        '''
+
+        import struct
+        self.handle.seek(-12, 2)
+        trailer = self.handle.read(12)
+        if trailer[8:12] != _BINARY_READS_END_:
+            raise ValueError('Binary reads file is incomplete.')
+        index_offset = struct.unpack('<Q', trailer[0:8])[0]
+        self.handle.seek(index_offset)
+        if self.handle.read(1) != b'I':
+            raise ValueError('Binary reads file index is damaged.')
+        count = struct.unpack('<I', self.handle.read(4))[0]
+        index = list()
+        for i in range(0, count):
+            index.append(struct.unpack('<QI', self.handle.read(12)))
+        return(index)
+
+    def read_block(self, offset):
+
+        '''
+        Returns the records of a block at offset, see read_index.
+        '''
+
+        return(self._read_block_at_(offset))
+
+    def close(self):
+        self.handle.close()
+
+
+def is_binary_reads_file(file_path):
+
+    '''
+    Check if a file is a binary reads file.
+    '''
+
+    handle = open(file_path, 'rb')
+    magic = handle.read(4)
+    handle.close()
+    return(magic == _BINARY_READS_MAGIC_)
+
+
+def read_reads_file(file_path, processes=1):
+
+    '''
+    Iterate over (title, seq, qual) records of a binary reads file or a FASTQ
+    file. FASTQ files can be gzip or BGZF compressed, BGZF blocks are
+    decompressed by processes worker processes if processes is more than 1.
+    '''
+
+    import krio
+
+    if is_binary_reads_file(file_path):
+        handle = BinaryReadsReader(file_path)
+        records = handle
+    else:
+        from Bio.SeqIO.QualityIO import FastqGeneralIterator
+        handle = krio.open_file(file_path, 'rU', processes=processes)
+        records = FastqGeneralIterator(handle)
+
+    try:
+        for record in records:
+            yield record
+    finally:
+        handle.close()
+
+
+def export_binary_reads(input_file_path, output_file_path,
+                        file_format='fastq'):
+
+    '''
+    Write reads from a binary reads file as FASTQ or FASTA, for programs that
+    do not read binary reads files. Files without qualities are always written
+    as FASTA. Returns the number of records written.
+    '''
+
+    count = 0
+    handle = open(output_file_path, 'w')
+    for title, seq, qual in read_reads_file(input_file_path):
+        if file_format == 'fasta' or qual is None:
+            handle.write('>' + title + '\n' + seq + '\n')
+        else:
+            handle.write('@' + title + '\n' + seq + '\n+\n' + qual + '\n')
+        count = count + 1
+    handle.close()
+
+    return(count)
 
 
 # if __name__ == '__main__':
@@ -67,13 +67,14 @@ def prepare_directory(path):
 
 
 def num_lines_in_file(file_path, print_every=None):
-    with open(file_path) as f:
-        for i, l in enumerate(f):
-            pass
-            # if print_every:
-                # if i % print_every == 0:
-                    # print(i)
-        # ah... wonderful Python scope rules!
+    f = open_file(file_path)
+    for i, l in enumerate(f):
+        pass
+        # if print_every:
+            # if i % print_every == 0:
+                # print(i)
+    f.close()
+    # ah... wonderful Python scope rules!
     return(i + 1)
 
 
@@ -202,6 +203,323 @@ def replace_line_in_file(file_path, line_str, replace_str):
             print(line.strip('\n'))
 
 
+# Compressed files ------------------------------------------------------------
+#
+# BGZF (bgzip) files are series of gzip members of at most 64 KB of data, each
+# with its compressed size in the header, so the members can be decompressed
+# independently in worker processes.
+
+_BGZF_EOF_ = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+              b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+# Data in one BGZF block, stored (not compressed) data still fits in a block
+_BGZF_BLOCK_DATA_SIZE_ = 65280
+
+
+def is_gzip_file(file_path):
+
+    '''
+    Check if a file is gzip (or BGZF) compressed.
+    '''
+
+    with open(file_path, 'rb') as f:
+        magic = f.read(2)
+    return(magic == b'\x1f\x8b')
+
+
+def _bgzf_block_size_(header):
+
+    '''
+    Return the size of a BGZF block from its header or None if header is not
+    a BGZF block header.
+    '''
+
+    import struct
+
+    if len(header) < 18 or header[0:4] != b'\x1f\x8b\x08\x04':
+        return(None)
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            return(struct.unpack('<H', extra[i + 4:i + 6])[0] + 1)
+        i = i + 4 + slen
+    return(None)
+
+
+def is_bgzf_file(file_path):
+
+    '''
+    Check if a file is BGZF (bgzip) compressed.
+    '''
+
+    with open(file_path, 'rb') as f:
+        header = f.read(64)
+    return(_bgzf_block_size_(header) is not None)
+
+
+def bgzf_ranges(file_path, range_size=4194304):
+
+    '''
+    Return (start, end) byte ranges of a BGZF file, each made of whole
+    blocks and about range_size bytes long.
+    '''
+
+    import os
+
+    file_size = os.path.getsize(file_path)
+    ranges = list()
+    start = 0
+    offset = 0
+
+    # Unbuffered, only block headers are read
+    with open(file_path, 'rb', 0) as f:
+        while offset < file_size:
+            f.seek(offset)
+            block_size = _bgzf_block_size_(f.read(64))
+            if block_size is None:
+                raise ValueError('Not a BGZF block at offset ' + str(offset) +
+                                 ' in ' + file_path)
+            offset = offset + block_size
+            if offset - start >= range_size:
+                ranges.append((start, offset))
+                start = offset
+
+    if offset > start:
+        ranges.append((start, offset))
+
+    return(ranges)
+
+
+def _bgzf_inflate_range_(args):
+
+    '''
+    Decompress the BGZF blocks in the byte range [start, end) of a file.
+    '''
+
+    import zlib
+
+    file_path, start, end = args
+
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    decompressed = list()
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed.append(d.decompress(data))
+        data = d.unused_data
+
+    return(b''.join(decompressed))
+
+
+def _bgzf_deflate_(args):
+
+    '''
+    Compress data as BGZF blocks.
+    '''
+
+    import struct
+    import zlib
+
+    data, compression_level = args
+
+    blocks = list()
+    for i in range(0, len(data), _BGZF_BLOCK_DATA_SIZE_):
+        chunk = data[i:i + _BGZF_BLOCK_DATA_SIZE_]
+        c = zlib.compressobj(compression_level, zlib.DEFLATED,
+                             -zlib.MAX_WBITS)
+        cdata = c.compress(chunk) + c.flush()
+        if len(cdata) > 65536 - 26:
+            c = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+            cdata = c.compress(chunk) + c.flush()
+        blocks.append(
+            b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00' +
+            struct.pack('<H', len(cdata) + 25) + cdata +
+            struct.pack('<II', zlib.crc32(chunk) & 0xffffffff,
+                        len(chunk)))
+
+    return(b''.join(blocks))
+
+
+class BGZFReader:
+
+    '''
+    Read lines of a BGZF file, blocks are decompressed ahead by a pool of
+    worker processes.
+    '''
+
+    def __init__(self, file_path, processes=2, range_size=4194304):
+
+        from collections import deque
+        from multiprocessing import Pool
+
+        self.file_path = file_path
+        self.processes = processes
+        self.ranges = deque(bgzf_ranges(file_path, range_size))
+        self.pending = deque()
+        self.lines = list()
+        self.rest = b''
+        self.pool = Pool(processes=processes)
+
+    def _read_chunk_(self):
+        while self.ranges and len(self.pending) < 2 * self.processes:
+            start, end = self.ranges.popleft()
+            self.pending.append(self.pool.apply_async(
+                _bgzf_inflate_range_, ((self.file_path, start, end),)))
+        if not self.pending:
+            return(None)
+        return(self.pending.popleft().get())
+
+    def readline(self):
+        while not self.lines:
+            chunk = self._read_chunk_()
+            if chunk is None:
+                line = self.rest
+                self.rest = b''
+                return(line)
+            lines = (self.rest + chunk).split(b'\n')
+            self.rest = lines.pop()
+            lines = [x + b'\n' for x in lines]
+            lines.reverse()
+            self.lines = lines
+        return(self.lines.pop())
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class BGZFWriter:
+
+    '''
+    Write a BGZF file, blocks are compressed by a pool of worker processes
+    (in this process if processes is 1).
+    '''
+
+    def __init__(self, file_path, processes=1, compression_level=6):
+
+        from collections import deque
+        from multiprocessing import Pool
+
+        self.handle = open(file_path, 'wb')
+        self.processes = processes
+        self.compression_level = compression_level
+        self.buffer = list()
+        self.buffer_size = 0
+        self.pending = deque()
+        self.pool = None
+        if processes > 1:
+            self.pool = Pool(processes=processes)
+
+    def _compress_(self, data):
+        args = (data, self.compression_level)
+        if self.pool is None:
+            self.handle.write(_bgzf_deflate_(args))
+            return
+        self.pending.append(self.pool.apply_async(_bgzf_deflate_, (args,)))
+        while len(self.pending) >= 2 * self.processes:
+            self.handle.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size = self.buffer_size + len(data)
+        if self.buffer_size >= 64 * _BGZF_BLOCK_DATA_SIZE_:
+            data = b''.join(self.buffer)
+            size = (len(data) // _BGZF_BLOCK_DATA_SIZE_ *
+                    _BGZF_BLOCK_DATA_SIZE_)
+            self.buffer = [data[size:]]
+            self.buffer_size = len(data) - size
+            self._compress_(data[:size])
+
+    def close(self):
+        data = b''.join(self.buffer)
+        self.buffer = list()
+        self.buffer_size = 0
+        if data:
+            self._compress_(data)
+        while self.pending:
+            self.handle.write(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.handle.write(_BGZF_EOF_)
+        self.handle.close()
+
+
+def open_file(file_path, mode='rU', processes=1):
+
+    '''
+    Open a plain text, gzip or BGZF compressed file. BGZF files are read with
+    BGZFReader if processes is more than 1. Files with names ending in .gz or
+    .bgz are written with BGZFWriter.
+    '''
+
+    import gzip
+
+    if mode.startswith('r'):
+        if is_gzip_file(file_path):
+            if processes > 1 and is_bgzf_file(file_path):
+                return(BGZFReader(file_path, processes=processes))
+            return(gzip.open(file_path, 'rb'))
+        return(open(file_path, mode))
+
+    if file_path.endswith('.gz') or file_path.endswith('.bgz'):
+        return(BGZFWriter(file_path, processes=processes))
+
+    return(open(file_path, mode))
+
+
+def decompress_file(file_path, output_file_path, processes=1,
+                    range_size=4194304):
+
+    '''
+    Decompress a gzip or BGZF file. BGZF blocks are decompressed in parallel.
+    '''
+
+    import gzip
+    import shutil
+    from collections import deque
+    from multiprocessing import Pool
+
+    if not is_bgzf_file(file_path) or processes < 2:
+        src = gzip.open(file_path, 'rb')
+        with open(output_file_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, range_size)
+        src.close()
+        return
+
+    pool = Pool(processes=processes)
+    try:
+        pending = deque()
+        with open(output_file_path, 'wb') as dst:
+            for start, end in bgzf_ranges(file_path, range_size):
+                pending.append(pool.apply_async(
+                    _bgzf_inflate_range_, ((file_path, start, end),)))
+                if len(pending) >= 2 * processes:
+                    dst.write(pending.popleft().get())
+            while pending:
+                dst.write(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 if __name__ == '__main__':
 
     # Tests
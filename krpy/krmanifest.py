@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+# from __future__ import unicode_literals
+
+# Version strings of the executables, keyed by the command used to get them.
+_TOOL_VERSIONS_ = dict()
+
+
+def file_checksum(file_path, block_size=1048576):
+
+    '''
+    MD5 checksum of the contents of a file.
+    '''
+
+    import hashlib
+
+    md5 = hashlib.md5()
+    handle = open(file_path, 'rb')
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        md5.update(block)
+    handle.close()
+    return(md5.hexdigest())
+
+
+def tool_version(executable, version_option='--version'):
+
+    '''
+    First line of whatever an executable prints when asked for its version.
+    Returns an empty string if the executable could not be run.
+    '''
+
+    import subprocess
+
+    command = executable + ' ' + version_option
+    if command in _TOOL_VERSIONS_:
+        return(_TOOL_VERSIONS_[command])
+
+    version = ''
+    try:
+        process = subprocess.Popen(command, shell=True,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        for l in output.splitlines():
+            l = l.strip()
+            if l:
+                version = l
+                break
+    except OSError:
+        pass
+
+    _TOOL_VERSIONS_[command] = version
+    return(version)
+
+
+def config_parameters(config, options):
+
+    '''
+    Values of configuration options as a list of (name, value) tuples.
+
+    options is a list of (section, option) tuples. If option is None, all
+    options in the section are included. Missing options have value None.
+    '''
+
+    parameters = list()
+    for section, option in options:
+        if option is None:
+            if config.has_section(section):
+                items = sorted(config.items(section))
+                for name, value in items:
+                    parameters.append((section + '.' + name, value))
+            continue
+        value = None
+        if config.has_option(section, option):
+            value = config.get(section, option)
+        parameters.append((section + '.' + option, value))
+    return(parameters)
+
+
+class Manifest():
+
+    '''
+    Record of the units of work (a sample in a workflow step) that have been
+    run: a fingerprint of their input file checksums, parameters and tool
+    versions, and the files they produced. A unit has to be run again only if
+    its fingerprint changed or one of its output files is missing.
+
+    File checksums are cached with the size and modification time of the
+    file, so unchanged files are not read again.
+    '''
+
+    def __init__(self, file_path):
+
+        import os
+        import json
+
+        self._file_path = file_path
+        self._files = dict()
+        self._units = dict()
+
+        if os.path.exists(file_path):
+            handle = open(file_path, 'rb')
+            data = json.load(handle)
+            handle.close()
+            self._files = data['files']
+            self._units = data['units']
+
+    def checksum(self, file_path):
+
+        import os
+
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cached = self._files.get(file_path, None)
+        if (cached is not None and cached[0] == stat.st_size and
+                cached[1] == stat.st_mtime):
+            return(cached[2])
+        checksum = file_checksum(file_path)
+        self._files[file_path] = [stat.st_size, stat.st_mtime, checksum]
+        return(checksum)
+
+    def fingerprint(self, input_file_paths=None, parameters=None, tools=None):
+
+        '''
+        input_file_paths - files the unit reads. Missing files are recorded
+            as such.
+        parameters - list of (name, value) tuples, see config_parameters.
+        tools - list of tool version strings, see tool_version.
+        '''
+
+        import os
+        import hashlib
+
+        md5 = hashlib.md5()
+
+        if input_file_paths:
+            for file_path in input_file_paths:
+                checksum = 'missing'
+                if os.path.exists(file_path):
+                    checksum = self.checksum(file_path)
+                md5.update('file\t' + os.path.basename(file_path) + '\t' +
+                           checksum + '\n')
+
+        if parameters:
+            for name, value in parameters:
+                md5.update('parameter\t' + name + '\t' + repr(value) + '\n')
+
+        if tools:
+            for version in tools:
+                md5.update('tool\t' + version + '\n')
+
+        return(md5.hexdigest())
+
+    def is_current(self, step, unit, fingerprint):
+
+        import os
+
+        record = self._units.get(step, dict()).get(unit, None)
+        if record is None or record['fingerprint'] != fingerprint:
+            return(False)
+        for file_path in record['outputs']:
+            if not os.path.exists(file_path):
+                return(False)
+        return(True)
+
+    def record(self, step, unit, fingerprint, output_file_paths):
+
+        import os
+        import datetime
+
+        if step not in self._units:
+            self._units[step] = dict()
+        self._units[step][unit] = {
+            'fingerprint': fingerprint,
+            'outputs': [os.path.abspath(x) for x in output_file_paths],
+            'time': datetime.datetime.now().isoformat()}
+
+    def save(self):
+
+        '''
+        Writes the manifest to a temporary file first, so an interrupted run
+        does not leave a truncated manifest behind.
+        '''
+
+        import os
+        import json
+
+        temp_file_path = self._file_path + '.temp'
+        handle = open(temp_file_path, 'wb')
+        json.dump({'files': self._files, 'units': self._units}, handle,
+                  indent=1, sort_keys=True)
+        handle.close()
+        os.rename(temp_file_path, self._file_path)
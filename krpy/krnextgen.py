@@ -29,33 +29,60 @@ def read_barcodes(file_path, delimiter, id_header, barcode_header):
     return(barcodes)
 
 
+def mask_low_quality_sites_batch(seq_strs, qual_strs, quality_score_treshold,
+                                 low_quality_residue='N'):
+
+    '''
+        Mask low quality sites in many reads at once. seq_strs and qual_strs
+        are lists of sequence and quality (phred+33) byte strings of the same
+        lengths. All reads are masked with one NumPy operation.
+
+        Returns a list of masked sequence strings.
+    '''
+
+    import numpy
+
+    if not seq_strs:
+        return(list())
+
+    # The reads are joined and split again by sequence length, so a
+    # quality string of the wrong length would shift every later read
+    if len(seq_strs) != len(qual_strs):
+        raise ValueError('Got ' + str(len(seq_strs)) + ' sequences and ' +
+                         str(len(qual_strs)) + ' quality strings.')
+    for i, (s, q) in enumerate(zip(seq_strs, qual_strs)):
+        if len(s) != len(q):
+            raise ValueError('Read ' + str(i) + ' has ' + str(len(s)) +
+                             ' sites and ' + str(len(q)) +
+                             ' quality scores.')
+
+    seq = numpy.frombuffer(b''.join(seq_strs), dtype=numpy.uint8).copy()
+    qual = numpy.frombuffer(b''.join(qual_strs), dtype=numpy.uint8)
+
+    # Same as qual - 33 < quality_score_treshold, without uint8 wrap-around
+    seq[qual < quality_score_treshold + 33] = ord(low_quality_residue)
+    seq = seq.tobytes()
+
+    masked = list()
+    start = 0
+    for s in seq_strs:
+        stop = start + len(s)
+        masked.append(seq[start:stop])
+        start = stop
+
+    return(masked)
+
+
 def mask_low_quality_sites(seq_str, qual_str, quality_score_treshold,
                            low_quality_residue='N'):
 
-    # phred_dict = dict((chr(min(126, qp + 33)), qp) for qp in range(0, 93 + 1))
-
-    phred_dict = {
-        '$': 3, '(': 7, ',': 11, '0': 15, '4': 19, '8': 23, '<': 27, '@': 31,
-        'D': 35, 'H': 39, 'L': 43, 'P': 47, 'T': 51, 'X': 55, '\\': 59,
-        '`': 63, 'd': 67, 'h': 71, 'l': 75, 'p': 79, 't': 83, 'x': 87,
-        '|': 91, '#': 2, "'": 6, '+': 10, '/': 14, '3': 18, '7': 22, ';': 26,
-        '?': 30, 'C': 34, 'G': 38, 'K': 42, 'O': 46, 'S': 50, 'W': 54, '[': 58,
-        '_': 62, 'c': 66, 'g': 70, 'k': 74, 'o': 78, 's': 82, 'w': 86, '{': 90,
-        '"': 1, '&': 5, '*': 9, '.': 13, '2': 17, '6': 21, ':': 25, '>': 29,
-        'B': 33, 'F': 37, 'J': 41, 'N': 45, 'R': 49, 'V': 53, 'Z': 57, '^': 61,
-        'b': 65, 'f': 69, 'j': 73, 'n': 77, 'r': 81, 'v': 85, 'z': 89, '~': 93,
-        '!': 0, '%': 4, ')': 8, '-': 12, '1': 16, '5': 20, '9': 24, '=': 28,
-        'A': 32, 'E': 36, 'I': 40, 'M': 44, 'Q': 48, 'U': 52, 'Y': 56, ']': 60,
-        'a': 64, 'e': 68, 'i': 72, 'm': 76, 'q': 80, 'u': 84, 'y': 88, '}': 92}
-
-    quality_scores = [phred_dict[y] for y in qual_str]
-    masked = ''
-    for i, q in enumerate(quality_scores):
-        bp = seq_str[i]
-        if q < quality_score_treshold:
-            bp = low_quality_residue
-        masked = masked + bp
-    return(masked)
+    masked = mask_low_quality_sites_batch(
+        seq_strs=[seq_str],
+        qual_strs=[qual_str],
+        quality_score_treshold=quality_score_treshold,
+        low_quality_residue=low_quality_residue)
+
+    return(masked[0])
 
 
 # def mask_low_quality_sites(bio_seq_record, quality_score_treshold,
@@ -129,6 +156,9 @@ def align_reads(r1, r2, mmmr_cutoff=0.85, ignore='N'):
         match / (match + miss) is above mmmr_cutoff. Ignored
         character does not count as a miss.
 
+        All offsets are evaluated at once: the reads are compared as uint8
+        arrays, one row per offset.
+
         Returns:
             best_alignment = (match, total, ratio, (a, b), (c, d))
 
@@ -136,6 +166,8 @@ def align_reads(r1, r2, mmmr_cutoff=0.85, ignore='N'):
             [c:d] - is the alignment range on the second sequence
     '''
 
+    import numpy
+
     l1 = len(r1)
     l2 = len(r2)
 
@@ -151,42 +183,60 @@ def align_reads(r1, r2, mmmr_cutoff=0.85, ignore='N'):
         l1 = l2
         l2 = tmp_int
 
-    # Slide the reads past each other and find the best alignment
-
     # Default setting
     best_alignment = (0, 0, 0, (None, None), (None, None))
 
-    for i in range(1, l1 + l2):
-
-        # print('i =', i)
-
-        b = min(l1, i)
-        c = max(0, l2 - i)
-        d = l2
-        if i > l1:
-            d = l2 + l1 - i
-        a = abs(d - b - c)
-
-        # print('r1[', a, ':', b, ']', r1[a:b], sep='')
-        # print('r2[', c, ':', d, ']', r2[c:d], sep='')
-
-        mask = compare_sequences(r1[a:b], r2[c:d], ignore=ignore)
-
-        match = mask.count(1)
-        miss = mask.count(0)
-        total = match + miss
-        ratio = 0
-
-        # Decide if this alignment is better than the current best alignment
-        if float(total) > 0:
-            ratio = float(match) / float(total)
-        # Consider the alignment to be acceptable only if match/(match+miss)
-        # meets given ratio
-        if ratio >= mmmr_cutoff:
-            # Furthermore, consider the alignment to be acceptable only if it
-            # contains more matches than the current best alignment
-            if match > best_alignment[0]:
-                best_alignment = (match, total, ratio, (a, b), (c, d))
+    if l1 == 0:
+        return(best_alignment)
+
+    # Slide the reads past each other, compared ranges for each offset i are
+    # r1[a:b] and r2[c:d]. When these differ in length only the first
+    # min(b - a, d - c) sites are compared.
+    i = numpy.arange(1, l1 + l2)
+    b = numpy.minimum(l1, i)
+    c = numpy.maximum(0, l2 - i)
+    d = numpy.where(i > l1, l2 + l1 - i, l2)
+    a = numpy.abs(d - b - c)
+    n = numpy.maximum(0, numpy.minimum(b - a, d - c))
+
+    s1 = numpy.frombuffer(r1, dtype=numpy.uint8)
+    s2 = numpy.frombuffer(r2, dtype=numpy.uint8)
+
+    # Row for offset i pairs site p of r1 with site p + c - a of r2
+    p = numpy.arange(l1)
+    q = p[numpy.newaxis, :] + (c - a)[:, numpy.newaxis]
+    valid = ((p >= a[:, numpy.newaxis]) &
+             (p < (a + n)[:, numpy.newaxis]))
+    q = numpy.clip(q, 0, l2 - 1)
+
+    x = s1[numpy.newaxis, :]
+    y = s2[q]
+
+    # Ignored character does not count as a match or a miss
+    if ignore and len(ignore) == 1:
+        valid = valid & (x != ord(ignore)) & (y != ord(ignore))
+
+    equal = x == y
+    match = (equal & valid).sum(axis=1)
+    total = valid.sum(axis=1)
+
+    ratio = numpy.zeros(len(i))
+    nonzero = total > 0
+    ratio[nonzero] = (match[nonzero].astype(float) /
+                      total[nonzero].astype(float))
+
+    # Consider the alignment to be acceptable only if match/(match+miss)
+    # meets given ratio. The first acceptable alignment with the most matches
+    # is the best alignment.
+    acceptable = (ratio >= mmmr_cutoff) & (match > 0)
+    if acceptable.any():
+        j = int(numpy.argmax(numpy.where(acceptable, match, -1)))
+        best_alignment = (
+            int(match[j]),
+            int(total[j]),
+            float(match[j]) / float(total[j]),
+            (int(a[j]), int(b[j])),
+            (int(c[j]), int(d[j])))
 
     # If the switch between r1 and r2 was made, we need to account for that
     # in our output
@@ -201,6 +251,104 @@ def align_reads(r1, r2, mmmr_cutoff=0.85, ignore='N'):
     return(best_alignment)
 
 
+def align_oligo_batch(oligo, reads, mmmr_cutoff=0.85, ignore='N',
+                      batch_size=256):
+
+    '''
+        Align a sequencing oligonucleotide to many reads. Returns a list with
+        the same alignments as align_reads(oligo, read, mmmr_cutoff, ignore)
+        for each read.
+
+        Reads of the same length are aligned together: the oligo is compared
+        to a padded array of batch_size reads at all offsets at once.
+    '''
+
+    import numpy
+
+    alignments = [None] * len(reads)
+
+    l1 = len(oligo)
+
+    if l1 == 0:
+        for j, read in enumerate(reads):
+            alignments[j] = align_reads(oligo, read, mmmr_cutoff=mmmr_cutoff,
+                                        ignore=ignore)
+        return(alignments)
+
+    s1 = numpy.frombuffer(oligo, dtype=numpy.uint8)
+    valid1 = numpy.ones(l1, dtype=bool)
+    if ignore and len(ignore) == 1:
+        valid1 = s1 != ord(ignore)
+
+    by_length = dict()
+    for j, read in enumerate(reads):
+        l2 = len(read)
+        # r1 is expected to be shorter than r2 in align_reads
+        if l2 < l1:
+            alignments[j] = align_reads(oligo, read, mmmr_cutoff=mmmr_cutoff,
+                                        ignore=ignore)
+            continue
+        if l2 not in by_length:
+            by_length[l2] = list()
+        by_length[l2].append(j)
+
+    for l2, indexes in by_length.items():
+
+        # At offset i, oligo[a:b] is compared to read[c:d]. Reads are padded
+        # with l1 zeros on both sides, site p of the oligo is compared to
+        # site p + l1 + l2 - i of a padded read. Zeros never match and are
+        # not counted.
+        i = numpy.arange(1, l1 + l2)
+        b = numpy.minimum(l1, i)
+        c = numpy.maximum(0, l2 - i)
+        d = numpy.where(i > l1, l2 + l1 - i, l2)
+        a = numpy.abs(d - b - c)
+
+        q = (numpy.arange(l1)[numpy.newaxis, :] +
+             (l1 + l2 - i)[:, numpy.newaxis])
+
+        for start in range(0, len(indexes), batch_size):
+            batch = indexes[start:start + batch_size]
+
+            s2 = numpy.zeros((len(batch), l2 + 2 * l1), dtype=numpy.uint8)
+            s2[:, l1:l1 + l2] = numpy.frombuffer(
+                b''.join([reads[j] for j in batch]),
+                dtype=numpy.uint8).reshape(len(batch), l2)
+
+            valid2 = s2 != 0
+            if ignore and len(ignore) == 1:
+                valid2 = valid2 & (s2 != ord(ignore))
+
+            y = s2[:, q]
+            valid = valid2[:, q] & valid1
+            match = ((y == s1) & valid).sum(axis=2)
+            total = valid.sum(axis=2)
+
+            ratio = numpy.zeros(match.shape)
+            nonzero = total > 0
+            ratio[nonzero] = (match[nonzero].astype(float) /
+                              total[nonzero].astype(float))
+
+            # The first acceptable alignment with the most matches is the
+            # best alignment
+            acceptable = (ratio >= mmmr_cutoff) & (match > 0)
+            best = numpy.argmax(numpy.where(acceptable, match, -1), axis=1)
+
+            for row, j in enumerate(batch):
+                o = best[row]
+                if not acceptable[row, o]:
+                    alignments[j] = (0, 0, 0, (None, None), (None, None))
+                    continue
+                alignments[j] = (
+                    int(match[row, o]),
+                    int(total[row, o]),
+                    float(match[row, o]) / float(total[row, o]),
+                    (int(a[o]), int(b[o])),
+                    (int(c[o]), int(d[o])))
+
+    return(alignments)
+
+
 def consensus_fr_read(r1, r2, min_overlap=5, mmmr_cutoff=0.85,
                       concatenate=False, ignore='N'):
 
@@ -274,7 +422,8 @@ def bin_reads(title, f_seq_str, r_seq_str=None,
               max_prop_low_quality_sites=0.10, min_overlap=5, mmmr_cutoff=0.85,
               concatenate=False,
               low_quality_residue='N', f_oligo=None, r_oligo=None,
-              min_read_length=10):
+              min_read_length=10, mmmr_cutoff_seq_oligo=0.8,
+              f_seq_oligo=None, r_seq_oligo=None):
 
     # from Bio import Seq
     # from Bio import SeqRecord
@@ -289,13 +438,16 @@ def bin_reads(title, f_seq_str, r_seq_str=None,
     #   [a:b] - is the alignment range on the first sequence
     #   [c:d] - is the alignment range on the second sequence
 
-    mmmr_cutoff_seq_oligo = 0.8  # ##
+    # f_seq_oligo and r_seq_oligo are the alignments of r_oligo to the
+    # forward read and of f_oligo to the reverse read, if these were already
+    # computed with align_oligo_batch
 
     # Forward
     if r_oligo and f_seq_str:
-        f_seq_oligo = align_reads(
-            r_oligo, f_seq_str, mmmr_cutoff=mmmr_cutoff_seq_oligo,
-            ignore=low_quality_residue)
+        if f_seq_oligo is None:
+            f_seq_oligo = align_reads(
+                r_oligo, f_seq_str, mmmr_cutoff=mmmr_cutoff_seq_oligo,
+                ignore=low_quality_residue)
 
         if ((f_seq_oligo[1] >= 10) or
            (f_seq_oligo[4][1] == len(f_seq_str)) and f_seq_oligo[1] >= 1):
@@ -312,9 +464,10 @@ def bin_reads(title, f_seq_str, r_seq_str=None,
 
     # Reverse
     if f_oligo and r_seq_str:
-        r_seq_oligo = align_reads(
-            f_oligo, r_seq_str, mmmr_cutoff=mmmr_cutoff_seq_oligo,
-            ignore=low_quality_residue)
+        if r_seq_oligo is None:
+            r_seq_oligo = align_reads(
+                f_oligo, r_seq_str, mmmr_cutoff=mmmr_cutoff_seq_oligo,
+                ignore=low_quality_residue)
 
         if ((r_seq_oligo[1] >= 10) or
            (r_seq_oligo[4][0] == 0) and r_seq_oligo[1] >= 1):
@@ -387,6 +540,245 @@ def bin_reads(title, f_seq_str, r_seq_str=None,
     return(ret_value)
 
 
+def bin_reads_batch(chunk, f_oligo=None, r_oligo=None,
+                    max_prop_low_quality_sites=0.10, min_overlap=5,
+                    mmmr_cutoff=0.85, concatenate=False,
+                    low_quality_residue='N', min_read_length=10,
+                    mmmr_cutoff_seq_oligo=0.8):
+
+    '''
+        Run bin_reads on a chunk of masked reads. chunk is a list of
+        (f_title, f_seq, f_qual, r_title, r_seq, r_qual) tuples, reverse
+        values are None for single end data. Quality strings are not used.
+        Sequencing oligonucleotides are aligned to all reads of the chunk at
+        once with align_oligo_batch.
+
+        Returns:
+            A dictionary {kind: text}, in the same order as chunk.
+
+            Kinds:
+                f_hq, f_lq, r_hq, r_lq, all_hq - binned reads, FASTA
+                binned - bin_reads statistics, one line per read pair
+    '''
+
+    results = dict()
+    for kind in ['f_hq', 'f_lq', 'r_hq', 'r_lq', 'all_hq', 'binned']:
+        results[kind] = list()
+
+    f_seq_oligos = [None] * len(chunk)
+    if r_oligo:
+        f_seq_oligos = align_oligo_batch(
+            oligo=r_oligo,
+            reads=[x[1] for x in chunk],
+            mmmr_cutoff=mmmr_cutoff_seq_oligo,
+            ignore=low_quality_residue)
+
+    r_seq_oligos = [None] * len(chunk)
+    paired = [j for j, x in enumerate(chunk) if x[4]]
+    if f_oligo and paired:
+        alignments = align_oligo_batch(
+            oligo=f_oligo,
+            reads=[chunk[j][4] for j in paired],
+            mmmr_cutoff=mmmr_cutoff_seq_oligo,
+            ignore=low_quality_residue)
+        for j, alignment in zip(paired, alignments):
+            r_seq_oligos[j] = alignment
+
+    for j, (f_title, f_seq, f_qual, r_title, r_seq, r_qual) in enumerate(
+            chunk):
+
+        binned = bin_reads(
+            title=f_title,
+            f_seq_str=f_seq,
+            r_seq_str=r_seq,
+            max_prop_low_quality_sites=max_prop_low_quality_sites,
+            min_overlap=min_overlap,
+            mmmr_cutoff=mmmr_cutoff,
+            concatenate=concatenate,
+            low_quality_residue=low_quality_residue,
+            f_oligo=f_oligo,
+            r_oligo=r_oligo,
+            min_read_length=min_read_length,
+            mmmr_cutoff_seq_oligo=mmmr_cutoff_seq_oligo,
+            f_seq_oligo=f_seq_oligos[j],
+            r_seq_oligo=r_seq_oligos[j])
+
+        f_hq = binned[0]
+        r_hq = binned[1]
+        f_seq = binned[2]
+        r_seq = binned[3]
+        consensus = binned[4]
+        consensus_title = binned[5]
+        consensus_message = binned[6]
+
+        str_fhq = ''
+        str_rhq = ''
+        str_cons = ''
+        str_msg = str(consensus_message)
+        str_flq = ''
+        str_rlq = ''
+
+        if f_hq:
+            results['f_hq'].append('>' + f_title + '\n' + f_seq + '\n')
+            str_fhq = str(len(f_seq))
+        else:
+            results['f_lq'].append('>' + f_title + '\n' + f_seq + '\n')
+            str_flq = str(len(f_seq))
+
+        if r_hq:
+            results['r_hq'].append('>' + r_title + '\n' + r_seq + '\n')
+            str_rhq = str(len(r_seq))
+        elif r_title is not None:
+            results['r_lq'].append('>' + r_title + '\n' + r_seq + '\n')
+            str_rlq = str(len(r_seq))
+
+        if f_hq and r_hq and consensus:
+            results['all_hq'].append(
+                '>' + consensus_title + '\n' + consensus + '\n')
+            str_cons = str(len(consensus))
+
+        if f_hq and not consensus:
+            results['all_hq'].append('>' + f_title + '\n' + f_seq + '\n')
+
+        if r_hq and not consensus:
+            results['all_hq'].append('>' + r_title + '\n' + r_seq + '\n')
+
+        results['binned'].append(
+            str_fhq + '\t' + str_rhq + '\t' + str_cons + '\t' + str_msg +
+            '\t' + str_flq + '\t' + str_rlq + '\n')
+
+    for kind in results.keys():
+        results[kind] = ''.join(results[kind])
+
+    return(results)
+
+
+def barcode_neighborhood(barcode, max_edits, alphabet='acgtn'):
+
+    '''
+        Enumerate every sequence that is within max_edits (Levenshtein
+        distance) of a barcode and is not longer than the barcode. Sequences
+        shorter than the barcode are kept so that reads shorter than the
+        barcode are resolved the same way Levenshtein.distance would resolve
+        them.
+
+        Returns:
+            dict {sequence: edit distance}
+    '''
+
+    l = len(barcode)
+    neighborhood = {barcode: 0}
+    current = set([barcode])
+
+    for d in range(1, max_edits + 1):
+        remaining = max_edits - d
+        found = set()
+        for s in current:
+            for i in range(0, len(s) + 1):
+                for c in alphabet:
+                    found.add(s[:i] + c + s[i:])
+                if i < len(s):
+                    found.add(s[:i] + s[i + 1:])
+                    for c in alphabet:
+                        found.add(s[:i] + c + s[i + 1:])
+        current = set()
+        for s in found:
+            # Strings that are too long to come back to the barcode length
+            # within the remaining edits are dropped early.
+            if s in neighborhood or len(s) - l > remaining:
+                continue
+            neighborhood[s] = d
+            current.add(s)
+
+    for s in list(neighborhood.keys()):
+        if len(s) > l:
+            del neighborhood[s]
+
+    return(neighborhood)
+
+
+def index_barcodes(barcodes, max_barcode_mismatch_count=1, alphabet='acgtn'):
+
+    '''
+        Precompute a lookup table that resolves a read to a barcode with one
+        dictionary lookup per distinct barcode length.
+
+        When a sequence is within max_barcode_mismatch_count of more than one
+        barcode, the barcode that comes first in the barcodes list wins, the
+        same as the original sequential scan. Such collisions are reported.
+
+        Returns:
+            (lookup, collisions)
+
+            lookup - a list of (barcode length, {sequence: barcode index})
+                tuples.
+            collisions - a list of (sequence, barcode id, barcode id) tuples.
+    '''
+
+    lookup_dict = dict()
+    collisions = list()
+
+    for i, barcode in enumerate(barcodes):
+        b = barcode['barcode'].lower()
+        l = len(b)
+        if l not in lookup_dict:
+            lookup_dict[l] = dict()
+        lookup = lookup_dict[l]
+        neighborhood = barcode_neighborhood(
+            b, max_barcode_mismatch_count, alphabet=alphabet)
+        for s in neighborhood:
+            if s in lookup:
+                collisions.append(
+                    (s, barcodes[lookup[s]]['id'], barcode['id']))
+                continue
+            lookup[s] = i
+
+    lookup = sorted(lookup_dict.items(), key=lambda x: x[0])
+
+    return((lookup, collisions))
+
+
+def match_barcode(seq, lookup):
+
+    '''
+        Return the index of the barcode (in the list given to index_barcodes)
+        that matches the beginning of seq or None if there is no match.
+    '''
+
+    match = None
+    for l, l_lookup in lookup:
+        i = l_lookup.get(seq[0:l].lower())
+        if i is not None and (match is None or i < match):
+            match = i
+    return(match)
+
+
+def print_barcode_collisions(barcodes, max_barcode_mismatch_count=1):
+
+    '''
+    Print a warning for every pair of barcodes that share sequences within
+    max_barcode_mismatch_count mismatches. For callers that demultiplex many
+    pieces of a run and want the warning once.
+    '''
+
+    barcodes = [{'id': x['id'], 'barcode': x['barcode']} for x in barcodes]
+    lookup, collisions = index_barcodes(
+        barcodes=barcodes,
+        max_barcode_mismatch_count=max_barcode_mismatch_count)
+    _print_barcode_collisions_(collisions, max_barcode_mismatch_count)
+
+
+def _print_barcode_collisions_(collisions, max_barcode_mismatch_count):
+    collision_counts = dict()
+    for c in collisions:
+        collision_counts[c[1:]] = collision_counts.get(c[1:], 0) + 1
+    for c in sorted(collision_counts.keys()):
+        print('Warning: barcodes ' + c[0] + ' and ' + c[1] + ' share ' +
+              str(collision_counts[c]) + ' sequences within ' +
+              str(max_barcode_mismatch_count) + ' mismatches, these reads ' +
+              'will be assigned to ' + c[0] + '.')
+
+
 def _write_demultiplex_results_(barcodes,
                                 reverse_reads_file_path,
                                 result_batch_forward_other,
@@ -443,11 +835,16 @@ def demultiplex(barcodes,
                 output_dir='.',
                 trim_barcode=True,
                 trim_extra=0,
-                write_every=1000
+                write_every=1000,
+                print_collisions=True
                 ):
 
+    '''
+    print_collisions - print barcode collision warnings, see
+        print_barcode_collisions.
+    '''
+
     import os
-    import Levenshtein
     # from Bio import SeqIO
     from Bio.SeqIO.QualityIO import FastqGeneralIterator
     from Bio.Seq import Seq
@@ -465,12 +862,12 @@ def demultiplex(barcodes,
 # ...     print sequence, quality
 
     # forward_reads = SeqIO.parse(forward_reads_file_path, input_file_format)
-    forward_reads_handle = open(forward_reads_file_path, "rU")
+    forward_reads_handle = krio.open_file(forward_reads_file_path, "rU")
     forward_reads = FastqGeneralIterator(forward_reads_handle)
     reverse_reads = None
     if reverse_reads_file_path is not None:
         # reverse_reads = SeqIO.parse(reverse_reads_file_path, input_file_format)
-        reverse_reads_handle = open(reverse_reads_file_path, "rU")
+        reverse_reads_handle = krio.open_file(reverse_reads_file_path, "rU")
         reverse_reads = FastqGeneralIterator(reverse_reads_handle)
 
     for barcode in barcodes:
@@ -489,6 +886,13 @@ def demultiplex(barcodes,
             barcode['write_handle_reverse'] = open(
                 barcode['file_path_reverse'], 'wa')
 
+    lookup, collisions = index_barcodes(
+        barcodes=barcodes,
+        max_barcode_mismatch_count=max_barcode_mismatch_count)
+
+    if print_collisions:
+        _print_barcode_collisions_(collisions, max_barcode_mismatch_count)
+
     write_handle_forward_other = open(output_dir + 'Mismatch_f.' + 'fastq',
                                       'wa')
     result_batch_forward_other = list()
@@ -512,70 +916,65 @@ def demultiplex(barcodes,
         #     f_record.annotations,
         #     f_record.letter_annotations)
 
-        # Try all barcodes
+        # Look up the barcode
         barcode_match_found = False
-        for barcode in barcodes:
+        barcode_match = match_barcode(f_seq, lookup)
+        if barcode_match is not None:
+            barcode = barcodes[barcode_match]
 
             l = barcode['length']
-            b = barcode['barcode'].lower()
-            r = str(f_seq[0:l]).lower()
-            ld = Levenshtein.distance(b, r)
 
             # Barcode match found
-            if ld <= max_barcode_mismatch_count:
-                barcode_match_found = True
-                f_title = f_title.replace(' ', '|')
-                f_title = f_title.replace('=', '_')
-                f_title = '@' + f_title
-                if trim_barcode:
-                    # f_record = krseq.trim_residues(f_record, l, False)
-                    f_seq = f_seq[l:]
-                    f_qual = f_qual[l:]
-                    if trim_extra > 0:
-                        # f_record = krseq.trim_residues(f_record, trim_extra,
-                        #                                False)
-                        f_seq = f_seq[trim_extra:]
-                        f_qual = f_qual[trim_extra:]
-                # barcode['result_batch_forward'].append(f_record)
-                f_read = (f_title, f_seq, f_qual)
-                barcode['result_batch_forward'].append(f_read)
-
-                # If there are reverse reads to consider
-                if reverse_reads_file_path is not None:
-                    r_title, r_seq, r_qual = reverse_reads.next()
-                    # r_record = reverse_reads.next()
-                    # r_record = krseq.reverse_complement(r_record)
-                    # r_record = SeqRecord.SeqRecord(
-                    #     r_record.seq,
-                    #     r_record.description.replace(' ', '|'),
-                    #     '',
-                    #     '',
-                    #     r_record.dbxrefs,
-                    #     r_record.features,
-                    #     r_record.annotations,
-                    #     r_record.letter_annotations)
-
-                    r_seq = Seq(r_seq)
-                    r_seq = str(r_seq.reverse_complement())
-                    r_qual = r_qual[::-1]
-
-                    r_title = r_title.replace(' ', '|')
-                    r_title = r_title.replace('=', '_')
-                    r_title = '@' + r_title
-
-                    if trim_barcode and trim_extra > 0:
-                        # r_record = krseq.trim_residues(r_record, trim_extra,
-                        #                                True)
-
-                        r_seq = r_seq[:-trim_extra]
-                        r_qual = r_qual[:-trim_extra]
-
-                    # barcode['result_batch_reverse'].append(r_record)
-                    r_read = (r_title, r_seq, r_qual)
-                    barcode['result_batch_reverse'].append(r_read)
-
-                # Barcode match found, breakout of the loop
-                break
+            barcode_match_found = True
+            f_title = f_title.replace(' ', '|')
+            f_title = f_title.replace('=', '_')
+            f_title = '@' + f_title
+            if trim_barcode:
+                # f_record = krseq.trim_residues(f_record, l, False)
+                f_seq = f_seq[l:]
+                f_qual = f_qual[l:]
+                if trim_extra > 0:
+                    # f_record = krseq.trim_residues(f_record, trim_extra,
+                    #                                False)
+                    f_seq = f_seq[trim_extra:]
+                    f_qual = f_qual[trim_extra:]
+            # barcode['result_batch_forward'].append(f_record)
+            f_read = (f_title, f_seq, f_qual)
+            barcode['result_batch_forward'].append(f_read)
+
+            # If there are reverse reads to consider
+            if reverse_reads_file_path is not None:
+                r_title, r_seq, r_qual = reverse_reads.next()
+                # r_record = reverse_reads.next()
+                # r_record = krseq.reverse_complement(r_record)
+                # r_record = SeqRecord.SeqRecord(
+                #     r_record.seq,
+                #     r_record.description.replace(' ', '|'),
+                #     '',
+                #     '',
+                #     r_record.dbxrefs,
+                #     r_record.features,
+                #     r_record.annotations,
+                #     r_record.letter_annotations)
+
+                r_seq = Seq(r_seq)
+                r_seq = str(r_seq.reverse_complement())
+                r_qual = r_qual[::-1]
+
+                r_title = r_title.replace(' ', '|')
+                r_title = r_title.replace('=', '_')
+                r_title = '@' + r_title
+
+                if trim_barcode and trim_extra > 0:
+                    # r_record = krseq.trim_residues(r_record, trim_extra,
+                    #                                True)
+
+                    r_seq = r_seq[:-trim_extra]
+                    r_qual = r_qual[:-trim_extra]
+
+                # barcode['result_batch_reverse'].append(r_record)
+                r_read = (r_title, r_seq, r_qual)
+                barcode['result_batch_reverse'].append(r_read)
 
         if not barcode_match_found:
             f_title = f_title.replace(' ', '|')
@@ -617,457 +1016,1337 @@ def demultiplex(barcodes,
     return()
 
 
-def combine_demultiplexed_results(input_dir, output_dir):
+def demultiplex_chunk(chunk, barcodes, lookup, trim_barcode=True,
+                      trim_extra=0, file_format='fastq'):
 
-    import os
-    import shutil
-    import krio
+    '''
+        Demultiplex a chunk of reads the same way demultiplex does.
 
-    ps = os.path.sep
-    input_dir = input_dir.rstrip(ps) + ps
-    output_dir = output_dir.rstrip(ps) + ps
-    krio.prepare_directory(output_dir)
-    directory_list = krio.parse_directory(
-        path=input_dir,
-        file_name_sep=' ',
-        sort='forward'
-    )
+        chunk is a list of (f_title, f_seq, f_qual, r_title, r_seq, r_qual)
+        tuples, reverse values are None for single end data. lookup is
+        produced by index_barcodes.
 
-    file_dir_path = directory_list[0]['path'].rstrip(ps) + ps
-    file_list = krio.parse_directory(
-        path=file_dir_path,
-        file_name_sep='_',
-        sort='forward'
-    )
+        Returns:
+            (forward, reverse)
 
-    for f in file_list:
-        output_file_path = output_dir + f['full']
-        output_file_handle = open(output_file_path, 'wa')
-#         for part in range(1, len(directory_list) + 1):
-        for part_dir in directory_list:
-            part_directory_path = input_dir + part_dir['name'] + ps
-            part_file_path = part_directory_path + f['full']
-            shutil.copyfileobj(open(part_file_path, 'rb'),
-                               output_file_handle)
-        output_file_handle.close()
+            Lists of FASTQ formatted strings, one per barcode, followed by
+            one for reads that did not match any barcode. If file_format is
+            'binary', binary reads file blocks (see krbioio) instead, an
+            empty string if there are no reads.
+    '''
 
+    from Bio.Seq import Seq
+    import krbioio
+
+    n = len(barcodes)
+    forward = [list() for x in range(0, n + 1)]
+    reverse = [list() for x in range(0, n + 1)]
+
+    for f_title, f_seq, f_qual, r_title, r_seq, r_qual in chunk:
+
+        i = match_barcode(f_seq, lookup)
+
+        if i is not None:
+            f_title = f_title.replace(' ', '|').replace('=', '_')
+            if trim_barcode:
+                l = len(barcodes[i]['barcode']) + trim_extra
+                f_seq = f_seq[l:]
+                f_qual = f_qual[l:]
+            if r_title is not None:
+                r_seq = str(Seq(r_seq).reverse_complement())
+                r_qual = r_qual[::-1]
+                r_title = r_title.replace(' ', '|').replace('=', '_')
+                if trim_barcode and trim_extra > 0:
+                    r_seq = r_seq[:-trim_extra]
+                    r_qual = r_qual[:-trim_extra]
+        else:
+            i = n
+            f_title = f_title.replace(' ', '|')
+            if r_title is not None:
+                r_title = r_title.replace(' ', '|')
 
-def nucleotides_at_site(site):
-    c_a = site.count('A')
-    c_c = site.count('C')
-    c_g = site.count('G')
-    c_t = site.count('T')
-    return([c_a, c_c, c_g, c_t])
+        if file_format == 'binary':
+            forward[i].append((f_title, f_seq, f_qual))
+            if r_title is not None:
+                reverse[i].append((r_title, r_seq, r_qual))
+            continue
 
+        forward[i].append(
+            '@' + f_title + '\n' + f_seq + '\n+\n' + f_qual + '\n')
+        if r_title is not None:
+            reverse[i].append(
+                '@' + r_title + '\n' + r_seq + '\n+\n' + r_qual + '\n')
+
+    if file_format == 'binary':
+        forward = [krbioio.encode_reads_block(x) if x else ''
+                   for x in forward]
+        reverse = [krbioio.encode_reads_block(x) if x else ''
+                   for x in reverse]
+    else:
+        forward = [''.join(x) for x in forward]
+        reverse = [''.join(x) for x in reverse]
 
-def decode_CIGAR(cigar):
+    return((forward, reverse))
 
-    import re
 
-    cigar_regex = re.compile("([0-9]*)([A-Za-z])")
-    cigar_decoded = cigar_regex.findall(cigar)
+# Worker processes of _stream_read_pairs_ keep the chunk function and its
+# arguments here, so these are sent to each worker once instead of with every
+# chunk.
+_stream_worker_state_ = dict()
 
-    cigar_decoded_list = list()
 
-    for d in cigar_decoded:
-        count = d[0]
-        if count == '':
-            count = 1
-        else:
-            count = int(count)
-        letter = d[1].upper()
+def _stream_worker_init_(function, kwargs):
+    _stream_worker_state_['function'] = function
+    _stream_worker_state_['kwargs'] = kwargs
 
-        cigar_decoded_list.append([count, letter])
 
-    return(cigar_decoded_list)
+def _stream_worker_(chunk, extra_kwargs=None):
+    function = _stream_worker_state_['function']
+    kwargs = _stream_worker_state_['kwargs']
+    if extra_kwargs:
+        kwargs = dict(kwargs)
+        kwargs.update(extra_kwargs)
+    return(function(chunk, **kwargs))
 
-'''
-def encode_CIGAR(cigar):
 
-    encoded = ''
+def _read_pair_chunks_(forward_reads, reverse_reads, chunk_size):
+    chunk = list()
+    for f_read in forward_reads:
+        r_read = (None, None, None)
+        if reverse_reads is not None:
+            r_read = reverse_reads.next()
+        chunk.append(f_read + r_read)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
 
-    for c in cigar:
-        encoded = encoded + str(c[0]) + c[1]
 
-    return(encoded)
+def _stream_read_pair_files_(inputs, function, kwargs, processes=1,
+                             chunk_size=10000):
 
+    '''
+        Read chunks of paired forward/reverse records in this process and
+        hand them to a pool of worker processes that call
+        function(chunk, **kwargs). At most 2 * processes chunks are held in
+        memory at a time.
+
+        inputs is a list of dictionaries, one per pair of files, with keys:
+            forward_reads_file_path
+            reverse_reads_file_path - None for single end data
+            kwargs - additional arguments to function for this input
+            write_results - called in this process with every result of
+                this input, in input order
+            start, finish - called with no arguments before the first chunk
+                of this input is read and after its last result is written
+
+        Only write_results and forward_reads_file_path are required. Read
+        files can be FASTQ (also gzip or BGZF compressed) or binary reads
+        files (see krbioio). Inputs
+        are read one after another, but chunks of consecutive inputs are
+        processed at the same time, so one large input is spread over all
+        worker processes and no worker waits for the end of an input.
+    '''
 
-def expand_CIGAR(cigar):
+    from collections import deque
+    from multiprocessing import Pool
+    import krbioio
 
-    decoded = decode_CIGAR(cigar)
+    pool = Pool(
+        processes=processes,
+        initializer=_stream_worker_init_,
+        initargs=(function, kwargs))
 
-    expanded = ''
+    # Items are (input, result), result is None after the last chunk of an
+    # input
+    pending = deque()
 
-    for d in decoded:
-        expanded = expanded + d[1] * d[0]
+    def write_next():
+        inp, result = pending.popleft()
+        if result is None:
+            if inp.get('finish', None):
+                inp['finish']()
+        else:
+            inp['write_results'](result.get())
+
+    try:
+        for inp in inputs:
+            if inp.get('start', None):
+                inp['start']()
+
+            # Decompressed in this process: the pool above already uses all
+            # processes, separate BGZF decompression pools per file would
+            # run up to three times as many workers.
+            forward_reads = krbioio.read_reads_file(
+                inp['forward_reads_file_path'], processes=1)
+            reverse_reads = None
+            if inp.get('reverse_reads_file_path', None) is not None:
+                reverse_reads = krbioio.read_reads_file(
+                    inp['reverse_reads_file_path'], processes=1)
+
+            for chunk in _read_pair_chunks_(forward_reads, reverse_reads,
+                                            chunk_size):
+                pending.append((inp, pool.apply_async(
+                    _stream_worker_, (chunk, inp.get('kwargs', None)))))
+                while len(pending) >= 2 * processes:
+                    write_next()
+
+            pending.append((inp, None))
+
+        while pending:
+            write_next()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _stream_read_pairs_(forward_reads_file_path, reverse_reads_file_path,
+                        function, kwargs, write_results, processes=1,
+                        chunk_size=10000):
 
-    return(expanded)
-'''
+    '''
+        _stream_read_pair_files_ for a single pair of files.
+    '''
 
-def length_of_CIGAR(cigar):
+    _stream_read_pair_files_(
+        inputs=[{'forward_reads_file_path': forward_reads_file_path,
+                 'reverse_reads_file_path': reverse_reads_file_path,
+                 'write_results': write_results}],
+        function=function,
+        kwargs=kwargs,
+        processes=processes,
+        chunk_size=chunk_size)
+
+
+def demultiplex_stream(barcodes,
+                       forward_reads_file_path,
+                       reverse_reads_file_path=None,
+                       max_barcode_mismatch_count=1,
+                       output_dir='.',
+                       trim_barcode=True,
+                       trim_extra=0,
+                       processes=1,
+                       chunk_size=10000,
+                       file_format='fastq'
+                       ):
 
-    decoded = decode_CIGAR(cigar)
+    '''
+        Demultiplex raw FASTQ files without splitting them first. This process
+        reads chunks of paired forward/reverse records and hands them to a
+        pool of worker processes, results are appended to the per-barcode
+        files in input order. Output files are the same as the combined
+        output of demultiplex.
+
+        If file_format is 'binary', binary reads files (see krbioio) with
+        extension krr are written instead of FASTQ files. Blocks are encoded
+        by the worker processes.
+    '''
 
-    length = 0
+    import os
+    import krio
+    import krbioio
 
-    for d in decoded:
-        count = d[0]
-        letter = d[1]
+    ps = os.path.sep
+    output_dir = output_dir.rstrip(ps) + ps
+    krio.prepare_directory(output_dir)
 
-        if letter == 'M' or letter == 'D':
-            length = length + count
+    barcodes = [{'id': x['id'], 'barcode': x['barcode']} for x in barcodes]
 
-    return(length)
+    lookup, collisions = index_barcodes(
+        barcodes=barcodes,
+        max_barcode_mismatch_count=max_barcode_mismatch_count)
 
-'''
-# rich_cigar, list of sequences should be sorted by their position.
-# will return a list of sequences in the same order with gaps included.
-# (pos, CIGAR, sequence)
-def alignment_from_CIGAR(rich_cigar_list):
+    _print_barcode_collisions_(collisions, max_barcode_mismatch_count)
 
-    # rich_cigar_list = sorted(rich_cigar_list, key=lambda x: (x[0]), reverse=False)
+    ext = 'fastq'
+    if file_format == 'binary':
+        ext = 'krr'
 
-    aln = list()
-    min_pos = rich_cigar_list[0][0]
-    max_pos = rich_cigar_list[0][0]
+    def open_output(file_path):
+        if file_format == 'binary':
+            return(krbioio.BinaryReadsWriter(file_path))
+        return(open(file_path, 'w'))
 
-    for rcl in rich_cigar_list:
-        min_pos = min(min_pos, rcl[0])
-        max_pos = max(max_pos, rcl[4])
+    forward_handles = list()
+    reverse_handles = list()
 
-    cigar_list = list()
-    read_list = list()
+    for barcode in barcodes:
+        base_file_name = output_dir + barcode['id'] + '_' + barcode['barcode']
+        forward_handles.append(open_output(base_file_name + '_f.' + ext))
+        if reverse_reads_file_path is not None:
+            reverse_handles.append(open_output(base_file_name + '_r.' + ext))
 
-    for rcl in rich_cigar_list:
-        cigar_length = length_of_CIGAR(rcl[1])
+    forward_handles.append(open_output(output_dir + 'Mismatch_f.' + ext))
+    if reverse_reads_file_path is not None:
+        reverse_handles.append(open_output(output_dir + 'Mismatch_r.' + ext))
 
-        offset = rcl[0] - min_pos
-        padding = max_pos - rcl[4]
-        rcl[2] = offset * '-' + rcl[2]
-        rcl[2] = rcl[2] + '-' * padding
+    def write_results(results):
+        forward, reverse = results
+        for i, handle in enumerate(forward_handles):
+            if not forward[i]:
+                continue
+            if file_format == 'binary':
+                handle.write_block(forward[i])
+            else:
+                handle.write(forward[i])
+        for i, handle in enumerate(reverse_handles):
+            if not reverse[i]:
+                continue
+            if file_format == 'binary':
+                handle.write_block(reverse[i])
+            else:
+                handle.write(reverse[i])
+
+    _stream_read_pairs_(
+        forward_reads_file_path=forward_reads_file_path,
+        reverse_reads_file_path=reverse_reads_file_path,
+        function=demultiplex_chunk,
+        kwargs={'barcodes': barcodes,
+                'lookup': lookup,
+                'trim_barcode': trim_barcode,
+                'trim_extra': trim_extra,
+                'file_format': file_format},
+        write_results=write_results,
+        processes=processes,
+        chunk_size=chunk_size)
+
+    for handle in forward_handles + reverse_handles:
+        handle.close()
 
-        decoded = decode_CIGAR(rcl[1])
+    return()
 
-        if decoded[0][1] == 'M':
-            decoded[0][0] = decoded[0][0] + offset
-        else:
-            decoded.insert(0, [offset, 'M'])
 
-        if decoded[-1][1] == 'M':
-            decoded[-1][0] = decoded[-1][0] + padding
-        else:
-            decoded.append([padding, 'M'])
+def process_reads_chunk(chunk, barcodes, lookup, trim_extra,
+                        quality_score_treshold, low_quality_residue,
+                        f_oligos, r_oligo, max_prop_low_quality_sites,
+                        min_overlap, mmmr_cutoff, concatenate,
+                        min_read_length, debug=False):
 
-        encoded = encode_CIGAR(decoded)
-        expanded = expand_CIGAR(encoded)
+    '''
+        Demultiplex, mask and bin a chunk of raw reads in one pass. Each step
+        is done the same way as by demultiplex (barcodes are always trimmed),
+        mask_low_quality_sites and bin_reads.
 
-        rcl[1] = expanded
-        cigar_length = length_of_CIGAR(rcl[1])
+        chunk is a list of (f_title, f_seq, f_qual, r_title, r_seq, r_qual)
+        tuples, reverse values are None for single end data. f_oligos is a
+        list with the forward read oligo for every barcode.
 
-        cigar_list.append(list(rcl[1]))
-        read_list.append(list(rcl[2]))
+        Returns:
+            A dictionary {(barcode index, kind): text}. Barcode index is
+            len(barcodes) for reads that did not match any barcode.
+
+            Kinds:
+                f_lengths, r_lengths - demultiplexed read lengths
+                f_hq, f_lq, r_hq, r_lq, all_hq - binned reads, FASTA
+                binned - bin_reads statistics, one line per read pair
+                f_fastq, r_fastq - demultiplexed reads, only if debug
+                f_masked, r_masked - masked reads, only if debug
+    '''
 
-    cigar_list_zipped = zip(*cigar_list)
+    from Bio.Seq import Seq
 
-    for i, c in enumerate(cigar_list_zipped):
-        if 'I' in c:
-            for l, letter in enumerate(c):
-                if letter == 'M':
-                    cigar_list[l].insert(i, 'M')
+    n = len(barcodes)
+    results = dict()
 
-    cigar_list_zipped = zip(*cigar_list)
-    for i, c in enumerate(cigar_list_zipped):
-        if 'I' in c:
-            for l, letter in enumerate(c):
-                if letter == 'M':
-                    read_list[l].insert(i, '-')
-        if 'D' in c:
-            for l, letter in enumerate(c):
-                if letter == 'D':
-                    read_list[l].insert(i, '-')
+    def add(i, kind, text):
+        key = (i, kind)
+        if key not in results:
+            results[key] = list()
+        results[key].append(text)
 
-    read_list_zipped = zip(*read_list)
-    columns_to_remove = list()
-    for r in read_list_zipped:
-        if set(r) == set('-'):
-            columns_to_remove.append(r)
+    def fastq(title, seq, qual):
+        return('@' + title + '\n' + seq + '\n+\n' + qual + '\n')
 
-    for r in columns_to_remove:
-        read_list_zipped.remove(r)
+    # Demultiplex
+    matched = list()
+    for f_title, f_seq, f_qual, r_title, r_seq, r_qual in chunk:
 
-    read_list = [list(x) for x in zip(*read_list_zipped)]
+        i = match_barcode(f_seq, lookup)
 
-    for r in read_list:
-        aln.append(''.join(r))
+        if i is None:
+            f_title = f_title.replace(' ', '|')
+            add(n, 'f_lengths', str(len(f_seq)) + '\n')
+            if debug:
+                add(n, 'f_fastq', fastq(f_title, f_seq, f_qual))
+            if r_title is not None:
+                r_title = r_title.replace(' ', '|')
+                add(n, 'r_lengths', str(len(r_seq)) + '\n')
+                if debug:
+                    add(n, 'r_fastq', fastq(r_title, r_seq, r_qual))
+            continue
 
-    return(aln)
-'''
+        l = len(barcodes[i]['barcode']) + trim_extra
+        f_title = f_title.replace(' ', '|').replace('=', '_')
+        f_seq = f_seq[l:]
+        f_qual = f_qual[l:]
+        add(i, 'f_lengths', str(len(f_seq)) + '\n')
+        if debug:
+            add(i, 'f_fastq', fastq(f_title, f_seq, f_qual))
+
+        if r_title is not None:
+            r_seq = str(Seq(r_seq).reverse_complement())
+            r_qual = r_qual[::-1]
+            r_title = r_title.replace(' ', '|').replace('=', '_')
+            if trim_extra > 0:
+                r_seq = r_seq[:-trim_extra]
+                r_qual = r_qual[:-trim_extra]
+            add(i, 'r_lengths', str(len(r_seq)) + '\n')
+            if debug:
+                add(i, 'r_fastq', fastq(r_title, r_seq, r_qual))
+
+        matched.append((i, f_title, f_seq, f_qual, r_title, r_seq, r_qual))
+
+    # Mask
+    f_masked = mask_low_quality_sites_batch(
+        seq_strs=[x[2] for x in matched],
+        qual_strs=[x[3] for x in matched],
+        quality_score_treshold=quality_score_treshold,
+        low_quality_residue=low_quality_residue)
+
+    paired = [x for x in matched if x[4] is not None]
+    r_masked = mask_low_quality_sites_batch(
+        seq_strs=[x[5] for x in paired],
+        qual_strs=[x[6] for x in paired],
+        quality_score_treshold=quality_score_treshold,
+        low_quality_residue=low_quality_residue)
+    r_masked.reverse()
+
+    # Bin, reads of each barcode separately as the forward oligo differs
+    to_bin = dict()
+    for j, (i, f_title, f_seq, f_qual, r_title, r_seq, r_qual) in enumerate(
+            matched):
+
+        f_seq = f_masked[j]
+        if debug:
+            add(i, 'f_masked', fastq(f_title, f_seq, f_qual))
+
+        if r_title is not None:
+            r_seq = r_masked.pop()
+            if debug:
+                add(i, 'r_masked', fastq(r_title, r_seq, r_qual))
+
+        if i not in to_bin:
+            to_bin[i] = list()
+        to_bin[i].append((f_title, f_seq, f_qual, r_title, r_seq, r_qual))
+
+    for i in to_bin.keys():
+        binned = bin_reads_batch(
+            chunk=to_bin[i],
+            f_oligo=f_oligos[i],
+            r_oligo=r_oligo,
+            max_prop_low_quality_sites=max_prop_low_quality_sites,
+            min_overlap=min_overlap,
+            mmmr_cutoff=mmmr_cutoff,
+            concatenate=concatenate,
+            low_quality_residue=low_quality_residue,
+            min_read_length=min_read_length)
+        for kind in binned.keys():
+            if binned[kind]:
+                add(i, kind, binned[kind])
+
+    for key in results.keys():
+        results[key] = ''.join(results[key])
+
+    return(results)
+
+
+def process_reads_stream(barcodes,
+                         forward_reads_file_path,
+                         output_file_path,
+                         reverse_reads_file_path=None,
+                         max_barcode_mismatch_count=1,
+                         trim_extra=0,
+                         quality_score_treshold=20,
+                         low_quality_residue='N',
+                         barcode_adapter='',
+                         f_sticky='',
+                         r_oligo=None,
+                         max_prop_low_quality_sites=0.10,
+                         min_overlap=5,
+                         mmmr_cutoff=0.85,
+                         concatenate=False,
+                         min_read_length=10,
+                         debug=False,
+                         processes=1,
+                         chunk_size=10000
+                         ):
 
-def overlap(range1, range2):
-    if (range1[1] >= range2[0]) and (range2[1] >= range1[0]):
-        return(range1[1] - range2[0])
-    else:
-        return(False)
+    '''
+        Demultiplex, mask and bin raw reads in a single streaming pass using
+        process_reads_chunk in a pool of worker processes.
 
+        output_file_path(barcode, kind) should return the path of the output
+        file of a given kind (see process_reads_chunk) for a barcode
+        dictionary, or for reads that did not match any barcode when barcode
+        is None. When it returns None, that output is not written.
 
-def alignments_from_sam_file(min_seq_cluster, max_seq_cluster, sam_file_path,
-                             aln_output_file_path=None,
-                             counts_output_file_path=None,
-                             program='mafft', options='',
-                             program_executable='mafft'):
+        The forward read oligo for each barcode is
+        barcode_adapter + barcode + f_sticky.
 
-    # from Bio import SeqIO
-    # from Bio import AlignIO
+        Returns:
+            A list of read counts, one per barcode, followed by the number of
+            reads that did not match any barcode.
+    '''
 
     import os
+    import krio
 
-    import string
+    barcodes = [{'id': x['id'], 'barcode': x['barcode']} for x in barcodes]
 
-    import datrie
+    lookup, collisions = index_barcodes(
+        barcodes=barcodes,
+        max_barcode_mismatch_count=max_barcode_mismatch_count)
 
-    from Bio import Seq
-    from Bio import SeqRecord
+    _print_barcode_collisions_(collisions, max_barcode_mismatch_count)
 
-    import kralign
-    import krseq
+    f_oligos = [barcode_adapter + x['barcode'].upper() + f_sticky
+                for x in barcodes]
 
-    import krother
+    kinds = ['f_lengths', 'f_hq', 'f_lq', 'all_hq', 'binned']
+    if reverse_reads_file_path is not None:
+        kinds = kinds + ['r_lengths', 'r_hq', 'r_lq']
+    if debug:
+        kinds = kinds + ['f_fastq', 'f_masked']
+        if reverse_reads_file_path is not None:
+            kinds = kinds + ['r_fastq', 'r_masked']
+
+    # Create all output files up front, so samples without reads still get
+    # them. Files are then opened for appending as results come in, there
+    # may be too many of them to keep open at the same time.
+    paths = dict()
+    for i, barcode in enumerate(barcodes + [None]):
+        for kind in kinds:
+            path = output_file_path(barcode, kind)
+            if not path:
+                continue
+            krio.prepare_directory(os.path.dirname(path))
+            handle = open(path, 'w')
+            if kind == 'binned':
+                handle.write('fhq\trhq\tcns\tmsg\tflq\trlq\n')
+            handle.close()
+            paths[(i, kind)] = path
+
+    read_counts = [0] * (len(barcodes) + 1)
+
+    def write_results(results):
+        for key in results.keys():
+            if key[1] == 'f_lengths':
+                read_counts[key[0]] = (
+                    read_counts[key[0]] + results[key].count('\n'))
+            if key not in paths:
+                continue
+            handle = open(paths[key], 'a')
+            handle.write(results[key])
+            handle.close()
+
+    _stream_read_pairs_(
+        forward_reads_file_path=forward_reads_file_path,
+        reverse_reads_file_path=reverse_reads_file_path,
+        function=process_reads_chunk,
+        kwargs={'barcodes': barcodes,
+                'lookup': lookup,
+                'trim_extra': trim_extra,
+                'quality_score_treshold': quality_score_treshold,
+                'low_quality_residue': low_quality_residue,
+                'f_oligos': f_oligos,
+                'r_oligo': r_oligo,
+                'max_prop_low_quality_sites': max_prop_low_quality_sites,
+                'min_overlap': min_overlap,
+                'mmmr_cutoff': mmmr_cutoff,
+                'concatenate': concatenate,
+                'min_read_length': min_read_length,
+                'debug': debug},
+        write_results=write_results,
+        processes=processes,
+        chunk_size=chunk_size)
+
+    return(read_counts)
+
+
+def bin_reads_stream(samples,
+                     output_file_path,
+                     r_oligo=None,
+                     max_prop_low_quality_sites=0.10,
+                     min_overlap=5,
+                     mmmr_cutoff=0.85,
+                     concatenate=False,
+                     low_quality_residue='N',
+                     min_read_length=10,
+                     processes=1,
+                     chunk_size=10000,
+                     log_func=None,
+                     log_file_path=None
+                     ):
 
-    ####
+    '''
+        Bin masked reads of many samples with bin_reads_batch in a pool of
+        worker processes. Samples are split into chunks of read pairs, so
+        samples with many reads do not keep a single process busy after the
+        others are done. Output of each sample is written in input order.
 
-    ps = os.path.sep
+        samples is a list of dictionaries with keys id, f_reads_file_path,
+        r_reads_file_path (None for single end data) and f_oligo.
 
-    printable_sample_name = sam_file_path.split(ps)[-1]
+        output_file_path(sample, kind) should return the path of the output
+        file of a given kind (see bin_reads_batch) for a sample dictionary.
+        When it returns None, that output is not written.
+    '''
 
-    print(krother.timestamp(), '-', 'Iterating over SAM file.', printable_sample_name)
+    import os
+    import krio
+    import krother
 
-    handle_sam = open(sam_file_path, 'r')
+    kinds = ['f_hq', 'f_lq', 'all_hq', 'binned']
 
-    accept = dict()
-    # accept = datrie.Trie(string.printable)
-    reject = list()
+    def log(msg):
+        print(msg)
+        if log_func and log_file_path:
+            log_func(msg, log_file_path)
 
-    for l in handle_sam:
-        if not l.startswith('@'):
-            record = l.strip('\n').split('\t')
-            if len(record) == 1:
-                continue
-            sam_flag = record[1]
-            # if sam_flag == '0' or sam_flag == '16':
-            if sam_flag != '4' and sam_flag != '8':
-                read_id = record[0]
-
-                if read_id in accept.keys():
-                    reject.append(read_id)
-                    accept.pop(read_id)
-                    # print('multiple matches reject', read_id)
-                    continue
-                elif read_id in reject:
-                    # print('                 reject', read_id)
+    inputs = list()
+    for sample in samples:
+
+        sample_kinds = kinds
+        if sample['r_reads_file_path'] is not None:
+            sample_kinds = kinds + ['r_hq', 'r_lq']
+
+        state = {'handles': dict()}
+
+        def start(sample=sample, sample_kinds=sample_kinds, state=state):
+            log(krother.timestamp() + ' - Sample ' + sample['id'] +
+                ' starting...')
+            for kind in sample_kinds:
+                path = output_file_path(sample, kind)
+                if not path:
                     continue
+                krio.prepare_directory(os.path.dirname(path))
+                handle = open(path, 'w')
+                if kind == 'binned':
+                    handle.write('fhq\trhq\tcns\tmsg\tflq\trlq\n')
+                state['handles'][kind] = handle
+
+        def write_results(results, state=state):
+            for kind in state['handles'].keys():
+                state['handles'][kind].write(results[kind])
+
+        def finish(sample=sample, state=state):
+            for handle in state['handles'].values():
+                handle.close()
+            log(krother.timestamp() + ' - Sample ' + sample['id'] + ' done.')
+
+        inputs.append({
+            'forward_reads_file_path': sample['f_reads_file_path'],
+            'reverse_reads_file_path': sample['r_reads_file_path'],
+            'kwargs': {'f_oligo': sample['f_oligo']},
+            'start': start,
+            'write_results': write_results,
+            'finish': finish})
+
+    _stream_read_pair_files_(
+        inputs=inputs,
+        function=bin_reads_batch,
+        kwargs={'r_oligo': r_oligo,
+                'max_prop_low_quality_sites': max_prop_low_quality_sites,
+                'min_overlap': min_overlap,
+                'mmmr_cutoff': mmmr_cutoff,
+                'concatenate': concatenate,
+                'low_quality_residue': low_quality_residue,
+                'min_read_length': min_read_length},
+        processes=processes,
+        chunk_size=chunk_size)
+
+
+def combine_demultiplexed_results(input_dir, output_dir):
+
+    import os
+    import shutil
+    import krio
+
+    ps = os.path.sep
+    input_dir = input_dir.rstrip(ps) + ps
+    output_dir = output_dir.rstrip(ps) + ps
+    krio.prepare_directory(output_dir)
+    directory_list = krio.parse_directory(
+        path=input_dir,
+        file_name_sep=' ',
+        sort='forward'
+    )
+
+    file_dir_path = directory_list[0]['path'].rstrip(ps) + ps
+    file_list = krio.parse_directory(
+        path=file_dir_path,
+        file_name_sep='_',
+        sort='forward'
+    )
+
+    for f in file_list:
+        output_file_path = output_dir + f['full']
+        output_file_handle = open(output_file_path, 'wa')
+#         for part in range(1, len(directory_list) + 1):
+        for part_dir in directory_list:
+            part_directory_path = input_dir + part_dir['name'] + ps
+            part_file_path = part_directory_path + f['full']
+            shutil.copyfileobj(open(part_file_path, 'rb'),
+                               output_file_handle)
+        output_file_handle.close()
+
+
+def nucleotides_at_site(site):
+    c_a = site.count('A')
+    c_c = site.count('C')
+    c_g = site.count('G')
+    c_t = site.count('T')
+    return([c_a, c_c, c_g, c_t])
+
+
+# CIGAR operations, parsed CIGAR strings code operations by their index here
+_CIGAR_OPERATIONS_ = 'MIDNSHP=X'
+
+# Parsed CIGAR strings, most reads share a handful of CIGAR strings (100M)
+_CIGAR_CACHE_ = dict()
+_CIGAR_CACHE_SIZE_ = 65536
+
+
+def _parse_CIGAR_(cigar):
+
+    '''
+    Parse a CIGAR string once and cache the result. Returns a tuple:
+    (operation, length) array, reference length, and for every read base
+    placed on the reference: its index in the read, its reference offset
+    and its rank within an insertion (0 for bases aligned to the reference).
+    The last two items are the reference offsets and lengths of insertions.
+    Insertions are placed before the reference position at their offset.
+    '''
+
+    import re
+
+    import numpy
+
+    parsed = _CIGAR_CACHE_.get(cigar)
+    if parsed is not None:
+        return(parsed)
+
+    decoded = list()
+    for count, letter in re.findall('([0-9]*)([A-Za-z=])', cigar):
+        op = _CIGAR_OPERATIONS_.find(letter.upper())
+        if op == -1:
+            raise ValueError('Unknown CIGAR operation ' + letter + ' in ' +
+                             cigar + '.')
+        if count == '':
+            count = 1
+        else:
+            count = int(count)
+        decoded.append((op, count))
+
+    query_index = list()
+    ref_offset = list()
+    ins_rank = list()
+    ins_at = list()
+    ins_len = list()
+
+    q = 0
+    r = 0
+    for op, count in decoded:
+        # M = X
+        if op == 0 or op == 7 or op == 8:
+            query_index.append(numpy.arange(q, q + count))
+            ref_offset.append(numpy.arange(r, r + count))
+            ins_rank.append(numpy.zeros(count, dtype=numpy.int_))
+            q = q + count
+            r = r + count
+        # I, consecutive insertions are joined
+        elif op == 1:
+            first = 1
+            if ins_at and ins_at[-1] == r:
+                first = ins_len[-1] + 1
+                ins_len[-1] = ins_len[-1] + count
+            else:
+                ins_at.append(r)
+                ins_len.append(count)
+            query_index.append(numpy.arange(q, q + count))
+            ref_offset.append(numpy.zeros(count, dtype=numpy.int_) + r)
+            ins_rank.append(numpy.arange(first, first + count))
+            q = q + count
+        # D N
+        elif op == 2 or op == 3:
+            r = r + count
+        # S
+        elif op == 4:
+            q = q + count
+
+    def array(x):
+        if x:
+            x = numpy.concatenate(x)
+        else:
+            x = numpy.zeros(0, dtype=numpy.int_)
+        x = x.astype(numpy.int_)
+        x.setflags(write=False)
+        return(x)
+
+    codes = numpy.array(decoded, dtype=numpy.int32).reshape(-1, 2)
+    codes.setflags(write=False)
+
+    parsed = (codes, r, array(query_index), array(ref_offset),
+              array(ins_rank), array([numpy.array(ins_at)]),
+              array([numpy.array(ins_len)]))
+
+    if len(_CIGAR_CACHE_) >= _CIGAR_CACHE_SIZE_:
+        _CIGAR_CACHE_.clear()
+    _CIGAR_CACHE_[cigar] = parsed
+
+    return(parsed)
+
+
+def parse_CIGAR(cigar):
+
+    '''
+    Parse a CIGAR string into a read-only array of (operation, length) rows.
+    Operations are coded by their index in 'MIDNSHP=X'.
+    '''
+
+    return(_parse_CIGAR_(cigar)[0])
+
+
+def decode_CIGAR(cigar):
+
+    cigar_decoded_list = list()
+
+    for op, count in _parse_CIGAR_(cigar)[0].tolist():
+        cigar_decoded_list.append([count, _CIGAR_OPERATIONS_[op]])
+
+    return(cigar_decoded_list)
+
+'''
+def encode_CIGAR(cigar):
+
+    encoded = ''
+
+    for c in cigar:
+        encoded = encoded + str(c[0]) + c[1]
+
+    return(encoded)
+
+
+def expand_CIGAR(cigar):
+
+    decoded = decode_CIGAR(cigar)
+
+    expanded = ''
+
+    for d in decoded:
+        expanded = expanded + d[1] * d[0]
+
+    return(expanded)
+'''
+
+def length_of_CIGAR(cigar):
+
+    '''
+    Number of reference positions covered by a CIGAR string (M D N = X).
+    '''
+
+    return(_parse_CIGAR_(cigar)[1])
+
+
+def _CIGAR_alignment_matrix_(reads, gap='-'):
+
+    '''
+    Place reads on reference columns using their CIGAR strings. reads is a
+    list of (reference_start, cigar, read_sequence). Returns a uint8 matrix
+    with one row per read. Inserted bases get their own columns, reference
+    columns without any read bases are removed.
+    '''
+
+    import numpy
+
+    parsed = [_parse_CIGAR_(x[1]) for x in reads]
+
+    min_pos = min([x[0] for x in reads])
+    span = max([x[0] + p[1] for x, p in zip(reads, parsed)]) - min_pos
+
+    # Longest insertion before every reference position
+    ins_before = numpy.zeros(span + 1, dtype=numpy.int_)
+    for x, p in zip(reads, parsed):
+        numpy.maximum.at(ins_before, x[0] - min_pos + p[5], p[6])
+
+    # Column of every reference position
+    ref_column = numpy.arange(span + 1) + numpy.cumsum(ins_before)
+
+    matrix = numpy.empty((len(reads), span + ins_before.sum()),
+                         dtype=numpy.uint8)
+    matrix.fill(ord(gap))
+
+    for i, (x, p) in enumerate(zip(reads, parsed)):
+        r = x[0] - min_pos + p[3]
+        columns = ref_column[r]
+        ins = p[4] > 0
+        columns[ins] = columns[ins] - ins_before[r[ins]] + p[4][ins] - 1
+        seq = numpy.frombuffer(x[2], dtype=numpy.uint8)
+        matrix[i, columns] = seq[p[2]]
+
+    matrix = matrix[:, (matrix != ord(gap)).any(axis=0)]
+
+    return(matrix)
+
+
+def alignment_from_CIGAR(reads, gap='-'):
+
+    '''
+    Align reads mapped to a reference using their CIGAR strings. reads is a
+    list of (reference_start, cigar, read_sequence). Returns gapped sequences
+    in the same order.
+    '''
+
+    matrix = _CIGAR_alignment_matrix_(reads, gap)
+
+    return([x.tobytes() for x in matrix])
+
+
+def overlap(range1, range2):
+    if (range1[1] >= range2[0]) and (range2[1] >= range1[0]):
+        return(range1[1] - range2[0])
+    else:
+        return(False)
+
+
+def _sam_lines_(sam_file_path, samtools_executable='samtools'):
+
+    '''
+    Iterate over lines of a SAM file. BAM files are read through
+    "samtools view -h", gzip or BGZF compressed SAM files are read with
+    krio.open_file.
+    '''
+
+    import gzip
+    import subprocess
+
+    import krio
+
+    bam = False
+    if krio.is_gzip_file(sam_file_path):
+        handle = gzip.open(sam_file_path, 'rb')
+        bam = handle.read(4) == b'BAM\x01'
+        handle.close()
+
+    if bam:
+        pipe = subprocess.Popen(
+            [samtools_executable, 'view', '-h', sam_file_path],
+            stdout=subprocess.PIPE)
+        try:
+            for l in pipe.stdout:
+                yield l
+        finally:
+            pipe.stdout.close()
+            pipe.wait()
+    else:
+        handle = krio.open_file(sam_file_path, 'r')
+        try:
+            for l in handle:
+                yield l
+        finally:
+            handle.close()
 
-                reference_id = record[2]
-                reference_start = int(record[3])
-                cigar = record[5]
-                read_sequence = record[9]
 
-                reference_stop = reference_start + length_of_CIGAR(cigar) - 1
+def _sam_is_coordinate_sorted_(sam_file_path, samtools_executable='samtools'):
 
-                ###KRTEMP
-                # if reference_id == 'SL2.50ch11':
-                #     if reference_start >= 4417124 and reference_stop <= 4417391:
-                ###KRTEMPEND
+    '''
+    Check the @HD header line of a SAM file for SO:coordinate.
+    '''
 
-                accept[read_id] = [reference_id, reference_start, reference_stop, read_id, cigar, read_sequence]
+    lines = _sam_lines_(sam_file_path, samtools_executable)
+    try:
+        for l in lines:
+            if not l.startswith('@'):
+                break
+            if l.startswith('@HD'):
+                return('SO:coordinate' in l.strip('\n').split('\t'))
+    finally:
+        lines.close()
 
-                # print(read_id, reference_id, reference_start, reference_stop)
-                # print(sam_flag, read_id, reference_id, reference_start, cigar, read_sequence)
+    return(False)
 
-    # for a in accept.keys():
-    #     print(accept[a][1])
 
-    handle_sam.close()
+def _sam_multiple_match_read_ids_(sam_file_path,
+                                  samtools_executable='samtools'):
 
-    print(krother.timestamp(), '-', 'Constructing loci.', printable_sample_name)
+    '''
+    Return a set of ids of reads that have more than one mapped record in a
+    SAM file. Only hashes of read ids are kept in the first pass, ids are
+    compared in the second pass only for reads with colliding hashes.
+    '''
+
+    import array
 
-    accept = accept.values()
-    accept = sorted(accept, key=lambda x: (x[0], x[1], x[2], x[3]), reverse=False)
+    import numpy
 
-    loci = list()
+    hashes = array.array('l')
 
+    for l in _sam_lines_(sam_file_path, samtools_executable):
+        if l.startswith('@'):
+            continue
+        record = l.split('\t', 2)
+        if len(record) == 1:
+            continue
+        if record[1] != '4' and record[1] != '8':
+            hashes.append(hash(record[0]))
+
+    hashes = numpy.frombuffer(hashes, dtype=numpy.int_)
+    hashes = numpy.sort(hashes)
+    candidates = set(hashes[1:][hashes[1:] == hashes[:-1]].tolist())
+    del hashes
+
+    reject = set()
+    if not candidates:
+        return(reject)
+
+    seen = set()
+    for l in _sam_lines_(sam_file_path, samtools_executable):
+        if l.startswith('@'):
+            continue
+        record = l.split('\t', 2)
+        if len(record) == 1:
+            continue
+        if record[1] != '4' and record[1] != '8':
+            read_id = record[0]
+            if hash(read_id) in candidates:
+                if read_id in seen:
+                    reject.add(read_id)
+                else:
+                    seen.add(read_id)
+
+    return(reject)
+
+
+def _sam_mapped_reads_(sam_file_path, reject, samtools_executable='samtools'):
+
+    '''
+    Iterate over mapped reads in a SAM file, skipping reads with ids in
+    reject. Yields (reference_id, reference_start, reference_stop, read_id,
+    cigar, read_sequence) in file order.
+    '''
+
+    for l in _sam_lines_(sam_file_path, samtools_executable):
+        if l.startswith('@'):
+            continue
+        record = l.strip('\n').split('\t')
+        if len(record) == 1:
+            continue
+        sam_flag = record[1]
+        if sam_flag != '4' and sam_flag != '8':
+            read_id = record[0]
+            if read_id in reject:
+                continue
+            reference_start = int(record[3])
+            cigar = record[5]
+            reference_stop = reference_start + length_of_CIGAR(cigar) - 1
+            yield((record[2], reference_start, reference_stop, read_id,
+                   cigar, record[9]))
+
+
+def _sort_coordinate_sorted_reads_(reads):
+
+    '''
+    Order reads from a coordinate sorted SAM file by reference stop and read
+    id within each reference position, as sorting all reads would.
+    '''
+
+    seen_refs = set()
     prev_ref = None
-    prev_ref_start = None
-    prev_ref_stop = None
+    group = list()
+
+    for r in reads:
+        if group and (r[0] != group[0][0] or r[1] != group[0][1]):
+            if r[0] == group[0][0] and r[1] < group[0][1]:
+                raise ValueError('SAM file is not coordinate sorted.')
+            for g in sorted(group):
+                yield(g)
+            group = list()
+        if r[0] != prev_ref:
+            if r[0] in seen_refs:
+                raise ValueError('SAM file is not coordinate sorted.')
+            seen_refs.add(r[0])
+            prev_ref = r[0]
+        group.append(r)
+
+    for g in sorted(group):
+        yield(g)
+
+
+def _sort_reads_external_(reads, temp_dir, run_size=500000):
 
+    '''
+    Sort reads by (reference_id, reference_start, reference_stop, read_id)
+    with bounded memory: sorted runs of run_size reads are written to files
+    in temp_dir and merged.
+    '''
+
+    import heapq
+    import os
+
+    ps = os.path.sep
+
+    def write_run(run, run_number):
+        run.sort()
+        run_file_path = temp_dir + ps + 'run_' + str(run_number) + '.tsv'
+        handle = open(run_file_path, 'w')
+        for r in run:
+            handle.write(r[0] + '\t' + str(r[1]) + '\t' + str(r[2]) + '\t' +
+                         r[3] + '\t' + r[4] + '\t' + r[5] + '\n')
+        handle.close()
+        return(run_file_path)
+
+    def read_run(run_file_path):
+        handle = open(run_file_path, 'r')
+        try:
+            for l in handle:
+                r = l.strip('\n').split('\t')
+                yield((r[0], int(r[1]), int(r[2]), r[3], r[4], r[5]))
+        finally:
+            handle.close()
+
+    run_file_paths = list()
+    run = list()
+    for r in reads:
+        run.append(r)
+        if len(run) == run_size:
+            run_file_paths.append(write_run(run, len(run_file_paths)))
+            run = list()
+
+    # Everything fits in a single run
+    if not run_file_paths:
+        run.sort()
+        for r in run:
+            yield(r)
+        return
+
+    if run:
+        run_file_paths.append(write_run(run, len(run_file_paths)))
+    run = None
+
+    try:
+        for r in heapq.merge(*[read_run(x) for x in run_file_paths]):
+            yield(r)
+    finally:
+        for run_file_path in run_file_paths:
+            os.remove(run_file_path)
+
+
+def sam_loci(reads, overlap_threshold=40):
+
+    '''
+    Group reads, sorted by reference position, into loci. A read joins the
+    current locus if it overlaps the previous read by more than
+    overlap_threshold positions. Each locus is yielded as soon as it closes.
+    '''
+
+    prev = None
     current_locus = list()
 
-    for a in accept:
+    for a in reads:
+        if prev is not None:
+            o = False
+            if prev[0] == a[0]:
+                o = overlap((prev[1], prev[2]), (a[1], a[2]))
+            if o is False or o <= overlap_threshold:
+                yield(current_locus)
+                current_locus = list()
+        current_locus.append(a)
+        prev = a
 
-        ref = a[0]
-        ref_start = a[1]
-        ref_stop = a[2]
+    if current_locus:
+        yield(current_locus)
 
-        if not prev_ref:
-            prev_ref = ref
-            prev_ref_start = ref_start
-            prev_ref_stop = ref_stop
-            current_locus.append(a)
-            continue
 
-        o = False
-        if prev_ref == ref:
-            o = overlap((prev_ref_start, prev_ref_stop), (ref_start, ref_stop))
+def alignments_from_sam_file(min_seq_cluster, max_seq_cluster, sam_file_path,
+                             aln_output_file_path=None,
+                             counts_output_file_path=None,
+                             program='mafft', options='',
+                             program_executable='mafft',
+                             overlap_threshold=40,
+                             samtools_executable='samtools',
+                             temp_dir=None, run_size=500000,
+                             builtin_max_records=0, builtin_max_length=300,
+                             site_counts_file_path=None):
 
-        prev_ref = ref
-        prev_ref_start = ref_start
-        prev_ref_stop = ref_stop
+    '''
+    Align reads within loci of a SAM (or BAM) file. Reads mapped more than
+    once are rejected. Loci are assembled while streaming over reads sorted
+    by reference position and aligned as soon as they close, so only one
+    locus is kept in memory. Coordinate sorted files (SO:coordinate) are
+    streamed directly, other files are sorted first in runs of run_size
+    reads written to a temporary directory in temp_dir. If program is
+    'cigar', reads are aligned using their CIGAR strings instead of an
+    alignment program. Loci of at most builtin_max_records reads no longer
+    than builtin_max_length are aligned in process (kralign.align).
+    Nucleotide counts per site are written to counts_output_file_path (text)
+    and site_counts_file_path (SiteCountsWriter).
+    '''
 
-        if o > 40:
-            current_locus.append(a)
-        else:
-            loci.append(current_locus)
-            current_locus = list()
-            current_locus.append(a)
-            # print('---------------')
+    # from Bio import SeqIO
+    # from Bio import AlignIO
 
-        # print(ref, ref_start, ref_stop)
+    import os
+    import shutil
+    import tempfile
 
-    loci.append(current_locus)
+    from Bio import Seq
+    from Bio import SeqRecord
 
-    print(krother.timestamp(), '-', 'Aligning sequences within loci.', printable_sample_name)
+    import kralign
+    import krseq
 
-    handle_aln = None
-    if aln_output_file_path:
-        handle_aln = open(aln_output_file_path, 'w', 1)
+    import krother
+
+    ####
+
+    ps = os.path.sep
+
+    printable_sample_name = sam_file_path.split(ps)[-1]
+
+    print(krother.timestamp(), '-', 'Finding reads with multiple matches.', printable_sample_name)
+
+    reject = _sam_multiple_match_read_ids_(sam_file_path, samtools_executable)
+
+    print(krother.timestamp(), '-', 'Iterating over SAM file.', printable_sample_name)
+
+    reads = _sam_mapped_reads_(sam_file_path, reject, samtools_executable)
 
+    run_dir = None
+    handle_aln = None
     handle_counts = None
-    if counts_output_file_path:
-        handle_counts = open(counts_output_file_path, 'w', 1)
+    site_counts = None
+    try:
+        if _sam_is_coordinate_sorted_(sam_file_path, samtools_executable):
+            reads = _sort_coordinate_sorted_reads_(reads)
+        else:
+            run_dir = tempfile.mkdtemp(dir=temp_dir)
+            reads = _sort_reads_external_(reads, run_dir, run_size)
 
-    cluster_depths = list()
+        loci = sam_loci(reads, overlap_threshold)
 
-    for l in loci:
+        print(krother.timestamp(), '-', 'Aligning sequences within loci.', printable_sample_name)
 
-        rpc = len(l)
-        cluster_depths.append(rpc)
+        if aln_output_file_path:
+            handle_aln = open(aln_output_file_path, 'w', 1)
 
-        if rpc >= min_seq_cluster and (rpc <= max_seq_cluster or max_seq_cluster == 0):
+        if counts_output_file_path:
+            handle_counts = open(counts_output_file_path, 'w', 1)
 
-            min_pos = l[0][1]
-            max_pos = l[0][1]
+        if site_counts_file_path:
+            site_counts = SiteCountsWriter(site_counts_file_path)
 
-            for s in l:
-                min_pos = min(min_pos, s[1])
-                max_pos = max(max_pos, s[2])
+        cluster_depths = list()
 
-            cluster_name = 'CLUSTER_' + l[0][0] + '_' + str(min_pos) + ':' + str(max_pos)
-            # print(cluster_name)
+        for l in loci:
 
-            if handle_aln:
-                handle_aln.write('>' + cluster_name + '\n')
-            if handle_counts:
-                handle_counts.write('>' + cluster_name + '\n')
+            rpc = len(l)
+            cluster_depths.append(rpc)
 
-            if rpc > 1:
+            if rpc >= min_seq_cluster and (rpc <= max_seq_cluster or max_seq_cluster == 0):
 
-                records = list()
+                min_pos = l[0][1]
+                max_pos = l[0][1]
 
                 for s in l:
-                    seq = Seq.Seq(s[5])
-                    seq_record = SeqRecord.SeqRecord(seq=seq, id=s[3], name='', description='')
-                    records.append(seq_record)
-
-                aln = kralign.align(
-                    records,
-                    program=program,
-                    options=options,
-                    program_executable=program_executable)
-
-                # for s in aln:
-                #     print(s.seq)
-
-                if handle_aln or handle_counts:
-                    for l in range(0, aln.get_alignment_length()):
-                        column = aln[:, l]
-                        column = column.upper()
-                        if handle_aln:
-                            handle_aln.write(column + '\n')
-                        counts = nucleotides_at_site(column)
-                        counts_str = (
-                            str(counts[0]) + '\t' +
-                            str(counts[1]) + '\t' +
-                            str(counts[2]) + '\t' +
-                            str(counts[3]) + '\n'
-                        )
-                        if handle_counts:
-                            handle_counts.write(counts_str)
-            else:
-                if handle_aln or handle_counts:
-                    record = l[0][5]
-                    for l in range(0, len(record)):
-                        column = record[l]
-                        column = column.upper()
-                        if handle_aln:
-                            handle_aln.write(column + '\n')
-                        counts = nucleotides_at_site(column)
-                        counts_str = (
-                            str(counts[0]) + '\t' +
-                            str(counts[1]) + '\t' +
-                            str(counts[2]) + '\t' +
-                            str(counts[3]) + '\n'
-                        )
-                        if handle_counts:
-                            handle_counts.write(counts_str)
-
-        # print('================================================================')
-
-        # locus_alignment = alignment_from_CIGAR(l)
-
-        # for s in locus_alignment:
-        #     print(s)
-
-        # alignment_breaks = list()
-        # running_start = None
-        # running_end = None
-        # for i, s in enumerate(locus_alignment):
-
-        #     # Find out where sequences starts and ends within an alignment
-        #     s = s.rstrip('-')
-        #     s_start = 0
-
-        #     start_found = False
-        #     for loc, nt in enumerate(s):
-        #         if not start_found and nt != '-':
-        #             s_start = loc
-        #             start_found = True
-        #     s_end = len(s)
-
-        #     # Find breaks in alignment
-        #     o = None
-        #     if (running_start is not None) and (running_end is not None):
-        #         o = overlap([running_start, running_end], [s_start, s_end])
-        #         if o >= 40:
-        #             running_end = s_end
-        #         else:
-        #             alignment_breaks.append(i)
-        #             running_start = s_start
-        #             running_end = s_end
-        #     else:
-        #         running_start = s_start
-        #         running_end = s_end
-
-        #     print(s, '|', running_start, running_end, '|', s_start, s_end, '|', o)
-
-        # print(alignment_breaks)
-
-        # print('****************************************************************')
+                    min_pos = min(min_pos, s[1])
+                    max_pos = max(max_pos, s[2])
 
-    ####
+                cluster_name = 'CLUSTER_' + l[0][0] + '_' + str(min_pos) + ':' + str(max_pos)
+                # print(cluster_name)
 
-    if handle_aln:
-        handle_aln.close()
-    if handle_counts:
-        handle_counts.close()
+                if rpc > 1 and program == 'cigar':
+
+                    aln = alignment_from_CIGAR(
+                        [(s[1], s[4], s[5]) for s in l])
+
+                elif rpc > 1:
+
+                    records = list()
+
+                    for s in l:
+                        seq = Seq.Seq(s[5])
+                        seq_record = SeqRecord.SeqRecord(seq=seq, id=s[3], name='', description='')
+                        records.append(seq_record)
+
+                    aln = kralign.align(
+                        records,
+                        program=program,
+                        options=options,
+                        program_executable=program_executable,
+                        builtin_max_records=builtin_max_records,
+                        builtin_max_length=builtin_max_length)
+
+                    # for s in aln:
+                    #     print(s.seq)
+
+                    aln = [str(x.seq) for x in aln]
+
+                else:
+                    aln = [l[0][5]]
+
+                _write_alignment_columns_(
+                    cluster_name, _alignment_matrix_(aln), handle_aln,
+                    handle_counts, site_counts)
+
+            # print('================================================================')
+
+            # locus_alignment = alignment_from_CIGAR(l)
+
+            # for s in locus_alignment:
+            #     print(s)
+
+            # alignment_breaks = list()
+            # running_start = None
+            # running_end = None
+            # for i, s in enumerate(locus_alignment):
+
+            #     # Find out where sequences starts and ends within an alignment
+            #     s = s.rstrip('-')
+            #     s_start = 0
+
+            #     start_found = False
+            #     for loc, nt in enumerate(s):
+            #         if not start_found and nt != '-':
+            #             s_start = loc
+            #             start_found = True
+            #     s_end = len(s)
+
+            #     # Find breaks in alignment
+            #     o = None
+            #     if (running_start is not None) and (running_end is not None):
+            #         o = overlap([running_start, running_end], [s_start, s_end])
+            #         if o >= 40:
+            #             running_end = s_end
+            #         else:
+            #             alignment_breaks.append(i)
+            #             running_start = s_start
+            #             running_end = s_end
+            #     else:
+            #         running_start = s_start
+            #         running_end = s_end
+
+            #     print(s, '|', running_start, running_end, '|', s_start, s_end, '|', o)
+
+            # print(alignment_breaks)
+
+            # print('****************************************************************')
+
+    finally:
+        # Closed on errors too, so the site counts header is written and
+        # nothing is left open
+        if handle_aln:
+            handle_aln.close()
+        if handle_counts:
+            handle_counts.close()
+        if site_counts:
+            site_counts.close()
+        # The external sort runs can be several GB
+        if run_dir:
+            shutil.rmtree(run_dir, ignore_errors=True)
 
     return(cluster_depths)
 
@@ -1075,10 +2354,27 @@ def alignments_from_sam_file(min_seq_cluster, max_seq_cluster, sam_file_path,
 def align_clusters(min_seq_cluster, max_seq_cluster, uc_file_path,
                    fasta_file_path, aln_clustal_phylip_file_path=None,
                    aln_output_file_path=None, counts_output_file_path=None,
-                   program='mafft', options='', program_executable='mafft'):
+                   program='mafft', options='', program_executable='mafft',
+                   processes=1, batch_size=64, builtin_max_records=0,
+                   builtin_max_length=300, site_counts_file_path=None):
+
+    '''
+    Align reads within clusters of a usearch .uc file. Clusters are sent to
+    the aligner in batches of batch_size clusters, aligned by processes
+    worker processes, and written out in cluster order as they come back.
+    Single read clusters and clusters of identical reads are not sent to
+    the alignment program. Clusters of at most builtin_max_records reads no
+    longer than builtin_max_length are aligned in process
+    (kralign.align_sequences). Nucleotide counts per site are written to
+    counts_output_file_path (text) and site_counts_file_path
+    (SiteCountsWriter).
+    '''
 
     from Bio import SeqIO
     from Bio import AlignIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Align import MultipleSeqAlignment
 
     import krusearch
     # import krbioio
@@ -1103,6 +2399,10 @@ def align_clusters(min_seq_cluster, max_seq_cluster, uc_file_path,
     if counts_output_file_path:
         handle_counts = open(counts_output_file_path, 'w')
 
+    site_counts = None
+    if site_counts_file_path:
+        site_counts = SiteCountsWriter(site_counts_file_path)
+
     # f_id = uc_file_path.split('.')[0].split('/')[-1].split('_')[0]
 
     alignments = list()
@@ -1112,95 +2412,61 @@ def align_clusters(min_seq_cluster, max_seq_cluster, uc_file_path,
     # cluster_count = len(keys)
 
     cluster_depths = list()
-    # krcl.hide_cursor()
-    for i, key in enumerate(keys):
-        records = list()
-        members = cluster_dict[key]
-        rpc = len(members)
-        cluster_depths.append(rpc)
-        if rpc >= min_seq_cluster and (rpc <= max_seq_cluster or
-                                       max_seq_cluster == 0):
-            # krcl.print_progress(i, cluster_count, 50, '')
-            # print(f_id, i, '/', cluster_count)
-            if handle_aln:
-                handle_aln.write('>CLUSTER_' + str(key) + '\n')
-            if handle_counts:
-                handle_counts.write('>CLUSTER_' + str(key) + '\n')
-            # X = False ####
-            if rpc > 1:
-                for m in members:
-                    # if m[1] == "HWI-ST1155:95:D0KL1ACXX:4:1101:2261:6701|C0NS:0": ####
-                    #     X = True ####
-                    # if X: ####
-                    #     print(m) ####
-                    if m[0] == '+':
-                        records.append(records_dict[m[1]])
-                    else:
-                        records.append(
-                            krseq.reverse_complement(records_dict[m[1]]))
-                # if X: ####
-                #     print('---') ####
-                aln = kralign.align(
-                    records,
-                    program=program,
-                    options=options,
-                    program_executable=program_executable)
-                    # options='--retree 1 --thread '+str(threads))
-                # aln = kralign.align(records, 'muscle', options='')
-                # if X: ####
-                #     AlignIO.write(aln, '/home/karolis/Dropbox/Code/aln.fasta', "phylip-relaxed") ####
-                if aln_clustal_phylip_file_path:
-                    # import krother
-                    # print(krother.attr(aln))
-                    ids = list()
-                    for seq in aln:
-                        # print(seq.id)
-                        seq.id = seq.id.split('_')[0]  # ##
-                        ids.append(seq.id)
-                    if len(set(ids)) == len(ids):
-                        alignments.append(aln)
-                        # print('Accept alignment: ' + str(len(ids))) ###
-                    else:
-                        pass
-                        # print('Warning: Multiple sequences from the same sample:', str(key)) ###
-                if handle_aln or handle_counts:
-                    for l in range(0, aln.get_alignment_length()):
-                        column = aln[:, l]
-                        column = column.upper()
-                        if handle_aln:
-                            handle_aln.write(column + '\n')
-                        counts = nucleotides_at_site(column)
-                        counts_str = (
-                            str(counts[0]) + '\t' +
-                            str(counts[1]) + '\t' +
-                            str(counts[2]) + '\t' +
-                            str(counts[3]) + '\n'
-                        )
-                        if handle_counts:
-                            handle_counts.write(counts_str)
-            else:
-                if handle_aln or handle_counts:
+
+    def batches():
+        batch = list()
+        for key in keys:
+            members = cluster_dict[key]
+            rpc = len(members)
+            cluster_depths.append(rpc)
+            if rpc >= min_seq_cluster and (rpc <= max_seq_cluster or
+                                           max_seq_cluster == 0):
+                sequences = list()
+                if rpc > 1:
+                    for m in members:
+                        record = records_dict[m[1]]
+                        if m[0] != '+':
+                            record = krseq.reverse_complement(record)
+                        sequences.append((record.id, str(record.seq)))
+                else:
                     record = records_dict[members[0][1]]
-                    record = str(record.seq)
-                    for l in range(0, len(record)):
-                        column = record[l]
-                        column = column.upper()
-                        if handle_aln:
-                            handle_aln.write(column + '\n')
-                        counts = nucleotides_at_site(column)
-                        counts_str = (
-                            str(counts[0]) + '\t' +
-                            str(counts[1]) + '\t' +
-                            str(counts[2]) + '\t' +
-                            str(counts[3]) + '\n'
-                        )
-                        if handle_counts:
-                            handle_counts.write(counts_str)
-    # krcl.show_cursor()
+                    sequences.append((record.id, str(record.seq)))
+                batch.append((key, sequences))
+                if len(batch) == batch_size:
+                    yield(batch)
+                    batch = list()
+        if batch:
+            yield(batch)
+
+    aligned_clusters = kralign.align_sequences_batches(
+        batches(),
+        program=program,
+        options=options,
+        program_executable=program_executable,
+        processes=processes,
+        builtin_max_records=builtin_max_records,
+        builtin_max_length=builtin_max_length)
+
+    for key, aln in aligned_clusters:
+        if aln_clustal_phylip_file_path and len(aln) > 1:
+            ids = [x[0].split('_')[0] for x in aln]
+            if len(set(ids)) == len(ids):
+                alignments.append(MultipleSeqAlignment(
+                    [SeqRecord(Seq(x[1]), id=i, name='', description='')
+                     for i, x in zip(ids, aln)]))
+            else:
+                pass
+                # print('Warning: Multiple sequences from the same sample:', str(key)) ###
+        _write_alignment_columns_(
+            'CLUSTER_' + str(key), _alignment_matrix_([x[1] for x in aln]),
+            handle_aln, handle_counts, site_counts)
+
     if handle_aln:
         handle_aln.close()
     if handle_counts:
         handle_counts.close()
+    if site_counts:
+        site_counts.close()
 
     if aln_clustal_phylip_file_path:
         AlignIO.write(alignments, aln_clustal_phylip_file_path, "phylip-relaxed")
@@ -1208,8 +2474,193 @@ def align_clusters(min_seq_cluster, max_seq_cluster, uc_file_path,
     return(cluster_depths)
 
 
+# Site counts files ------------------------------------------------------------
+#
+# Nucleotide counts per alignment site of all clusters in a sample. A .npy
+# file with a uint32 array of shape (sites, 5), columns A C G T and other
+# (gaps and ambiguous residues), so it can be memory-mapped with numpy.load.
+# The index file (file_path + '.index') lists cluster name, first site and
+# number of sites of every cluster, tab separated.
+
+_NPY_MAGIC_ = b'\x93NUMPY'
+
+# Header is written when the number of sites is known, its size is fixed
+_SITE_COUNTS_HEADER_SIZE_ = 128
+
+
+def alignment_site_counts(matrix):
+
+    '''
+    Count A, C, G, T and other residues in every column of an uppercase
+    alignment matrix (uint8, a row per sequence). Returns a uint32 array of
+    shape (columns, 5).
+    '''
+
+    import numpy
+
+    counts = numpy.empty((matrix.shape[1], 5), dtype=numpy.uint32)
+    for i, nt in enumerate('ACGT'):
+        counts[:, i] = (matrix == ord(nt)).sum(axis=0)
+    counts[:, 4] = matrix.shape[0] - counts[:, 0:4].sum(axis=1)
+
+    return(counts)
+
+
+class SiteCountsWriter:
+
+    '''
+    Write a site counts file, one cluster at a time.
+    '''
+
+    def __init__(self, file_path):
+
+        self.file_path = file_path
+        self._handle = open(file_path, 'wb')
+        self._handle.write(b' ' * _SITE_COUNTS_HEADER_SIZE_)
+        self._index_handle = open(file_path + '.index', 'w')
+        self.sites = 0
+
+    def write(self, cluster_name, counts):
+
+        '''
+        Add counts of a cluster, an array of shape (sites, 5).
+        '''
+
+        import numpy
+
+        counts = numpy.ascontiguousarray(counts, dtype='<u4')
+        self._handle.write(counts.tobytes())
+        self._index_handle.write(cluster_name + '\t' + str(self.sites) +
+                                 '\t' + str(counts.shape[0]) + '\n')
+        self.sites = self.sites + counts.shape[0]
+
+    def close(self):
+
+        import struct
+
+        header = ("{'descr': '<u4', 'fortran_order': False, 'shape': (" +
+                  str(self.sites) + ", 5), }")
+        header = header.ljust(_SITE_COUNTS_HEADER_SIZE_ - 11) + '\n'
+        self._handle.seek(0)
+        self._handle.write(_NPY_MAGIC_ + b'\x01\x00' +
+                           struct.pack('<H', len(header)) + header)
+        self._handle.close()
+        self._index_handle.close()
+
+
+def is_site_counts_file(file_path):
+
+    with open(file_path, 'rb') as f:
+        magic = f.read(len(_NPY_MAGIC_))
+    return(magic == _NPY_MAGIC_)
+
+
+def read_site_counts(file_path):
+
+    '''
+    Read a site counts file. Returns a read-only memory-mapped array of
+    shape (sites, 5) and a list of (cluster name, first site, number of
+    sites).
+    '''
+
+    import os
+
+    import numpy
+
+    if os.path.getsize(file_path) > _SITE_COUNTS_HEADER_SIZE_:
+        counts = numpy.load(file_path, mmap_mode='r')
+    else:
+        counts = numpy.zeros((0, 5), dtype=numpy.uint32)
+
+    index = list()
+    with open(file_path + '.index', 'r') as f:
+        for l in f:
+            l = l.rstrip('\n').split('\t')
+            index.append((l[0], int(l[1]), int(l[2])))
+
+    return(counts, index)
+
+
+def _alignment_matrix_(sequences):
+
+    '''
+    Uppercase alignment matrix (uint8, a row per sequence) from a list of
+    aligned sequences.
+    '''
+
+    import numpy
+
+    return(numpy.frombuffer(''.join(sequences).upper(), dtype=numpy.uint8)
+           .reshape(len(sequences), -1))
+
+
+def _write_alignment_columns_(cluster_name, matrix, handle_aln=None,
+                              handle_counts=None, site_counts=None):
+
+    '''
+    Write columns of an uppercase alignment matrix to an .alignment file,
+    counts of A, C, G and T per column to a .counts file and a site counts
+    file (SiteCountsWriter).
+    '''
+
+    counts = alignment_site_counts(matrix)
+
+    if handle_aln:
+        handle_aln.write('>' + cluster_name + '\n')
+        handle_aln.write(''.join([x.tobytes() + '\n' for x in matrix.T]))
+    if handle_counts:
+        handle_counts.write('>' + cluster_name + '\n')
+        handle_counts.write(''.join(
+            ['\t'.join([str(y) for y in x]) + '\n'
+             for x in counts[:, 0:4].tolist()]))
+    if site_counts:
+        site_counts.write(cluster_name, counts)
+
+
+def _site_counts_from_file_(file_path, min_total_per_site=1,
+                            max_total_per_site=0, rettype='list'):
+
+    from collections import OrderedDict
+
+    import numpy
+
+    counts, index = read_site_counts(file_path)
+
+    totals = counts[:, 0:4].sum(axis=1)
+    keep = totals >= min_total_per_site
+    if max_total_per_site != 0:
+        keep = keep & (totals <= max_total_per_site)
+
+    if rettype == 'array':
+        return(numpy.array(counts[keep, 0:4]))
+
+    if rettype != 'dict':
+        return([tuple(x) for x in counts[keep, 0:4].tolist()])
+
+    # Sorted by cluster name, as keys of a trie
+    ret_value = OrderedDict()
+    for name, start, length in sorted(index):
+        end = start + length
+        ret_value[name] = [tuple(x) for x in
+                           counts[start:end][keep[start:end], 0:4].tolist()]
+
+    return(ret_value)
+
+
 def nt_freq(nt_counts_file):
+
+    '''
+    Nucleotide frequencies in a .counts file or a site counts file.
+    '''
+
     import krio
+
+    if is_site_counts_file(nt_counts_file):
+        counts = read_site_counts(nt_counts_file)[0]
+        totals = counts[:, 0:4].sum(axis=0, dtype='u8').tolist()
+        total = float(sum(totals))
+        return([x / total for x in totals])
+
     nt_counts = krio.read_table_file(
         path=nt_counts_file,
         has_headers=False,
@@ -1257,6 +2708,24 @@ def nt_freq(nt_counts_file):
 def nt_site_counts(nt_counts_file, min_total_per_site=1, max_total_per_site=0,
                    rettype='list'):
 
+    '''
+    Counts of A, C, G and T at sites with min_total_per_site to
+    max_total_per_site (0 - no limit) nucleotides in a .counts file or a
+    site counts file. Returns a list of count tuples, an array of shape
+    (sites, 4) if rettype is 'array', or if rettype is 'dict', lists of
+    count tuples keyed by cluster name.
+    '''
+
+    if is_site_counts_file(nt_counts_file):
+        return(_site_counts_from_file_(nt_counts_file, min_total_per_site,
+                                       max_total_per_site, rettype))
+
+    if rettype == 'array':
+        import numpy
+        ns = nt_site_counts(nt_counts_file, min_total_per_site,
+                            max_total_per_site, 'list')
+        return(numpy.array(ns, dtype=numpy.int64).reshape(-1, 4))
+
     # from Bio import trie  # ##
     import string  # ##
     import datrie  # ##
@@ -1428,6 +2897,121 @@ def like_homo_hetero(s, p, e, pi):
     return likelihood
 
 
+class SiteLikelihood:
+
+    '''
+        Negative natural log of the total likelihood (for multiple sites) of
+        observed data and its gradient, as in neg_ll_homo_hetero. Sites with
+        the same [A, C, G, T] counts are evaluated once, binomial
+        coefficients are computed once, so evaluating the likelihood for a
+        new e and pi is a few array operations. Diploid individual is
+        assumed. Lynch 2008.
+
+        parameters:
+            ns - counts of nucleotides at sites, a list of [A, C, G, T] lists
+                 or an array of shape (sites, 4)
+
+            p - average nucleotide frequencies in the region of analysis
+                 0  1  2  3
+                [A, C, G, T]
+    '''
+
+    def __init__(self, ns, p):
+
+        import numpy
+        from scipy.special import gammaln
+
+        ns = numpy.asarray(ns, dtype=numpy.int64).reshape(-1, 4)
+        s, self.multiplicity = numpy.unique(ns, axis=0, return_counts=True)
+        s = s.astype(numpy.float64)
+        n = s.sum(axis=1)[:, numpy.newaxis]
+        p = numpy.asarray(p, dtype=numpy.float64)
+
+        def log_comb(a, b):
+            return(gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1))
+
+        with numpy.errstate(divide='ignore'):
+            log_p = numpy.log(p)
+
+        # Homozygous: base i, all other bases are errors
+        self.homo_errors = n - s
+        self.homo_correct = s
+        self.homo_log_coef = log_p + log_comb(n, s)
+
+        # Heterozygous: bases i and j, all other bases are errors
+        i, j = numpy.triu_indices(4, 1)
+        s_i = s[:, i]
+        s_j = s[:, j]
+        big_s = 1.0 - (p * p).sum()
+        self.hetero_errors = n - s_i - s_j
+        self.hetero_correct = s_i + s_j
+        self.hetero_log_coef = (
+            numpy.log(2.0) + log_p[i] + log_p[j] - numpy.log(big_s) +
+            log_comb(n, self.hetero_errors) +
+            log_comb(s_i + s_j, s_i) - (s_i + s_j) * numpy.log(2.0))
+
+    def _log_terms_(self, e):
+
+        from scipy.special import xlogy, xlog1py
+
+        homo = (self.homo_log_coef + xlogy(self.homo_errors, e) +
+                xlog1py(self.homo_correct, -e))
+        q = 2.0 * e / 3.0
+        hetero = (self.hetero_log_coef + xlogy(self.hetero_errors, q) +
+                  xlog1py(self.hetero_correct, -q))
+
+        return(homo, hetero)
+
+    def neg_ll(self, e, pi, multiplicity=None):
+
+        return(self.neg_ll_and_gradient(e, pi, False, multiplicity)[0])
+
+    def neg_ll_and_gradient(self, e, pi, gradient=True, multiplicity=None):
+
+        '''
+            Returns the negative log likelihood and its gradient with respect
+            to (e, pi). Sites with zero likelihood are left out, as in
+            neg_ll_homo_hetero. multiplicity replaces the number of sites
+            with each configuration, so resampled sites are a reweighting.
+        '''
+
+        import numpy
+        from scipy.special import logsumexp
+
+        if (e > 1.0 or e < 0) or (pi > 1.0 or pi < 0):
+            return(float("inf"), numpy.zeros(2))
+
+        homo, hetero = self._log_terms_(e)
+        log_homo = logsumexp(homo, axis=1)
+        log_hetero = logsumexp(hetero, axis=1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ll = numpy.logaddexp(numpy.log(1.0 - pi) + log_homo,
+                                 numpy.log(pi) + log_hetero)
+            keep = numpy.isfinite(ll)
+            if multiplicity is None:
+                multiplicity = self.multiplicity
+            m = multiplicity[keep]
+            nll = -float((m * ll[keep]).sum())
+
+            if not gradient:
+                return(nll, None)
+
+            ll = ll[keep, numpy.newaxis]
+            q = 2.0 * e / 3.0
+            d_homo = (numpy.exp(homo[keep] - ll) *
+                      (self.homo_errors[keep] / e -
+                       self.homo_correct[keep] / (1.0 - e))).sum(axis=1)
+            d_hetero = (numpy.exp(hetero[keep] - ll) * (2.0 / 3.0) *
+                        (self.hetero_errors[keep] / q -
+                         self.hetero_correct[keep] / (1.0 - q))).sum(axis=1)
+            d_e = (1.0 - pi) * d_homo + pi * d_hetero
+            d_pi = (numpy.exp(log_hetero[keep] - ll[:, 0]) -
+                    numpy.exp(log_homo[keep] - ll[:, 0]))
+
+        return(nll, numpy.array([-(m * d_e).sum(), -(m * d_pi).sum()]))
+
+
 def neg_ll_homo_hetero(ns, p, e, pi):
 
     '''
@@ -1454,48 +3038,16 @@ def neg_ll_homo_hetero(ns, p, e, pi):
     if (e > 1.0 or e < 0) or (pi > 1.0 or pi < 0):
         return(float("inf"))
 
-    import numpy
-    ll = 0
-    # Keep track of [A, C, G, T] configurations to not repeat unnecessary
-    # calculations
-    s_log = list()
-    # repeats_found = 0
-    for s in ns:
-        # Check if this configuration has occured already
-        repeat = False
-        for sl in s_log:
-            if (
-                sl[0][0] == s[0] and
-                sl[0][1] == s[1] and
-                sl[0][2] == s[2] and
-                sl[0][3] == s[3]
-            ):
-                ll = ll + sl[1]
-                repeat = True
-                # repeats_found = repeats_found + 1
-                break
-
-        if not repeat:
-            l = like_homo_hetero(s, p, e, pi)
-            if l > 0:
-                nl = numpy.log(l)
-                ll = ll + nl
-                # print(ll)
-                s_log.append([s, nl])
-
-    ll = ll * (-1.0)
-    # print(ll)
-    # print('Repeat configurations:', len(s_log))
-    # print('Repeats:', repeats_found)
-    return(ll)
+    return(SiteLikelihood(ns, p).neg_ll(e, pi))
 
 
 def mle_e_and_pi(ns, p, e0, pi0):
 
     '''
-        Using neg_ll_homo_hetero, will produce a region-wide (could be whole
+        Using SiteLikelihood, will produce a region-wide (could be whole
         genome) maximum likelihood estimate of e (error rate) and pi
-        (nucleotide diversity).
+        (nucleotide diversity). Likelihood is maximized with L-BFGS-B using
+        the analytic gradient.
 
         parameters:
             ns - a list of lists of counts of nucleotides (for a given site) in
@@ -1509,38 +3061,222 @@ def mle_e_and_pi(ns, p, e0, pi0):
                 [A, C, G, T]
     '''
 
+    likelihood = SiteLikelihood(ns, p)
+
+    ret_value = _fit_e_and_pi_(likelihood, e0, pi0)
+
+    # print(ret_value)
+
+    return(ret_value)
+
+
+def _fit_e_and_pi_(likelihood, e0, pi0, multiplicity=None):
+
+    # Above e = 0.75 a read base tells nothing about the genotype, the
+    # likelihood rises again towards e = 1 (every read an error)
     from scipy import optimize
-    nll = lambda estimated, ns_l, p_l: (
-        neg_ll_homo_hetero(ns_l, p_l, estimated[0], estimated[1])
+
+    nll = lambda estimated: (
+        likelihood.neg_ll_and_gradient(estimated[0], estimated[1], True,
+                                       multiplicity)
     )
 
-    ml_est = optimize.fmin(
+    ml_est = optimize.fmin_l_bfgs_b(
         nll,
         x0=(e0, pi0),
-        args=(ns, p),
-        # xtol=0.0001,
-        # ftol=0.0001,
-        # maxiter=None,
-        # maxfun=None,
-        full_output=1,
-        disp=0
-        # retall=0,
-        # callback=None
+        bounds=((1E-10, 0.75), (1E-10, 0.99999))
     )
 
-    # ml_est = optimize.fmin_l_bfgs_b(
-    #     nll,
-    #     x0=(e0, pi0),
-    #     args=(ns, p),
-    #     bounds=((1E-10, 0.99999), (1E-10, 0.99999)),
-    #     approx_grad=True
-    # )
+    return([ml_est[0][0], ml_est[0][1], ml_est[1]])
 
-    ret_value = [ml_est[0][0], ml_est[0][1], ml_est[1]]
 
-    # print(ret_value)
+def mle_e_and_pi_bootstrap(ns, p, e0, pi0, replicates=100, confidence=0.95,
+                           seed=None):
 
-    return(ret_value)
+    '''
+        Maximum likelihood estimate of e and pi (as mle_e_and_pi) with
+        bootstrap confidence intervals. Each replicate resamples sites with
+        replacement, which is drawing new multiplicities of the unique site
+        configurations, and is fitted starting from the estimate. p is not
+        resampled.
+
+        Returns:
+            [e, pi, negll, e_low, e_high, pi_low, pi_high]
+    '''
+
+    import numpy
+
+    likelihood = SiteLikelihood(ns, p)
+
+    ret_value = _fit_e_and_pi_(likelihood, e0, pi0)
+
+    sites = likelihood.multiplicity.sum()
+
+    if replicates < 1 or sites == 0:
+        return(ret_value + [None, None, None, None])
+
+    random_state = numpy.random.RandomState(seed)
+    probabilities = likelihood.multiplicity / float(sites)
+
+    estimates = list()
+    for r in range(0, replicates):
+        multiplicity = random_state.multinomial(sites, probabilities)
+        estimates.append(_fit_e_and_pi_(likelihood, ret_value[0],
+                                        ret_value[1], multiplicity)[0:2])
+    estimates = numpy.array(estimates)
+
+    q = [50.0 * (1.0 - confidence), 100.0 - 50.0 * (1.0 - confidence)]
+    e_ci = numpy.percentile(estimates[:, 0], q).tolist()
+    pi_ci = numpy.percentile(estimates[:, 1], q).tolist()
+
+    return(ret_value + e_ci + pi_ci)
+
+
+class ConsensusCaller:
+
+    '''
+        Call consensus bases at many sites at once, as consensus_base does for
+        a single site. Probabilities are computed in log space, so sites of
+        any depth can be called. Results for each pair of counts of the two
+        most common bases are cached, a caller is made for a given e and pi.
+
+        Parameters as in consensus_base.
+    '''
+
+    def __init__(self, e, pi, p=0.95, low_quality_residue='N',
+                 min_total_per_site=4, max_total_per_site=1023):
+
+        self.e = e
+        self.pi = pi
+        self.p = p
+        self.low_quality_residue = low_quality_residue
+        self.min_total_per_site = min_total_per_site
+        self.max_total_per_site = max_total_per_site
+        # (k1, k2) -> (rel_prob, het)
+        self._cache = dict()
+
+    def _probabilities_(self, k1, k2):
+
+        '''
+            Relative probability of the most probable genotype and whether it
+            is heterozygous, for arrays of counts of the most common (k1) and
+            second most common (k2) base.
+        '''
+
+        import numpy
+        from scipy.special import gammaln, logsumexp, xlogy, xlog1py
+
+        k1 = numpy.asarray(k1, dtype=numpy.float64)
+        k2 = numpy.asarray(k2, dtype=numpy.float64)
+        n = k1 + k2
+
+        log_comb = gammaln(n + 1) - gammaln(k1 + 1) - gammaln(k2 + 1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            log_prior_het = numpy.log(self.pi)
+            log_prior_hom = numpy.log((1.0 - self.pi) / 2.0)
+
+            log_probs = numpy.empty((len(n), 3))
+            log_probs[:, 0] = log_comb - n * numpy.log(2.0) + log_prior_het
+            log_probs[:, 1] = (log_comb + xlogy(k1, self.e) +
+                               xlog1py(k2, -self.e) + log_prior_hom)
+            log_probs[:, 2] = (log_comb + xlogy(k2, self.e) +
+                               xlog1py(k1, -self.e) + log_prior_hom)
+
+            best = log_probs.argmax(axis=1)
+            rel_prob = numpy.exp(log_probs[numpy.arange(len(n)), best] -
+                                 logsumexp(log_probs, axis=1))
+
+        return(rel_prob, best == 0)
+
+    def call(self, ns):
+
+        '''
+            Call consensus at sites. ns is an array of shape (sites, 4) of
+            [A, C, G, T] counts. Returns a tuple of arrays: relative
+            probability, heterozygous, indexes of the two most common bases
+            and the consensus residue (uint8).
+        '''
+
+        import numpy
+
+        import kriupac
+
+        ns = numpy.asarray(ns).reshape(-1, 4)
+        sites = ns.shape[0]
+        rows = numpy.arange(sites)
+
+        # Two most common bases, ties go to the first base as with nlargest
+        common = numpy.argsort(-ns.astype(numpy.int64), axis=1,
+                               kind='mergesort')[:, 0:2]
+        k1 = ns[rows, common[:, 0]].astype(numpy.int64)
+        k2 = ns[rows, common[:, 1]].astype(numpy.int64)
+        n = k1 + k2
+
+        pairs, inverse = numpy.unique(
+            numpy.column_stack((k1, k2)).reshape(-1, 2), axis=0,
+            return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        missing = [i for i, x in enumerate(pairs.tolist())
+                   if tuple(x) not in self._cache]
+        if missing:
+            rel, het = self._probabilities_(pairs[missing, 0],
+                                            pairs[missing, 1])
+            for i, r, h in zip(missing, rel.tolist(), het.tolist()):
+                self._cache[tuple(pairs[i].tolist())] = (r, h)
+
+        cached = [self._cache[tuple(x)] for x in pairs.tolist()]
+        rel_prob = numpy.array([x[0] for x in cached])[inverse]
+        het = numpy.array([x[1] for x in cached], dtype=numpy.bool_)[inverse]
+
+        out = ((n < self.min_total_per_site) |
+               (n > self.max_total_per_site))
+        rel_prob[out] = 0
+        het[out] = False
+
+        # Residue for every pair of bases
+        bases = 'ACGT'
+        table = numpy.empty((4, 4), dtype=numpy.uint8)
+        for i in range(0, 4):
+            for j in range(0, 4):
+                if i == j:
+                    table[i, j] = ord(bases[i])
+                else:
+                    table[i, j] = ord(kriupac.IUPAC_DOUBLE_DNA_DICT[
+                        ''.join(sorted(bases[i] + bases[j]))])
+
+        consensus = numpy.where(het, table[common[:, 0], common[:, 1]],
+                                table[common[:, 0], common[:, 0]])
+        consensus[out | (rel_prob < self.p)] = ord(self.low_quality_residue)
+
+        return(rel_prob, het, common, consensus.astype(numpy.uint8))
+
+
+def consensus_from_site_counts(file_path, e, pi, p=0.95,
+                               low_quality_residue='N', min_total_per_site=4,
+                               max_total_per_site=1023):
+
+    '''
+        Call consensus sequences of all clusters in a site counts file in one
+        pass. Sites without A, C, G or T are skipped. Yields
+        (cluster name, consensus sequence) sorted by cluster name.
+    '''
+
+    counts, index = read_site_counts(file_path)
+    counts = counts[:, 0:4]
+
+    caller = ConsensusCaller(
+        e=e, pi=pi, p=p, low_quality_residue=low_quality_residue,
+        min_total_per_site=min_total_per_site,
+        max_total_per_site=max_total_per_site)
+
+    consensus = caller.call(counts)[3]
+    covered = counts.sum(axis=1) > 0
+
+    for name, start, length in sorted(index):
+        end = start + length
+        yield((name, consensus[start:end][covered[start:end]].tobytes()))
 
 
 def consensus_base(s, e, pi, p=0.95, low_quality_residue='N', min_total_per_site=4, max_total_per_site=1023):
@@ -1548,6 +3284,7 @@ def consensus_base(s, e, pi, p=0.95, low_quality_residue='N', min_total_per_site
     '''
         Given nucleotide counts (from multiple NextGen reads) at a site,
         determine if the site is heterozygous and return nucleotides present.
+        ConsensusCaller calls many sites at once.
 
         Parameters:
             s - A list of counts of nucleotides for a given site
@@ -1571,66 +3308,30 @@ def consensus_base(s, e, pi, p=0.95, low_quality_residue='N', min_total_per_site
             consensus - consensus base or ambiguity
     '''
 
-    from scipy import special
-    from scipy import stats
-    from heapq import nlargest
-
-    import kriupac
+    caller = ConsensusCaller(
+        e=e, pi=pi, p=p, low_quality_residue=low_quality_residue,
+        min_total_per_site=min_total_per_site,
+        max_total_per_site=max_total_per_site)
 
-    # Indexes of the two most common bases at the site
-    # TODO What happens if there are more than two common bases?
-    indexes = [0, 1, 2, 3]
-    common = nlargest(2, indexes, key=lambda i: s[i])
-
-    # print(common[0], common[1])
+    rel_prob, het, common, consensus = caller.call([s])
 
     bases = ['A', 'C', 'G', 'T']
-    b1 = bases[common[0]]
-    b2 = bases[common[1]]
-
-    # print(b1, b2)
-
-    k1 = s[common[0]]
-    k2 = s[common[1]]
-    n = s[common[0]] + s[common[1]]
+    b1 = bases[common[0, 0]]
+    b2 = bases[common[0, 1]]
+    rel_prob = float(rel_prob[0])
+    het = bool(het[0])
+    consensus = chr(consensus[0])
 
-    if (n < min_total_per_site) or (n > max_total_per_site):
-        ret_value = (0, False, (low_quality_residue, low_quality_residue), low_quality_residue)
-        return(ret_value)
-
-    # print(k1, k2, n)
-    # TODO: ERROR WHEN
-    # 550 474 1024
-
-    prob_het = special.binom(n, k1) / (2.0 ** n)
-    prob_hom_1 = stats.binom.pmf(k1, n, e)
-    prob_hom_2 = stats.binom.pmf(k2, n, e)
-
-    prior_het = pi
-    prior_hom = (1.0 - pi) / 2.0
-
-    prob_het = prob_het * prior_het
-    prob_hom_1 = prob_hom_1 * prior_hom
-    prob_hom_2 = prob_hom_2 * prior_hom
-
-    probs = [prob_het, prob_hom_1, prob_hom_2]
-    prob_max = max(probs)
-    rel_prob = prob_max / sum(probs)
+    n = s[common[0, 0]] + s[common[0, 1]]
 
     bases_at_site = (b1, b1)
-    consensus = b1
-
-    het = False
-    if probs.index(prob_max) == 0:
-        het = True
 
-    if rel_prob < p:
+    if ((n < min_total_per_site) or (n > max_total_per_site) or
+            (rel_prob < p)):
         bases_at_site = (low_quality_residue, low_quality_residue)
-        consensus = low_quality_residue
     elif het:
         bases_at_site = [b1, b2]
         bases_at_site.sort()
-        consensus = kriupac.IUPAC_DOUBLE_DNA_DICT[''.join(bases_at_site)]
 
     ret_value = (rel_prob, het, bases_at_site, consensus)
 
@@ -1,6 +1,10 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+# Binary edit format: a version byte followed by one run per edit.
+_EDITS_BINARY_VERSION = 1
+_EDIT_OPS = [str('equal'), str('replace'), str('insert'), str('delete')]
+
 
 def produce_edits(s1, s2):
     import Levenshtein
@@ -26,27 +30,20 @@ def produce_edits(s1, s2):
 
 
 def apply_edits(e, s):
-    import Levenshtein
 
-    # print(s[0:150])
+    # Same result as Levenshtein.apply_edit with the destination string
+    # rebuilt from the edits, but joined once instead of concatenated.
 
-    ocs = [x[0] for x in e]
-
-    s2 = ''
+    parts = list()
 
     for edit in e:
-        if edit[0][0] == b'equal':
-            start = edit[0][3]
-            stop = edit[0][4]
-            s2 = s2 + (stop-start) * '.'
+        ocs = edit[0]
+        if ocs[0] == b'equal':
+            parts.append(s[ocs[1]:ocs[2]])
         else:
-            s2 = s2 + edit[1] * edit[2]
+            parts.append(edit[1] * edit[2])
 
-    # print(s2[0:150])
-
-    edited = Levenshtein.apply_edit(ocs, unicode(s), unicode(s2))
-
-    # print(edited[0:150])
+    edited = ''.join(parts)
 
     return edited
 
@@ -77,6 +74,161 @@ def string_to_edits(edits_string):
     return edits
 
 
+def _write_varint(b, n):
+    while n > 0x7f:
+        b.append((n & 0x7f) | 0x80)
+        n = n >> 7
+    b.append(n)
+
+
+def _read_varint(b, p):
+    n = 0
+    shift = 0
+    while True:
+        byte = b[p]
+        p = p + 1
+        n = n | ((byte & 0x7f) << shift)
+        if byte < 0x80:
+            return (n, p)
+        shift = shift + 7
+
+
+# Flags in the first byte of a binary edit, after the opcode in bits 0-1.
+_EDIT_GAPS = 0x04  # does not start where the previous edit ended
+_EDIT_SAME_LENGTH = 0x08  # same length in the source and the destination
+_EDIT_EMPTY = 0x10  # no inserted string, repeat count 1
+_EDIT_FILL = 0x20  # one character repeated over the destination length
+
+
+def edits_to_bytes(e):
+
+    '''
+    Binary form of the edits: a version byte, then for every edit a byte
+    with the opcode and flags, varints for its length in the source and
+    (unless it is the same) in the destination, and the inserted string.
+
+    Levenshtein opcodes follow each other and insert either nothing, a run
+    of one character (gaps) or a short string, so most edits take two or
+    three bytes. Anything else is still stored exactly: gaps between edits
+    as zigzag varints, and the repeat count and string length as varints.
+    '''
+
+    b = bytearray()
+    b.append(_EDITS_BINARY_VERSION)
+
+    i_end = 0
+    j_end = 0
+
+    for edit in e:
+        ocs = edit[0]
+        k = bytearray(str(edit[1]))
+        c = int(edit[2])
+        i_len = ocs[2] - ocs[1]
+        j_len = ocs[4] - ocs[3]
+
+        flags = _EDIT_OPS.index(ocs[0])
+        if ocs[1] != i_end or ocs[3] != j_end:
+            flags = flags | _EDIT_GAPS
+        if i_len == j_len:
+            flags = flags | _EDIT_SAME_LENGTH
+        if not k and c == 1:
+            flags = flags | _EDIT_EMPTY
+        elif len(k) == 1 and c == j_len:
+            flags = flags | _EDIT_FILL
+        b.append(flags)
+
+        if flags & _EDIT_GAPS:
+            i_gap = ocs[1] - i_end
+            j_gap = ocs[3] - j_end
+            _write_varint(b, (i_gap << 1) ^ (i_gap >> 63))
+            _write_varint(b, (j_gap << 1) ^ (j_gap >> 63))
+        _write_varint(b, i_len)
+        if not flags & _EDIT_SAME_LENGTH:
+            _write_varint(b, j_len)
+        if flags & _EDIT_FILL:
+            b.extend(k)
+        elif not flags & _EDIT_EMPTY:
+            _write_varint(b, c)
+            _write_varint(b, len(k))
+            b.extend(k)
+
+        i_end = ocs[2]
+        j_end = ocs[4]
+
+    return bytes(b)
+
+
+def bytes_to_edits(edits_bytes):
+
+    '''
+    Reverse of edits_to_bytes. Returns the same edits as string_to_edits
+    does for the text form.
+    '''
+
+    b = bytearray(edits_bytes)
+
+    if not b or b[0] != _EDITS_BINARY_VERSION:
+        raise ValueError('Not a binary edit representation.')
+
+    edits = list()
+    append = edits.append
+
+    i1 = 0
+    j1 = 0
+    p = 1
+    size = len(b)
+
+    # Varints are read inline when they fit in one byte, which is most of
+    # them; this loop is where get_alignment spends its time.
+    while p < size:
+        flags = b[p]
+        p = p + 1
+
+        if flags & _EDIT_GAPS:
+            n, p = _read_varint(b, p)
+            i1 = i1 + ((n >> 1) ^ -(n & 1))
+            n, p = _read_varint(b, p)
+            j1 = j1 + ((n >> 1) ^ -(n & 1))
+
+        i_len = b[p]
+        p = p + 1
+        if i_len > 0x7f:
+            i_len, p = _read_varint(b, p - 1)
+
+        if flags & _EDIT_SAME_LENGTH:
+            j_len = i_len
+        else:
+            j_len = b[p]
+            p = p + 1
+            if j_len > 0x7f:
+                j_len, p = _read_varint(b, p - 1)
+
+        if flags & _EDIT_EMPTY:
+            k = str('')
+            c = 1
+        elif flags & _EDIT_FILL:
+            k = bytes(b[p:p + 1])
+            p = p + 1
+            c = j_len
+        else:
+            c, p = _read_varint(b, p)
+            k_len, p = _read_varint(b, p)
+            k = bytes(b[p:p + k_len])
+            p = p + k_len
+
+        i2 = i1 + i_len
+        j2 = j1 + j_len
+        append(((_EDIT_OPS[flags & 0x03], i1, i2, j1, j2), k, c))
+        i1 = i2
+        j1 = j2
+
+    return edits
+
+
+def is_binary_edits(edits_data):
+    return len(edits_data) > 0 and bytearray(edits_data[:1])[0] == _EDITS_BINARY_VERSION
+
+
 if __name__ == '__main__':
 
     # Tests
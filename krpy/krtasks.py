@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+# from __future__ import unicode_literals
+
+
+def _run_task_in_child_(task):
+
+    '''
+    Runs in the forked child process and never returns.
+    '''
+
+    import os
+    import sys
+    import traceback
+
+    status = 0
+    try:
+        task['function'](*task.get('args', ()))
+    except:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+
+def run_tasks(tasks, cores, log_func=None, log_file_path=None,
+              poll_interval=0.1):
+
+    '''
+    Run tasks in forked child processes, without using more than cores CPU
+    cores at a time.
+
+    tasks is a list of dictionaries with keys:
+        function - called in the child process as function(*args)
+        args - tuple of arguments, default ()
+        name - used in log messages and errors, default task number
+        cores - cores the task uses, for example the number of threads of
+            an external program it runs, default 1. A task that needs more
+            than cores runs alone.
+        size - tasks are started largest first, default 0
+
+    Because the children are forked, function can be a closure or any other
+    object that can not be pickled. Results have to be written to files or
+    to a multiprocessing.Manager object.
+
+    If a task fails, no further tasks are started, the running ones are
+    allowed to finish and RuntimeError is raised. If run_tasks itself is
+    interrupted, the running children are terminated.
+
+    Returns a list of (name, cores, wall time, CPU time) tuples in the
+    order the tasks finished. CPU time is the user and system time of the
+    child process and of any processes it started and waited for.
+    '''
+
+    import os
+    import sys
+    import time
+    import signal
+
+    def log(msg):
+        if log_func and log_file_path:
+            log_func(msg, log_file_path)
+
+    pending = list()
+    for i, task in enumerate(tasks):
+        pending.append((task.get('size', 0), i, task))
+    pending.sort(key=lambda x: (-x[0], x[1]))
+    pending = [x[1:] for x in pending]
+
+    # pid: (task, name, cores, start time)
+    running = dict()
+    used_cores = 0
+    failed = list()
+    times = list()
+
+    try:
+        while pending or running:
+            while pending and not failed:
+                i, task = pending[0]
+                task_cores = max(1, task.get('cores', 1))
+                if running and used_cores + task_cores > cores:
+                    break
+                pending.pop(0)
+                name = task.get('name', str(i))
+                # Buffered output would otherwise be written again by the
+                # child
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    _run_task_in_child_(task)
+                running[pid] = (task, name, task_cores, time.time())
+                used_cores = used_cores + task_cores
+
+            if failed and not running:
+                break
+
+            finished = False
+            for pid in list(running.keys()):
+                pid_done, status, rusage = os.wait4(pid, os.WNOHANG)
+                if pid_done == 0:
+                    continue
+                finished = True
+                task, name, task_cores, start = running.pop(pid)
+                used_cores = used_cores - task_cores
+                wall = time.time() - start
+                cpu = rusage.ru_utime + rusage.ru_stime
+                times.append((name, task_cores, wall, cpu))
+                log('Task ' + name + ': ' + str(task_cores) + ' cores, ' +
+                    '%.1f' % wall + ' s wall, ' + '%.1f' % cpu + ' s CPU.')
+                if not (os.WIFEXITED(status) and
+                        os.WEXITSTATUS(status) == 0):
+                    failed.append(name)
+
+            if not finished:
+                time.sleep(poll_interval)
+
+    except:
+        for pid in running.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        raise
+
+    if failed:
+        raise RuntimeError('Tasks failed: ' + ', '.join(failed))
+
+    return(times)
@@ -240,7 +240,6 @@ def regular_search(kr_seq_db_object, log_file_path, email, loci, locus_name, ncb
     from krpy import krother
     # from krpy import krncbi
     # from krpy import krbioio
-    from krpy import krcl
     from krpy.krother import write_log
 
     LOCI = loci
@@ -304,45 +303,15 @@ def regular_search(kr_seq_db_object, log_file_path, email, loci, locus_name, ncb
         msg = 'Adding downloaded records to database. This may take a bit.'
         write_log(msg, LFP)
 
-        record_count = len(records_to_add)
-
-        # DB._DB_CURSOR.execute('BEGIN TRANSACTION;')
-
-        for i, record in enumerate(records_to_add):
-
-            krcl.print_progress(
-                current=i+1, total=record_count, length=0,
-                prefix=krother.timestamp() + ' ',
-                postfix=' - ' + record.id,
-                show_bar=False)
-
-            DB.add_genbank_record(
-                record=record,
-                action_str='Genbank search result.')
-
-            gi = record.id
-
-            DB.add_record_annotation(
-                record_reference=gi,
-                type_str='locus',
-                annotation_str=locus_name,
-                record_reference_type='gi')
-
-            DB.add_record_annotation(
-                record_reference=gi,
-                type_str='locus_not_extracted',
-                annotation_str=locus_name,
-                record_reference_type='gi')
-
-            DB.add_record_annotation(
-                record_reference=gi,
-                type_str='source_file',
-                annotation_str=gb_file_name,
-                record_reference_type='gi')
-
-        # DB._DB_CURSOR.execute('END TRANSACTION;')
-
-        print()
+        DB.add_genbank_records(
+            records=records_to_add,
+            action_str='Genbank search result.',
+            annotations=[
+                ('locus', locus_name),
+                ('locus_not_extracted', locus_name),
+                ('source_file', gb_file_name)],
+            log_func=write_log,
+            log_file_path=LFP)
 
     DB.save()
 
@@ -31,19 +31,18 @@ if __name__ == '__main__':
     import random
     import shutil
 
-    from multiprocessing import Process
-    from multiprocessing import JoinableQueue
     from multiprocessing import Manager
 
     import numpy
 
     import datrie
 
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
     from Bio import AlignIO
 
     import krio
     import krbioio
+    import krmanifest
+    import krtasks
     import krnextgen
     import krusearch
     import kriupac
@@ -67,6 +66,10 @@ if __name__ == '__main__':
     parser.add_argument('--group', type=unicode,
                         help='Sample group to analyze.')
 
+    parser.add_argument('--force', default=False, action='store_true',
+                        help='Process all samples, even those that are up \
+                        to date.')
+
     # parser.add_argument('--output_dir', type=unicode,
     #                     help='Output directory path.')
 
@@ -179,6 +182,12 @@ if __name__ == '__main__':
         # Number of CPU cores -------------------------------------------------
         cpu = config.getint('General', 'max_cpu_cores_available')
 
+        # Exchange reads between steps as binary reads files (krbioio)
+        # instead of FASTQ
+        binary_reads_files = (
+            config.has_option('General', 'binary_reads_files') and
+            config.getboolean('General', 'binary_reads_files'))
+
         split_raw_fastq_output_dir = output_dir + '01-raw-fastq-parts' + ps
         dmltplx_output_dir_split = (output_dir +
                                     '02-demultiplexed-fastq-parts' + ps)
@@ -195,6 +204,44 @@ if __name__ == '__main__':
         analyzed_samples_output_dir = output_dir + '99-analyzed-samples' + ps
         krio.prepare_directory(analyzed_samples_output_dir)
 
+        # Samples whose input files, parameters and tool versions have not
+        # changed since a step last processed them are skipped by that step.
+        # Steps read the outputs of the previous steps, so a changed sample
+        # is processed again by every step that follows.
+        manifest = krmanifest.Manifest(output_dir + 'manifest.json')
+
+        def unit_is_current(step, unit, fingerprint):
+            if args.force or not manifest.is_current(step, unit, fingerprint):
+                return(False)
+            msg = (krother.timestamp() + ' - ' + step + ' ' + unit +
+                   ' is up to date, skipping.')
+            print(msg)
+            write_log(msg, lfp)
+            return(True)
+
+        def record_units(step, units):
+            for unit, fingerprint, output_file_paths in units:
+                manifest.record(step, unit, fingerprint, output_file_paths)
+            manifest.save()
+
+        # Steps run their tasks (mostly one per sample) in child processes,
+        # largest first, using at most cpu cores at a time. Wall and CPU times
+        # of the tasks are appended to task_times.tsv.
+        task_times_file_path = output_dir + 'task_times.tsv'
+
+        def run_step_tasks(step, tasks):
+            times = krtasks.run_tasks(
+                tasks=tasks,
+                cores=cpu,
+                log_func=write_log,
+                log_file_path=lfp)
+            handle = open(task_times_file_path, 'a')
+            for name, cores, wall, cpu_time in times:
+                handle.write('\t'.join([step, name, str(cores),
+                                        '%.2f' % wall, '%.2f' % cpu_time]) +
+                             '\n')
+            handle.close()
+
         # Group samples
         sample_groups_dict = dict()
         # sample_groups_dict = datrie.Trie(string.printable)
@@ -263,13 +310,20 @@ if __name__ == '__main__':
             f_file = config.get('General', 'forward_reads_file')
             r_file = config.get('General', 'reverse_reads_file')
 
+            # Write BGZF compressed pieces
+            compress_split_files = (
+                config.has_option('General', 'compress_split_files') and
+                config.getboolean('General', 'compress_split_files'))
+
             krbioio.split_fastq_file(
                 pieces=cpu,
                 output_dir=split_raw_fastq_output_dir,
                 forward_reads_file_path=f_file,
                 reverse_reads_file_path=r_file,
                 log_func=write_log,
-                log_file_path=lfp
+                log_file_path=lfp,
+                processes=cpu,
+                compress=compress_split_files
             )
 
             print()
@@ -290,30 +344,60 @@ if __name__ == '__main__':
             #     print('trim_extra is required.')
             #     sys.exit(1)
 
-            file_list = krio.parse_directory(split_raw_fastq_output_dir, '_')
-            file_list.sort(key=lambda x: x['name'], reverse=False)
-            reverse = False
-            for f in file_list:
-                if f['split'][0] == 'r':
-                    reverse = True
-                    break
+            trim_extra = len(config.get('General', 'f_sticky'))
 
-            processes = list()
-            queue = JoinableQueue()
+            # Streaming mode reads the raw FASTQ files directly, so the split
+            # step and combining of the demultiplexed parts are not needed.
+            streaming = (
+                config.has_option('Demultiplex', 'streaming') and
+                config.getboolean('Demultiplex', 'streaming'))
 
-            trim_extra = len(config.get('General', 'f_sticky'))
+            if streaming:
+
+                msg = (krother.timestamp() + ' - Demultiplexing raw reads using ' +
+                       str(cpu) + ' processes.')
+                print(msg)
+                write_log(msg, lfp)
+
+                reverse_reads_file_path = config.get('General', 'reverse_reads_file')
+                if not reverse_reads_file_path:
+                    reverse_reads_file_path = None
+
+                krnextgen.demultiplex_stream(
+                    barcodes=barcodes,
+                    forward_reads_file_path=config.get('General', 'forward_reads_file'),
+                    reverse_reads_file_path=reverse_reads_file_path,
+                    max_barcode_mismatch_count=config.getint(
+                        'Demultiplex',
+                        'max_bp_mismatch_in_barcode'),
+                    output_dir=dmltplx_output_dir_combined,
+                    trim_barcode=True,
+                    trim_extra=trim_extra,
+                    processes=cpu,
+                    file_format='binary' if binary_reads_files else 'fastq'
+                )
 
-            def t(q):
-                while True:
-                    f = q.get()
+            else:
+
+                file_list = krio.parse_directory(split_raw_fastq_output_dir, '_')
+                file_list.sort(key=lambda x: x['name'], reverse=False)
+                reverse = False
+                for f in file_list:
+                    if f['split'][0] == 'r':
+                        reverse = True
+                        break
+
+                def t(f):
+                    # Piece number, without .fastq of fastq.gz pieces
+                    piece = f['split'][1].split('.')[0]
                     # lock.acquire()
-                    msg = krother.timestamp() + ' - Demultiplexing File ' + f['split'][1]
+                    msg = krother.timestamp() + ' - Demultiplexing File ' + piece
                     print(msg)
                     write_log(msg, lfp)
                     # lock.release()
                     input_file_format = f['ext']
                     output_dir_split = (dmltplx_output_dir_split +
-                                        f['split'][1])
+                                        piece)
                     reverse_reads_file_path = None
                     if reverse:
                         reverse_reads_file_path = (
@@ -332,32 +416,32 @@ if __name__ == '__main__':
                         output_dir=output_dir_split,
                         trim_barcode=True,
                         trim_extra=trim_extra,
-                        write_every=1000
+                        write_every=1000,
+                        print_collisions=False
                     )
-                    q.task_done()
-
-            for f in file_list:
-                if f['split'][0] == 'f':
-                    queue.put(f)
 
-            for i in range(cpu):
-                # lock = Lock()
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+                # Once for the run, not once per split piece
+                krnextgen.print_barcode_collisions(
+                    barcodes=barcodes,
+                    max_barcode_mismatch_count=config.getint(
+                        'Demultiplex', 'max_bp_mismatch_in_barcode'))
 
-            queue.join()
+                tasks = list()
+                for f in file_list:
+                    if f['split'][0] == 'f':
+                        tasks.append({'name': f['name'], 'function': t,
+                                      'args': (f,),
+                                      'size': os.path.getsize(f['path'])})
 
-            for p in processes:
-                p.terminate()
+                run_step_tasks('demultiplex', tasks)
 
-            # Combine demultiplexed files
-            msg = '\nCombining demultiplexed results...'
-            print(msg)
-            write_log(msg, lfp)
-            krnextgen.combine_demultiplexed_results(
-                input_dir=dmltplx_output_dir_split,
-                output_dir=dmltplx_output_dir_combined)
+                # Combine demultiplexed files
+                msg = '\nCombining demultiplexed results...'
+                print(msg)
+                write_log(msg, lfp)
+                krnextgen.combine_demultiplexed_results(
+                    input_dir=dmltplx_output_dir_split,
+                    output_dir=dmltplx_output_dir_combined)
 
             # Produce read lengths files
             combined_file_list = krio.parse_directory(
@@ -369,13 +453,11 @@ if __name__ == '__main__':
             for f in combined_file_list:
                 if f['isdir']:
                     continue
-                handle = open(f['path'], "rU")
-                records = FastqGeneralIterator(handle)
+                records = krbioio.read_reads_file(f['path'])
                 # records = SeqIO.parse(f['path'], 'fastq')
                 lengths = list()
                 for r in records:
                     lengths.append(len(r[1]))
-                handle.close()
                 sample = 'Sample '
                 if f['split'][0] == 'Mismatch':
                     if not mismatch:
@@ -420,6 +502,106 @@ if __name__ == '__main__':
             print()
             write_log('', lfp)
 
+        # Demultiplex, mask and bin in a single pass --------------------------
+        # Replaces split, demultiplex, mask and bin. Intermediate FASTQ files
+        # are written only if requested.
+        if commands and ('process_reads' in commands):
+
+            write_intermediate_files = (
+                config.has_option('Process Reads', 'write_intermediate_files') and
+                config.getboolean('Process Reads', 'write_intermediate_files'))
+
+            reverse_reads_file_path = config.get('General', 'reverse_reads_file')
+            if not reverse_reads_file_path:
+                reverse_reads_file_path = None
+
+            # Sample group for every barcode
+            barcode_groups = dict()
+            for group in sample_groups_dict.keys():
+                for sample_name in sample_groups_dict[group]:
+                    for barcode in barcodes:
+                        if (barcode['id'].startswith(sample_name) and
+                                barcode['id'] not in barcode_groups):
+                            barcode_groups[barcode['id']] = group
+
+            def process_reads_output_file_path(barcode, kind):
+                direction = kind.split('_')[0]
+                if barcode is None:
+                    if kind.endswith('_lengths'):
+                        return(analyzed_samples_output_dir + 'Mismatch_' +
+                               direction + '.lengths')
+                    if write_intermediate_files and kind.endswith('_fastq'):
+                        return(dmltplx_output_dir_combined + 'Mismatch_' +
+                               direction + '.fastq')
+                    return(None)
+                sample = barcode['id']
+                if kind.endswith('_lengths'):
+                    return(analyzed_samples_output_dir + sample + '_' +
+                           direction + '.lengths')
+                if kind == 'binned':
+                    return(analyzed_samples_output_dir + sample + '.binned')
+                group = barcode_groups.get(sample, None)
+                if group is None:
+                    return(None)
+                fastq_name = (sample + '_' + barcode['barcode'] + '_' +
+                              direction + '.fastq')
+                if kind.endswith('_fastq'):
+                    if write_intermediate_files:
+                        return(dmltplx_output_dir_combined + group + ps +
+                               fastq_name)
+                    return(None)
+                if kind.endswith('_masked'):
+                    if write_intermediate_files:
+                        return(masked_output_dir + group + ps + fastq_name)
+                    return(None)
+                return(binned_output_dir + group + ps + sample + '_' + kind +
+                       '.fasta')
+
+            msg = (krother.timestamp() + ' - Demultiplexing, masking and ' +
+                   'binning raw reads using ' + str(cpu) + ' processes.')
+            print(msg)
+            write_log(msg, lfp)
+
+            read_counts = krnextgen.process_reads_stream(
+                barcodes=barcodes,
+                forward_reads_file_path=config.get('General', 'forward_reads_file'),
+                output_file_path=process_reads_output_file_path,
+                reverse_reads_file_path=reverse_reads_file_path,
+                max_barcode_mismatch_count=config.getint(
+                    'Demultiplex',
+                    'max_bp_mismatch_in_barcode'),
+                trim_extra=len(config.get('General', 'f_sticky')),
+                quality_score_treshold=config.getint(
+                    'Mask', 'quality_score_treshold'),
+                low_quality_residue=config.get(
+                    'General', 'low_quality_residue'),
+                barcode_adapter=config.get('General', 'barcode_adapter'),
+                f_sticky=config.get('General', 'f_sticky'),
+                r_oligo=(config.get('General', 'r_sticky') +
+                         config.get('General', 'common_adapter')),
+                max_prop_low_quality_sites=config.getfloat(
+                    'Bin', 'max_prop_low_quality_sites'),
+                min_overlap=config.getint('Bin', 'min_overlap'),
+                mmmr_cutoff=config.getfloat('Bin', 'mmmr_cutoff'),
+                concatenate=config.getboolean('Bin', 'concatenate'),
+                min_read_length=config.getint('Bin', 'min_read_length'),
+                debug=write_intermediate_files,
+                processes=cpu
+            )
+
+            for barcode, count in zip(barcodes + [{'id': 'Mismatch'}],
+                                      read_counts):
+                msg = 'Sample ' + barcode['id'] + ', ' + str(count) + ' reads.'
+                print(msg)
+                write_log(msg, lfp)
+
+            msg = krother.timestamp() + ' - Done.'
+            print(msg)
+            write_log(msg, lfp)
+
+            print()
+            write_log('', lfp)
+
         # Mask low quality sites ----------------------------------------------
         if commands and ('mask' in commands):
             if not args.group:
@@ -449,68 +631,92 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
-            processes = list()
-            queue = JoinableQueue()
-
-            def t(q):
-                while True:
-                    f = q.get()
-                    handle_r = open(f['path'], "rU")
+            def t(f):
 
-                    f_name = f['split'][0].split('_')
+                f_name = f['split'][0].split('_')
 
-                    msg = krother.timestamp() + ' - Sample ' + f_name[0] + ' ' + f_name[2].upper() + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
+                msg = krother.timestamp() + ' - Sample ' + f_name[0] + ' ' + f_name[2].upper() + ' starting...'
+                print(msg)
+                write_log(msg, lfp)
 
-                    # records = FastqPhredIterator(handle_r)
-                    records = FastqGeneralIterator(handle_r)
-                    # records = SeqIO.parse(f['path'], 'fastq')
-                    output_file_path = masked_output_dir_sample + f['full']
+                # records = FastqPhredIterator(handle_r)
+                records = krbioio.read_reads_file(f['path'])
+                # records = SeqIO.parse(f['path'], 'fastq')
+                output_file_path = masked_output_dir_sample + f['full']
+                binary = f['ext'] == 'krr'
+                if binary:
+                    handle_w = krbioio.BinaryReadsWriter(output_file_path)
+                else:
                     handle_w = open(output_file_path, 'w')
-                    for r in records:
-                        masked = krnextgen.mask_low_quality_sites(
-                            seq_str=r[1],
-                            qual_str=r[2],
-                            quality_score_treshold=(
-                                config.getint('Mask', 'quality_score_treshold')
-                            ),
-                            low_quality_residue=(
-                                config.get('General', 'low_quality_residue')))
-
-                        # SeqIO.write(
-                        #     sequences=r_masked,
-                        #     handle=handle,
-                        #     format='fastq'
-                        # )
-
-                        handle_w.write('@' + r[0] + '\n')
-                        handle_w.write(masked + '\n')
-                        handle_w.write('+\n')
-                        handle_w.write(r[2] + '\n')
-
-                    handle_r.close()
-                    handle_w.close()
-
-                    msg = krother.timestamp() + ' - Sample ' + f_name[0] + ' ' + f_name[2].upper() + ' done.'
-                    print(msg)
-                    write_log(msg, lfp)
 
-                    q.task_done()
+                quality_score_treshold = config.getint(
+                    'Mask', 'quality_score_treshold')
+                low_quality_residue = config.get(
+                    'General', 'low_quality_residue')
+
+                # Reads are masked in batches, one NumPy operation per
+                # batch
+                def write_masked(batch):
+                    masked = krnextgen.mask_low_quality_sites_batch(
+                        seq_strs=[x[1] for x in batch],
+                        qual_strs=[x[2] for x in batch],
+                        quality_score_treshold=quality_score_treshold,
+                        low_quality_residue=low_quality_residue)
+
+                    # SeqIO.write(
+                    #     sequences=r_masked,
+                    #     handle=handle,
+                    #     format='fastq'
+                    # )
+
+                    if binary:
+                        handle_w.write(
+                            [(r[0], m, r[2]) for r, m in zip(batch, masked)])
+                        return
+
+                    lines = list()
+                    for r, m in zip(batch, masked):
+                        lines.append(
+                            '@' + r[0] + '\n' + m + '\n+\n' + r[2] + '\n')
+                    handle_w.write(''.join(lines))
+
+                batch = list()
+                for r in records:
+                    batch.append(r)
+                    if len(batch) == 10000:
+                        write_masked(batch)
+                        batch = list()
+                write_masked(batch)
+
+                handle_w.close()
 
+                msg = krother.timestamp() + ' - Sample ' + f_name[0] + ' ' + f_name[2].upper() + ' done.'
+                print(msg)
+                write_log(msg, lfp)
+
+            mask_parameters = krmanifest.config_parameters(config, [
+                ('Mask', 'quality_score_treshold'),
+                ('General', 'low_quality_residue')])
+
+            units = list()
+            tasks = list()
             for f in file_list:
                 if 'Mismatch' not in f['name']:
-                    queue.put(f)
-
-            for i in range(cpu):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+                    unit = args.group + '/' + f['name']
+                    fingerprint = manifest.fingerprint(
+                        input_file_paths=[f['path']],
+                        parameters=mask_parameters)
+                    if unit_is_current('mask', unit, fingerprint):
+                        continue
+                    units.append((unit, fingerprint,
+                                  [masked_output_dir_sample + f['full']]))
+                    tasks.append({'name': f['name'], 'function': t,
+                                  'args': (f,),
+                                  'size': os.path.getsize(f['path'])})
 
-            queue.join()
+            run_step_tasks('mask', tasks)
 
-            for p in processes:
-                p.terminate()
+            record_units('mask', units)
 
             print()
             write_log('', lfp)
@@ -549,232 +755,92 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
-            processes = list()
-            queue = JoinableQueue()
-
-            def t(q):
-                while True:
-                    f = q.get()
-
-                    base_file_name = f['split'][0] + '_'
-                    # + f['split'][1] + '_'
-
-                    base_file_path = (masked_output_dir_sample + base_file_name +
-                                      f['split'][1] + '_')
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
-
-                    # f_records = SeqIO.parse(base_file_path + 'f.fastq', 'fastq')
-                    f_reads_handle = open(base_file_path + 'f.fastq', "rU")
-                    f_reads = FastqGeneralIterator(f_reads_handle)
-
-                    r_reads = None
-                    if os.path.exists(base_file_path + 'r.fastq'):
-                        # r_records = SeqIO.parse(base_file_path + 'r.fastq', 'fastq')
-                        r_reads_handle = open(base_file_path + 'r.fastq', "rU")
-                        r_reads = FastqGeneralIterator(r_reads_handle)
-
-                    ofp_f_hq = (binned_output_dir_sample + base_file_name +
-                                'f_hq.fasta')
-                    ofp_f_lq = (binned_output_dir_sample + base_file_name +
-                                'f_lq.fasta')
-
-                    ofp_r_hq = None
-                    ofp_r_lq = None
-
-                    if r_reads:
-                        ofp_r_hq = (binned_output_dir_sample + base_file_name +
-                                    'r_hq.fasta')
-                        ofp_r_lq = (binned_output_dir_sample + base_file_name +
-                                    'r_lq.fasta')
-
-                    ofp_all_hq = (binned_output_dir_sample + base_file_name +
-                                  'all_hq.fasta')
-
-                    handle_f_hq = open(ofp_f_hq, 'w')
-                    handle_f_lq = open(ofp_f_lq, 'w')
-
-                    handle_r_hq = None
-                    handle_r_lq = None
-
-                    if r_reads:
-                        handle_r_hq = open(ofp_r_hq, 'w')
-                        handle_r_lq = open(ofp_r_lq, 'w')
-
-                    handle_all_hq = open(ofp_all_hq, 'w')
-
-                    lengths_path = (analyzed_samples_output_dir +
-                                    f['split'][0] +  # '_' + f['split'][1] +
-                                    '.binned')
-                    handle_lengths = open(lengths_path, 'w')
-
-                    reads_string = (
-                        'fhq' + '\t' +
-                        'rhq' + '\t' +
-                        'cns' + '\t' +
-                        'msg' + '\t' +
-                        'flq' + '\t' +
-                        'rlq' + '\n')
-
-                    handle_lengths.write(reads_string)
-
-                    # Forward read oligo components
-                    # These can be found in overreaching reverse reads
-                    # barcode_adapter-barcode-f_sticky
-                    barcode_adapter = config.get('General', 'barcode_adapter')
-                    barcode = f['split'][1]
-                    f_sticky = config.get('General', 'f_sticky')
-                    f_oligo = barcode_adapter + barcode.upper() + f_sticky
-
-                    # Reverse read oligo components
-                    # These can be found in overreaching forward reads
-                    # r_sticky-common_adapter
-                    common_adapter = config.get('General', 'common_adapter')
-                    r_sticky = config.get('General', 'r_sticky')
-                    r_oligo = r_sticky + common_adapter
-
-                    max_prop_low_quality_sites = config.getfloat(
-                        'Bin', 'max_prop_low_quality_sites')
-                    min_overlap = config.getint('Bin', 'min_overlap')
-                    mmmr_cutoff = config.getfloat('Bin', 'mmmr_cutoff')
-                    concatenate = config.getboolean('Bin', 'concatenate')
-                    low_quality_residue = config.get(
-                        'General', 'low_quality_residue')
-                    min_read_length = config.getint('Bin', 'min_read_length')
-
-                    for f_title, f_seq, f_qual in f_reads:
-                        r_title = None
-                        r_seq = None
-                        r_qual = None
-                        if r_reads:
-                            r_title, r_seq, r_qual = r_reads.next()
-
-                        # print(concatenate)
-
-                        binned = krnextgen.bin_reads(
-                            title=f_title,
-                            f_seq_str=f_seq,
-                            r_seq_str=r_seq,
-                            max_prop_low_quality_sites=max_prop_low_quality_sites,
-                            min_overlap=min_overlap,
-                            mmmr_cutoff=mmmr_cutoff,
-                            concatenate=concatenate,
-                            low_quality_residue=low_quality_residue,
-                            f_oligo=f_oligo,
-                            r_oligo=r_oligo,
-                            min_read_length=min_read_length
-                        )
-
-                        f_hq = binned[0]
-                        r_hq = binned[1]
-                        f_seq = binned[2]
-                        r_seq = binned[3]
-                        consensus = binned[4]
-                        consensus_title = binned[5]
-                        consensus_message = binned[6]
-                        # cons_alignment = binned[7]
-
-                        # print(f_hq, f_seq)
-                        # print(r_hq, r_seq)
-
-                        # if cons_alignment and cons_alignment[0] > 0:
-                        #     print()
-                        #     print(cons_alignment[4][0] * ' ' + f_seq)
-                        #     print(cons_alignment[3][0] * ' ' + r_seq)
-
-                        # print(consensus)
-                        # print(consensus_message)
-                        # print('----------------------------------------------')
-
-                        str_fhq = ''
-                        str_rhq = ''
-                        str_cons = ''
-                        str_msg = str(consensus_message)
-                        str_flq = ''
-                        str_rlq = ''
-
-                        if f_hq:
-                            # SeqIO.write(sequences=fr, handle=handle_f_hq,
-                            #             format='fasta')
-                            handle_f_hq.write('>' + f_title + '\n' + f_seq + '\n')
-                            str_fhq = str(len(f_seq))
-                        else:
-                            # SeqIO.write(sequences=fr, handle=handle_f_lq,
-                            #             format='fasta')
-                            handle_f_lq.write('>' + f_title + '\n' + f_seq + '\n')
-                            str_flq = str(len(f_seq))
-
-                        if r_hq:
-                            # SeqIO.write(sequences=rr, handle=handle_r_hq,
-                            #             format='fasta')
-                            handle_r_hq.write('>' + r_title + '\n' + r_seq + '\n')
-                            str_rhq = str(len(r_seq))
-                        elif r_reads:
-                            # SeqIO.write(sequences=rr, handle=handle_r_lq,
-                            #             format='fasta')
-                            handle_r_lq.write('>' + r_title + '\n' + r_seq + '\n')
-                            str_rlq = str(len(r_seq))
-
-                        if f_hq and r_hq and consensus:
-                            # SeqIO.write(sequences=consensus,
-                            #             handle=handle_all_hq,
-                            #             format='fasta')
-                            handle_all_hq.write('>' + consensus_title + '\n' +
-                                                consensus + '\n')
-                            str_cons = str(len(consensus))
-
-                        if f_hq and not consensus:
-                            # SeqIO.write(sequences=fr, handle=handle_all_hq,
-                            #             format='fasta')
-                            handle_all_hq.write('>' + f_title + '\n' + f_seq + '\n')
-
-                        if r_hq and not consensus:
-                            # SeqIO.write(sequences=rr, handle=handle_all_hq,
-                            #             format='fasta')
-                            handle_all_hq.write('>' + r_title + '\n' + r_seq + '\n')
-
-                        reads_string = (
-                            str_fhq + '\t' +
-                            str_rhq + '\t' +
-                            str_cons + '\t' +
-                            str_msg + '\t' +
-                            str_flq + '\t' +
-                            str_rlq + '\n')
-
-                        handle_lengths.write(reads_string)
-
-                    handle_lengths.close()
-
-                    handle_f_hq.close()
-                    handle_f_lq.close()
-
-                    if r_reads:
-                        handle_r_hq.close()
-                        handle_r_lq.close()
-
-                    handle_all_hq.close()
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
-                    print(msg)
-                    write_log(msg, lfp)
-
-                    q.task_done()
-
+            # Forward read oligo components
+            # These can be found in overreaching reverse reads
+            # barcode_adapter-barcode-f_sticky
+            barcode_adapter = config.get('General', 'barcode_adapter')
+            f_sticky = config.get('General', 'f_sticky')
+
+            # Reverse read oligo components
+            # These can be found in overreaching forward reads
+            # r_sticky-common_adapter
+            common_adapter = config.get('General', 'common_adapter')
+            r_sticky = config.get('General', 'r_sticky')
+            r_oligo = r_sticky + common_adapter
+
+            bin_parameters = krmanifest.config_parameters(config, [
+                ('Bin', None),
+                ('General', 'barcode_adapter'),
+                ('General', 'f_sticky'),
+                ('General', 'r_sticky'),
+                ('General', 'common_adapter'),
+                ('General', 'low_quality_residue')])
+
+            samples = list()
             for f in file_list:
                 if f['name'] != 'Mismatch_f' and f['split'][-1] == 'f':
-                    queue.put(f)
-
-            for i in range(cpu):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
-
-            queue.join()
+                    base_file_path = (masked_output_dir_sample +
+                                      f['split'][0] + '_' +
+                                      f['split'][1] + '_')
+                    # FASTQ or binary reads files
+                    ext = '.' + f['ext']
+                    r_reads_file_path = None
+                    if os.path.exists(base_file_path + 'r' + ext):
+                        r_reads_file_path = base_file_path + 'r' + ext
+                    samples.append({
+                        'id': f['split'][0],
+                        'f_reads_file_path': base_file_path + 'f' + ext,
+                        'r_reads_file_path': r_reads_file_path,
+                        'f_oligo': (barcode_adapter + f['split'][1].upper() +
+                                    f_sticky)})
+
+            def bin_output_file_path(sample, kind):
+                if kind == 'binned':
+                    return(analyzed_samples_output_dir + sample['id'] +
+                           '.binned')
+                return(binned_output_dir_sample + sample['id'] + '_' + kind +
+                       '.fasta')
+
+            units = list()
+            stale_samples = list()
+            for sample in samples:
+                unit = args.group + '/' + sample['id']
+                input_file_paths = [sample['f_reads_file_path']]
+                if sample['r_reads_file_path']:
+                    input_file_paths.append(sample['r_reads_file_path'])
+                fingerprint = manifest.fingerprint(
+                    input_file_paths=input_file_paths,
+                    parameters=bin_parameters + [('f_oligo',
+                                                  sample['f_oligo'])])
+                if unit_is_current('bin', unit, fingerprint):
+                    continue
+                units.append((unit, fingerprint, [
+                    bin_output_file_path(sample, 'all_hq'),
+                    bin_output_file_path(sample, 'binned')]))
+                stale_samples.append(sample)
+            samples = stale_samples
+
+            # Samples are binned in chunks of read pairs by a pool of
+            # processes, so a few samples with many reads do not hold up the
+            # step
+            krnextgen.bin_reads_stream(
+                samples=samples,
+                output_file_path=bin_output_file_path,
+                r_oligo=r_oligo,
+                max_prop_low_quality_sites=config.getfloat(
+                    'Bin', 'max_prop_low_quality_sites'),
+                min_overlap=config.getint('Bin', 'min_overlap'),
+                mmmr_cutoff=config.getfloat('Bin', 'mmmr_cutoff'),
+                concatenate=config.getboolean('Bin', 'concatenate'),
+                low_quality_residue=config.get(
+                    'General', 'low_quality_residue'),
+                min_read_length=config.getint('Bin', 'min_read_length'),
+                processes=cpu,
+                log_func=write_log,
+                log_file_path=lfp
+            )
 
-            for p in processes:
-                p.terminate()
+            record_units('bin', units)
 
             print()
             write_log('', lfp)
@@ -1012,14 +1078,39 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
+            cluster_parameters = krmanifest.config_parameters(config, [
+                ('Cluster Within Samples', None)])
+            cluster_tools = [krmanifest.tool_version(
+                config.get('General', 'usearch_executable'), '-version')]
+
+            # usearch threads per sample, taken from the core budget
+            cluster_threads = 1
+            if config.has_option('Cluster Within Samples', 'threads'):
+                cluster_threads = config.getint('Cluster Within Samples',
+                                                'threads')
+
+            units = list()
+            stale_samples = set()
+
             # Sort files, this will take memory, so we will not parallelize
             # this
             for f in file_list:
                 if f['ext'] == 'fasta' and f['split'][-1] == 'hq' and f['split'][-2] == 'all':
+                    unit = args.group + '/' + f['split'][0]
+                    fingerprint = manifest.fingerprint(
+                        input_file_paths=[f['path']],
+                        parameters=cluster_parameters,
+                        tools=cluster_tools)
+                    if unit_is_current('cluster_samples', unit, fingerprint):
+                        continue
                     msg = krother.timestamp() + ' - Sample ' + f['split'][0]
                     print(msg)
                     write_log(msg, lfp)
                     ifp_split = os.path.splitext(f['path'])
+                    units.append((unit, fingerprint, [
+                        ifp_split[0] + '_sorted' + ifp_split[1],
+                        clustered_output_dir_sample + f['split'][0] + '.uc']))
+                    stale_samples.add(f['split'][0])
                     subprocess.call(
                         (config.get('General', 'usearch_executable') + ' -quiet' +
                             ' -sortbylength ' + f['path'] +
@@ -1037,122 +1128,113 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
-            processes = list()
-            queue = JoinableQueue()
+            def t(f):
+                # ifp_split = os.path.splitext(f['path'])
+                # input_file_path = ifp_split[0] + '_sorted' + ifp_split[1]
 
-            def t(q):
-                while True:
-                    f = q.get()
-                    # ifp_split = os.path.splitext(f['path'])
-                    # input_file_path = ifp_split[0] + '_sorted' + ifp_split[1]
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
+                print(msg)
+                write_log(msg, lfp)
 
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
+                first_uc = clustered_output_dir_sample + f['name'] + '_1_1_uc'
+                first_cons_path = clustered_output_dir_sample + f['name'] + '_1_2_cons'
 
-                    first_uc = clustered_output_dir_sample + f['name'] + '_1_1_uc'
-                    first_cons_path = clustered_output_dir_sample + f['name'] + '_1_2_cons'
-
-                    krusearch.cluster_file(
-                        input_file_path=f['path'],
-                        output_file_path=first_uc,
-                        identity_threshold=
-                        config.getfloat('Cluster Within Samples', 'identity_threshold'),
-                        consensus_file_path=first_cons_path,
-                        sorted_input=True,
-                        algorithm='smallmem',
-                        strand='both',
-                        threads=1,
-                        quiet=True,
-                        program=config.get('General', 'usearch_executable'),
-                        heuristics=config.getboolean('Cluster Within Samples', 'heuristics'),
-                        query_coverage=config.getfloat('Cluster Within Samples', 'query_coverage'),
-                        target_coverage=config.getfloat('Cluster Within Samples', 'target_coverage'),
-                        sizeout=True,
-                        sizein=False,
-                        usersort=False
-                    )
+                krusearch.cluster_file(
+                    input_file_path=f['path'],
+                    output_file_path=first_uc,
+                    identity_threshold=
+                    config.getfloat('Cluster Within Samples', 'identity_threshold'),
+                    consensus_file_path=first_cons_path,
+                    sorted_input=True,
+                    algorithm='smallmem',
+                    strand='both',
+                    threads=cluster_threads,
+                    quiet=True,
+                    program=config.get('General', 'usearch_executable'),
+                    heuristics=config.getboolean('Cluster Within Samples', 'heuristics'),
+                    query_coverage=config.getfloat('Cluster Within Samples', 'query_coverage'),
+                    target_coverage=config.getfloat('Cluster Within Samples', 'target_coverage'),
+                    sizeout=True,
+                    sizein=False,
+                    usersort=False
+                )
 
-                    subprocess.call(
-                        (config.get('General', 'usearch_executable') + ' -quiet' +
-                            ' -sortbysize ' + first_cons_path +
-                            ' -output ' + first_cons_path + '_sorted'), shell=True)
-
-                    second_uc = clustered_output_dir_sample + f['name'] + '_2_1_uc'
-
-                    krusearch.cluster_file(
-                        input_file_path=first_cons_path + '_sorted',
-                        output_file_path=second_uc,
-                        identity_threshold=
-                        config.getfloat('Cluster Within Samples', 'identity_threshold'),
-                        consensus_file_path=False,
-                        sorted_input=True,
-                        algorithm='smallmem',
-                        strand='both',
-                        threads=1,
-                        quiet=True,
-                        program=config.get('General', 'usearch_executable'),
-                        heuristics=False,
-                        query_coverage=config.getfloat('Cluster Within Samples', 'query_coverage'),
-                        target_coverage=config.getfloat('Cluster Within Samples', 'target_coverage'),
-                        sizeout=True,
-                        sizein=True,
-                        usersort=True
-                    )
+                subprocess.call(
+                    (config.get('General', 'usearch_executable') + ' -quiet' +
+                        ' -sortbysize ' + first_cons_path +
+                        ' -output ' + first_cons_path + '_sorted'), shell=True)
 
-                    # Produce a final cluster file
-
-                    final_uc = clustered_output_dir_sample + f['split'][0] + '.uc'
-                    first_dict = krusearch.parse_uc_file(first_uc, 'centroid')
-                    second_dict = krusearch.parse_uc_file(second_uc, 'centroid')
-                    new_dict = datrie.Trie(string.printable)
-
-                    for k2 in second_dict.keys():
-                        cluster2 = second_dict[k2]
-                        centroid = unicode(cluster2[0][1].split('=')[1].split(';')[0])
-                        # print(centroid)
-                        if len(cluster2) > 1:
-                            for i2, r2 in enumerate(cluster2):
-                                if i2 == 0:
-                                    new_dict[centroid] = first_dict[centroid]
-                                    # print(i2, centroid)
-                                else:
-                                    minor_centroid = unicode(r2[1].split('=')[1].split(';')[0])
-                                    if r2[0] == '-':
-                                        for mr in first_dict[minor_centroid]:
-                                            if mr[0] == '-':
-                                                mr[0] = '+'
-                                            else:
-                                                mr[0] = '-'
-                                    new_dict[centroid] = new_dict[centroid] + first_dict[minor_centroid]
-                                    # print(i2, minor_centroid)
-                            # print('--- --- ---')
-                        else:
-                            new_dict[centroid] = first_dict[centroid]
-
-                    krusearch.write_uc_file(new_dict, final_uc)
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
-                    print(msg)
-                    write_log(msg, lfp)
+                second_uc = clustered_output_dir_sample + f['name'] + '_2_1_uc'
+
+                krusearch.cluster_file(
+                    input_file_path=first_cons_path + '_sorted',
+                    output_file_path=second_uc,
+                    identity_threshold=
+                    config.getfloat('Cluster Within Samples', 'identity_threshold'),
+                    consensus_file_path=False,
+                    sorted_input=True,
+                    algorithm='smallmem',
+                    strand='both',
+                    threads=cluster_threads,
+                    quiet=True,
+                    program=config.get('General', 'usearch_executable'),
+                    heuristics=False,
+                    query_coverage=config.getfloat('Cluster Within Samples', 'query_coverage'),
+                    target_coverage=config.getfloat('Cluster Within Samples', 'target_coverage'),
+                    sizeout=True,
+                    sizein=True,
+                    usersort=True
+                )
 
-                    q.task_done()
+                # Produce a final cluster file
+
+                final_uc = clustered_output_dir_sample + f['split'][0] + '.uc'
+                first_dict = krusearch.parse_uc_file(first_uc, 'centroid')
+                second_dict = krusearch.parse_uc_file(second_uc, 'centroid')
+                new_dict = datrie.Trie(string.printable)
+
+                for k2 in second_dict.keys():
+                    cluster2 = second_dict[k2]
+                    centroid = unicode(cluster2[0][1].split('=')[1].split(';')[0])
+                    # print(centroid)
+                    if len(cluster2) > 1:
+                        for i2, r2 in enumerate(cluster2):
+                            if i2 == 0:
+                                new_dict[centroid] = first_dict[centroid]
+                                # print(i2, centroid)
+                            else:
+                                minor_centroid = unicode(r2[1].split('=')[1].split(';')[0])
+                                if r2[0] == '-':
+                                    for mr in first_dict[minor_centroid]:
+                                        if mr[0] == '-':
+                                            mr[0] = '+'
+                                        else:
+                                            mr[0] = '-'
+                                new_dict[centroid] = new_dict[centroid] + first_dict[minor_centroid]
+                                # print(i2, minor_centroid)
+                        # print('--- --- ---')
+                    else:
+                        new_dict[centroid] = first_dict[centroid]
 
+                krusearch.write_uc_file(new_dict, final_uc)
+
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
+                print(msg)
+                write_log(msg, lfp)
+
+            tasks = list()
             for f in file_list:
                 if (f['split'][-1] == 'sorted' and
                     f['split'][-2] == 'hq' and
-                        f['split'][-3] == 'all'):
-                    queue.put(f)
-
-            for i in range(cpu):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+                        f['split'][-3] == 'all' and
+                        f['split'][0] in stale_samples):
+                    tasks.append({'name': f['split'][0], 'function': t,
+                                  'args': (f,), 'cores': cluster_threads,
+                                  'size': os.path.getsize(f['path'])})
 
-            queue.join()
+            run_step_tasks('cluster_samples', tasks)
 
-            for p in processes:
-                p.terminate()
+            record_units('cluster_samples', units)
 
             print()
             write_log('', lfp)
@@ -1217,108 +1299,153 @@ if __name__ == '__main__':
             else:
                 file_list = krio.parse_directory(clustered_output_dir_sample, '_')
 
-            processes = list()
-            queue = JoinableQueue()
-
             aln_program = config.get('Align Within Samples', 'program')
             aln_program_exe = config.get('General', aln_program + '_executable')
             aln_program_options = config.get('Align Within Samples', 'options')
 
-            def t(q):
-                while True:
-                    f = q.get()
-                    fasta_file_path = binned_output_dir_sample + f['name'] + '_all_hq.fasta'
-                    aln_output_file_path = (
-                        sample_alignments_output_dir_sample +
-                        f['name'] + '.alignment')
-                    counts_output_file_path = (
-                        sample_alignments_output_dir_sample +
-                        f['name'] + '.counts')
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
+            # Aligner processes per sample, taken from the core budget. Only
+            # clusters from .uc files are aligned in parallel,
+            # alignments_from_sam_file runs in one process.
+            align_processes = 1
+            if (config.has_option('Align Within Samples', 'processes') and
+                    not groups_map_ref_loci_dict[args.group]):
+                align_processes = config.getint('Align Within Samples',
+                                                'processes')
+
+            # Align small clusters without starting the alignment program
+            builtin_max_records = 0
+            if config.has_option('Align Within Samples', 'builtin_max_records'):
+                builtin_max_records = config.getint('Align Within Samples',
+                                                    'builtin_max_records')
+            builtin_max_length = 300
+            if config.has_option('Align Within Samples', 'builtin_max_length'):
+                builtin_max_length = config.getint('Align Within Samples',
+                                                   'builtin_max_length')
+
+            def t(f):
+                fasta_file_path = binned_output_dir_sample + f['name'] + '_all_hq.fasta'
+                aln_output_file_path = (
+                    sample_alignments_output_dir_sample +
+                    f['name'] + '.alignment')
+                # Nucleotide counts per site, memory-mapped by the
+                # analyze_samples and consensus steps
+                site_counts_file_path = (
+                    sample_alignments_output_dir_sample +
+                    f['name'] + '.sitecounts')
+
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
+                print(msg)
+                write_log(msg, lfp)
 
-                    cluster_depths = None
-
-                    if groups_map_ref_loci_dict[args.group] == False:
-
-                        cluster_depths = krnextgen.align_clusters(
-                            min_seq_cluster=config.getint('Align Within Samples',
-                                                          'min_seq_cluster'),
-                            max_seq_cluster=config.getint('Align Within Samples',
-                                                          'max_seq_cluster'),
-                            uc_file_path=f['path'],
-                            fasta_file_path=fasta_file_path,
-                            aln_output_file_path=aln_output_file_path,
-                            counts_output_file_path=counts_output_file_path,
-                            program=aln_program,
-                            options=aln_program_options,
-                            # options='--retree 1 --thread '+str(cpu)
-                            program_executable=aln_program_exe
-                        )
+                cluster_depths = None
 
-                    else:
+                if groups_map_ref_loci_dict[args.group] == False:
 
-                        cluster_depths = krnextgen.alignments_from_sam_file(
-                            min_seq_cluster=config.getint('Align Within Samples',
-                                                          'min_seq_cluster'),
-                            # max_seq_cluster=0,
-                            max_seq_cluster=config.getint('Align Within Samples',
-                                                          'max_seq_cluster'),
-                            sam_file_path=f['path'],
-                            aln_output_file_path=aln_output_file_path,
-                            counts_output_file_path=counts_output_file_path,
-                            program=aln_program,
-                            options=aln_program_options,
-                            program_executable=aln_program_exe
-                        )
-
-                    handle = open((analyzed_samples_output_dir +
-                                   f['split'][0] +
-                                   #  '_' + f['split'][1] +
-                                   '.clusters'), 'wb')
-                    for c in cluster_depths:
-                        handle.write(str(c) + '\n')
-                    handle.close()
-
-                    ns = krnextgen.nt_site_counts(counts_output_file_path, 1, 0)
-                    coverage_list = [sum(x) for x in ns]
-                    handle = open((analyzed_samples_output_dir +
-                                   f['split'][0] +
-                                   #  '_' + f['split'][1] +
-                                   '.coverage'), 'wb')
-                    for c in coverage_list:
-                        handle.write(str(c) + '\n')
-                    handle.close()
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
-                    print(msg)
-                    write_log(msg, lfp)
+                    cluster_depths = krnextgen.align_clusters(
+                        min_seq_cluster=config.getint('Align Within Samples',
+                                                      'min_seq_cluster'),
+                        max_seq_cluster=config.getint('Align Within Samples',
+                                                      'max_seq_cluster'),
+                        uc_file_path=f['path'],
+                        fasta_file_path=fasta_file_path,
+                        aln_output_file_path=aln_output_file_path,
+                        site_counts_file_path=site_counts_file_path,
+                        program=aln_program,
+                        options=aln_program_options,
+                        # options='--retree 1 --thread '+str(cpu)
+                        program_executable=aln_program_exe,
+                        processes=align_processes,
+                        builtin_max_records=builtin_max_records,
+                        builtin_max_length=builtin_max_length
+                    )
+
+                else:
+
+                    # Minimum overlap between neighbouring reads of a
+                    # locus
+                    overlap_threshold = 40
+                    if config.has_option('Align Within Samples',
+                                         'locus_overlap_threshold'):
+                        overlap_threshold = config.getint(
+                            'Align Within Samples',
+                            'locus_overlap_threshold')
+
+                    cluster_depths = krnextgen.alignments_from_sam_file(
+                        min_seq_cluster=config.getint('Align Within Samples',
+                                                      'min_seq_cluster'),
+                        # max_seq_cluster=0,
+                        max_seq_cluster=config.getint('Align Within Samples',
+                                                      'max_seq_cluster'),
+                        sam_file_path=f['path'],
+                        aln_output_file_path=aln_output_file_path,
+                        site_counts_file_path=site_counts_file_path,
+                        program=aln_program,
+                        options=aln_program_options,
+                        program_executable=aln_program_exe,
+                        overlap_threshold=overlap_threshold,
+                        temp_dir=sample_alignments_output_dir_sample,
+                        builtin_max_records=builtin_max_records,
+                        builtin_max_length=builtin_max_length
+                    )
+
+                handle = open((analyzed_samples_output_dir +
+                               f['split'][0] +
+                               #  '_' + f['split'][1] +
+                               '.clusters'), 'wb')
+                for c in cluster_depths:
+                    handle.write(str(c) + '\n')
+                handle.close()
+
+                ns = krnextgen.nt_site_counts(site_counts_file_path, 1, 0)
+                coverage_list = [sum(x) for x in ns]
+                handle = open((analyzed_samples_output_dir +
+                               f['split'][0] +
+                               #  '_' + f['split'][1] +
+                               '.coverage'), 'wb')
+                for c in coverage_list:
+                    handle.write(str(c) + '\n')
+                handle.close()
 
-                    q.task_done()
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
+                print(msg)
+                write_log(msg, lfp)
+
+            align_parameters = krmanifest.config_parameters(config, [
+                ('Align Within Samples', None)])
+            align_tools = [krmanifest.tool_version(aln_program_exe)]
 
+            units = list()
+            tasks = list()
             for f in file_list:
                 if groups_map_ref_loci_dict[args.group] == False:
-                    if f['ext'] == 'uc':
-                        queue.put(f)
+                    if f['ext'] != 'uc':
+                        continue
+                    input_file_paths = [
+                        f['path'],
+                        binned_output_dir_sample + f['name'] + '_all_hq.fasta']
                 else:
-                    if f['ext'] == 'sam' and f['split'][-1] == 'hq' and f['split'][-2] == 'all':
-                        queue.put(f)
-
-            threads_local = cpu
-            # if aln_program == 'muscle':
-            #     threads_local = cpu * 2
-
-            for i in range(threads_local):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+                    if not (f['ext'] == 'sam' and f['split'][-1] == 'hq' and f['split'][-2] == 'all'):
+                        continue
+                    input_file_paths = [f['path']]
+                unit = args.group + '/' + f['split'][0]
+                fingerprint = manifest.fingerprint(
+                    input_file_paths=input_file_paths,
+                    parameters=align_parameters,
+                    tools=align_tools)
+                if unit_is_current('align_samples', unit, fingerprint):
+                    continue
+                units.append((unit, fingerprint, [
+                    sample_alignments_output_dir_sample + f['name'] + '.alignment',
+                    sample_alignments_output_dir_sample + f['name'] + '.sitecounts',
+                    analyzed_samples_output_dir + f['split'][0] + '.clusters',
+                    analyzed_samples_output_dir + f['split'][0] + '.coverage']))
+                tasks.append({'name': f['split'][0], 'function': t,
+                              'args': (f,), 'cores': align_processes,
+                              'size': os.path.getsize(f['path'])})
 
-            queue.join()
+            run_step_tasks('align_samples', tasks)
 
-            for p in processes:
-                p.terminate()
+            record_units('align_samples', units)
 
             print()
             write_log('', lfp)
@@ -1407,45 +1534,53 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
+            # Bootstrap replicates for the e and pi confidence intervals.
+            bootstrap_replicates = 100
+            if config.has_option('e and pi', 'bootstrap_replicates'):
+                bootstrap_replicates = config.getint('e and pi',
+                                                     'bootstrap_replicates')
+
             manager = Manager()
             results = manager.list()
 
-            processes = list()
-            queue = JoinableQueue()
-
-            def t(q):
-                while True:
-                    q_input = q.get()
-                    f = q_input[0]
-                    results = q_input[1]
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
-                    p = krnextgen.nt_freq(f['path'])
-                    # print(f['split'][0], p)
-                    ns = krnextgen.nt_site_counts(
-                        f['path'],
-                        config.getint('e and pi', 'min_seq_cluster'),
-                        config.getint('e and pi', 'max_seq_cluster'))
-                    mle = krnextgen.mle_e_and_pi(
-                        ns=ns,
-                        p=p,
-                        e0=config.getfloat('e and pi', 'error_rate_initial'),
-                        pi0=config.getfloat('e and pi',
-                                            'heterozygosity_initial'))
-
-                    results_dict = dict()
-                    # results_dict = datrie.Trie(string.printable)
-
-                    results_dict['sample'] = str(f['split'][0])
-                    # results_dict['barcode'] = str(f['split'][1])
-                    results_dict['fA'] = p[0]
-                    results_dict['fC'] = p[1]
-                    results_dict['fG'] = p[2]
-                    results_dict['fT'] = p[3]
-                    results_dict['e'] = mle[0]
-                    results_dict['pi'] = mle[1]
-                    results_dict['negll'] = mle[2]
+            def t(f, results):
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
+                print(msg)
+                write_log(msg, lfp)
+                p = krnextgen.nt_freq(f['path'])
+                # print(f['split'][0], p)
+                ns = krnextgen.nt_site_counts(
+                    f['path'],
+                    config.getint('e and pi', 'min_seq_cluster'),
+                    config.getint('e and pi', 'max_seq_cluster'),
+                    rettype='array')
+                mle = krnextgen.mle_e_and_pi_bootstrap(
+                    ns=ns,
+                    p=p,
+                    e0=config.getfloat('e and pi', 'error_rate_initial'),
+                    pi0=config.getfloat('e and pi',
+                                        'heterozygosity_initial'),
+                    replicates=bootstrap_replicates,
+                    seed=config.getint('General', 'random_seed'))
+
+                results_dict = dict()
+                # results_dict = datrie.Trie(string.printable)
+
+                results_dict['sample'] = str(f['split'][0])
+                # results_dict['barcode'] = str(f['split'][1])
+                results_dict['fA'] = p[0]
+                results_dict['fC'] = p[1]
+                results_dict['fG'] = p[2]
+                results_dict['fT'] = p[3]
+                results_dict['e'] = mle[0]
+                results_dict['pi'] = mle[1]
+                results_dict['negll'] = mle[2]
+                for i, k in enumerate(['e_low', 'e_high', 'pi_low',
+                                       'pi_high']):
+                    if mle[3 + i] is None:
+                        results_dict[k] = ''
+                    else:
+                        results_dict[k] = mle[3 + i]
 
 #                     # rps = float(sum(coverage_list)) / float(len(coverage_list))
 #                     # results_dict['rps'] = rps
@@ -1463,16 +1598,16 @@ if __name__ == '__main__':
 #                     # results_dict['rpc'] = rpc
 #                     # results_dict['clusters'] = len(cluster_list)
 
-                    handle = open((analyzed_samples_output_dir +
-                                   results_dict['sample'] +
-                                   # '_' +
-                                   # results_dict['barcode'] +
-                                   '.stats'), 'wb')
+                handle = open((analyzed_samples_output_dir +
+                               results_dict['sample'] +
+                               # '_' +
+                               # results_dict['barcode'] +
+                               '.stats'), 'wb')
 
-                    handle.write('sample\t' + str(results_dict['sample']) +
-                                 '\n')
-                    # handle.write('barcode\t' + str(results_dict['barcode']) +
-                                 # '\n')
+                handle.write('sample\t' + str(results_dict['sample']) +
+                             '\n')
+                # handle.write('barcode\t' + str(results_dict['barcode']) +
+                             # '\n')
 #                     # reads per cluster (rpc)
 #                     # handle.write('rpc\t' + str(rpc) + '\n')
 #                     # handle.write('clusters\t' +
@@ -1480,41 +1615,66 @@ if __name__ == '__main__':
 #                     # reads per site (rps)
 #                     # handle.write('rps\t' + str(rps) + '\n')
 #                     # handle.write('sites\t' + str(results_dict['sites']) + '\n')
-                    handle.write('fA\t' + str(results_dict['fA']) + '\n')
-                    handle.write('fC\t' + str(results_dict['fC']) + '\n')
-                    handle.write('fG\t' + str(results_dict['fG']) + '\n')
-                    handle.write('fT\t' + str(results_dict['fT']) + '\n')
-                    handle.write('e\t' + str(results_dict['e']) + '\n')
-                    handle.write('pi\t' + str(results_dict['pi']) + '\n')
-                    handle.write('negll\t' + str(results_dict['negll']) + '\n')
+                handle.write('fA\t' + str(results_dict['fA']) + '\n')
+                handle.write('fC\t' + str(results_dict['fC']) + '\n')
+                handle.write('fG\t' + str(results_dict['fG']) + '\n')
+                handle.write('fT\t' + str(results_dict['fT']) + '\n')
+                handle.write('e\t' + str(results_dict['e']) + '\n')
+                handle.write('pi\t' + str(results_dict['pi']) + '\n')
+                handle.write('negll\t' + str(results_dict['negll']) + '\n')
+                handle.write('e_low\t' + str(results_dict['e_low']) + '\n')
+                handle.write('e_high\t' + str(results_dict['e_high']) + '\n')
+                handle.write('pi_low\t' + str(results_dict['pi_low']) + '\n')
+                handle.write('pi_high\t' + str(results_dict['pi_high']) + '\n')
 
-                    handle.close()
+                handle.close()
 
-                    results.append(results_dict)
+                results.append(results_dict)
 
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done: e=' + str(results_dict['e']) + ', pi=' + str(results_dict['pi'])
-                    print(msg)
-                    write_log(msg, lfp)
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done: e=' + str(results_dict['e']) + ', pi=' + str(results_dict['pi'])
+                print(msg)
+                write_log(msg, lfp)
 
-                    q.task_done()
+            analyze_parameters = krmanifest.config_parameters(config, [
+                ('e and pi', None),
+                ('General', 'random_seed')])
 
+            units = list()
+            tasks = list()
+            # Statistics of up to date samples are read from their .stats
+            # files
+            current_stats_paths = list()
             for f in file_list:
-                if f['ext'] == 'counts':
-                    queue.put([f, results])
-
-            for i in range(cpu):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+                if f['ext'] == 'sitecounts':
+                    unit = args.group + '/' + f['split'][0]
+                    stats_path = (analyzed_samples_output_dir +
+                                  str(f['split'][0]) + '.stats')
+                    fingerprint = manifest.fingerprint(
+                        input_file_paths=[f['path']],
+                        parameters=analyze_parameters)
+                    if unit_is_current('analyze_samples', unit, fingerprint):
+                        current_stats_paths.append(stats_path)
+                        continue
+                    units.append((unit, fingerprint, [stats_path]))
+                    tasks.append({'name': f['split'][0], 'function': t,
+                                  'args': (f, results),
+                                  'size': os.path.getsize(f['path'])})
 
-            queue.join()
+            run_step_tasks('analyze_samples', tasks)
 
-            for p in processes:
-                p.terminate()
+            record_units('analyze_samples', units)
 
             results_new = list()
             for r in results:
                 results_new.append(r)
+            for stats_path in current_stats_paths:
+                results_dict = dict()
+                handle = open(stats_path, 'rb')
+                for l in handle:
+                    l = l.rstrip('\n').split('\t')
+                    results_dict[l[0]] = l[1]
+                handle.close()
+                results_new.append(results_dict)
 
             results_new.sort(key=lambda x: x['sample'], reverse=False)
 
@@ -1523,7 +1683,8 @@ if __name__ == '__main__':
                 #               'sites', 'fA', 'fC', 'fG', 'fT', 'e', 'pi',
                 #               'negll']
                 fieldnames = ['sample', 'fA', 'fC', 'fG', 'fT', 'e',
-                              'pi', 'negll']
+                              'pi', 'negll', 'e_low', 'e_high', 'pi_low',
+                              'pi_high']
                 writer = csv.DictWriter(f, fieldnames=fieldnames)
                 writer.writerow({
                     'sample': 'sample',
@@ -1539,6 +1700,10 @@ if __name__ == '__main__':
                     'e': 'e',
                     'pi': 'pi',
                     'negll': 'negll',
+                    'e_low': 'e_low',
+                    'e_high': 'e_high',
+                    'pi_low': 'pi_low',
+                    'pi_high': 'pi_high',
                 })
                 writer.writerows(results_new)
 
@@ -1563,9 +1728,6 @@ if __name__ == '__main__':
             print(msg)
             write_log(msg, lfp)
 
-            processes = list()
-            queue = JoinableQueue()
-
             # Values are tuples: (e, pi)
             group_stats = dict()
             # group_stats = datrie.Trie(string.printable)
@@ -1583,10 +1745,11 @@ if __name__ == '__main__':
                 e = float("inf")
                 pi = 0.0
                 for l in lines:
-                    if l.startswith('e'):
+                    key = l.split('\t')[0]
+                    if key == 'e':
                         e = float(l.split('\t')[1])
                         e_list.append(e)
-                    if l.startswith('pi'):
+                    if key == 'pi':
                         pi = float(l.split('\t')[1])
                         h_list.append(pi)
                 sample_stats[sample] = (e, pi)
@@ -1619,92 +1782,93 @@ if __name__ == '__main__':
                 write_log(msg, lfp)
             # End print log messages
 
-            def t(q):
-                while True:
-                    q_input = q.get()
-                    f = q_input[0]
-                    group_stats = q_input[1]
-                    sample_stats = q_input[2]
-                    use_mean_e_and_pi = q_input[3]
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
-                    print(msg)
-                    write_log(msg, lfp)
+            def t(f, group_stats, sample_stats, use_mean_e_and_pi):
 
-                    ns = krnextgen.nt_site_counts(
-                        f['path'],
-                        1,
-                        0,
-                        rettype='dict')
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' starting...'
+                print(msg)
+                write_log(msg, lfp)
 
-                    handle = open((consensus_output_dir_sample +
-                                   f['split'][0] +
-                                   '_' +
-                                   'consensus' +
-                                   '.fasta'), 'wb')
+                handle = open((consensus_output_dir_sample +
+                               f['split'][0] +
+                               '_' +
+                               'consensus' +
+                               '.fasta'), 'wb')
 
-                    current_sample = f['split'][0]
-                    error = float("inf")
-                    heter = 0.0
-                    if use_mean_e_and_pi:
+                current_sample = f['split'][0]
+                error = float("inf")
+                heter = 0.0
+                if use_mean_e_and_pi:
 #                         for group in sample_groups_dict.keys():
-                        group_samples = sample_groups_dict[group]
-                        if current_sample in group_samples:
-                            error = group_stats[group][0]
-                            heter = group_stats[group][1]
+                    group_samples = sample_groups_dict[group]
+                    if current_sample in group_samples:
+                        error = group_stats[group][0]
+                        heter = group_stats[group][1]
 #                             break
-                    else:
-                        error = sample_stats[current_sample][0]
-                        heter = sample_stats[current_sample][1]
-
-                    # print('e', error)
-                    # print('pi', heter)
-
-                    threshold_probability = config.getfloat(
-                        'Consensus', 'threshold_probability')
-                    low_quality_residue = config.get(
-                        'General', 'low_quality_residue')
-                    min_seq_cluster = config.getint('Consensus', 'min_seq_cluster')
-                    max_seq_cluster = config.getint('Consensus', 'max_seq_cluster')
-
-                    for k in ns.keys():
-                        handle.write('>' + k + '\n')
-                        sites = ns[k]
-                        sequence = ''
-                        for site in sites:
-                            c = krnextgen.consensus_base(
-                                site,
-                                e=error,
-                                pi=heter,
-                                p=threshold_probability,
-                                low_quality_residue=low_quality_residue,
-                                min_total_per_site=min_seq_cluster,
-                                max_total_per_site=max_seq_cluster)
-                            # print(site, c)
-                            sequence = sequence + c[3]
-                        handle.write(sequence + '\n')
-
-                    handle.close()
-
-                    msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
-                    print(msg)
-                    write_log(msg, lfp)
+                else:
+                    error = sample_stats[current_sample][0]
+                    heter = sample_stats[current_sample][1]
+
+                # print('e', error)
+                # print('pi', heter)
+
+                threshold_probability = config.getfloat(
+                    'Consensus', 'threshold_probability')
+                low_quality_residue = config.get(
+                    'General', 'low_quality_residue')
+                min_seq_cluster = config.getint('Consensus', 'min_seq_cluster')
+                max_seq_cluster = config.getint('Consensus', 'max_seq_cluster')
+
+                consensus = krnextgen.consensus_from_site_counts(
+                    f['path'],
+                    e=error,
+                    pi=heter,
+                    p=threshold_probability,
+                    low_quality_residue=low_quality_residue,
+                    min_total_per_site=min_seq_cluster,
+                    max_total_per_site=max_seq_cluster)
+
+                for k, sequence in consensus:
+                    handle.write('>' + k + '\n')
+                    handle.write(sequence + '\n')
 
-                    q.task_done()
+                handle.close()
 
-            for f in file_list:
-                if f['ext'] == 'counts':
-                    queue.put((f, group_stats, sample_stats, use_mean_e_and_pi))
+                msg = krother.timestamp() + ' - Sample ' + f['split'][0] + ' done.'
+                print(msg)
+                write_log(msg, lfp)
 
-            for i in range(cpu):
-                worker = Process(target=t, args=(queue,))
-                worker.start()
-                processes.append(worker)
+            consensus_parameters = krmanifest.config_parameters(config, [
+                ('Consensus', 'threshold_probability'),
+                ('Consensus', 'min_seq_cluster'),
+                ('Consensus', 'max_seq_cluster'),
+                ('General', 'low_quality_residue')])
+
+            units = list()
+            tasks = list()
+            for f in file_list:
+                if f['ext'] == 'sitecounts':
+                    current_sample = f['split'][0]
+                    e_and_pi = sample_stats.get(current_sample, None)
+                    if use_mean_e_and_pi:
+                        e_and_pi = group_stats[group]
+                    unit = group + '/' + current_sample
+                    fingerprint = manifest.fingerprint(
+                        input_file_paths=[f['path']],
+                        parameters=consensus_parameters + [
+                            ('e_and_pi', e_and_pi)])
+                    if unit_is_current('consensus', unit, fingerprint):
+                        continue
+                    units.append((unit, fingerprint, [
+                        consensus_output_dir_sample + current_sample +
+                        '_consensus.fasta']))
+                    tasks.append({'name': current_sample, 'function': t,
+                                  'args': (f, group_stats, sample_stats,
+                                           use_mean_e_and_pi),
+                                  'size': os.path.getsize(f['path'])})
 
-            queue.join()
+            run_step_tasks('consensus', tasks)
 
-            for p in processes:
-                p.terminate()
+            record_units('consensus', units)
 
             # Create a master consensus file
             msg = '\nCreating grouped-consensus files...'
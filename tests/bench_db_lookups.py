@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+'''
+Per-lookup latency of KRSequenceDatabase.db_select with the WHERE clause
+built by _db_where (=, IN, IS NULL, sorted columns) and with the earlier
+form that compared every column with IS in dictionary order.
+
+Builds a temporary database of N records through KRSequenceDatabase, so all
+migrations and indexes are in place, and times the same random lookups with
+both forms on the same connection.
+
+Run with: python tests/bench_db_lookups.py [N] [lookups]
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from krpy.KRSequenceDatabase import KRSequenceDatabase
+
+
+def _select_with_is_(db, table_name_list, column_list, where_dict=None,
+                     join_rules_str=None, order_by_column_list=None):
+
+    '''
+    db_select as it was before _db_where, for comparison.
+    '''
+
+    import sqlite3
+
+    columns_str = ', '.join(column_list)
+
+    if where_dict:
+        where_str = ' WHERE ' + ' AND '.join(
+            [str(x) + ' IS :' + str(x.replace('.', '_')) for x in where_dict.keys()])
+
+        new_where_dict = dict()
+        for key in where_dict.keys():
+            new_where_dict[key.replace('.', '_')] = where_dict[key]
+        where_dict = new_where_dict
+
+    else:
+        where_str = ''
+        where_dict = {}
+
+    order_by_str = ''
+    if order_by_column_list:
+        order_by_str = ' ORDER BY ' + ', '.join(order_by_column_list)
+
+    tables_str = ''
+
+    if len(table_name_list) == 1:
+        tables_str = table_name_list[0]
+    else:
+        tables_str = ' LEFT OUTER JOIN '.join(table_name_list)
+        tables_str = tables_str + ' ON ' + join_rules_str
+
+    select_str = str('SELECT ' + columns_str + ' FROM ' + tables_str + where_str + order_by_str)
+
+    try:
+        db._DB_CURSOR.execute(select_str, where_dict)
+    except sqlite3.Error as error:
+        print(error, file=sys.stderr)
+        raise
+
+    return db._DB_CURSOR.fetchall()
+
+
+def _select_with_db_where_(db, table_name_list, column_list, where_dict):
+    return db.db_select(table_name_list=table_name_list,
+                        column_list=column_list, where_dict=where_dict)
+
+
+def build_database(db_file_path, record_count):
+
+    db = KRSequenceDatabase(db_file_path)
+
+    tax_id = db.db_insert(
+        'taxonomies', {'taxonomy': 'Solanaceae,Solanum'})[0]
+
+    organisms = list()
+    for i in range(50):
+        org_dict = {
+            'genus': 'Solanum', 'species': 'species' + str(i),
+            'subspecies': None, 'variety': None, 'hybrid': None,
+            'other': None, 'authority': None}
+        if i % 5 == 0:
+            org_dict['subspecies'] = 'subspecies' + str(i)
+        values_dict = dict(org_dict)
+        values_dict.update({
+            'active': 1, 'taxonomy_id': tax_id, 'common_name': None,
+            'synonymy_check_done': 0, 'taxonomy_check_done': 0})
+        org_id = db.db_insert('organisms', values_dict,
+                              check_exists=False)[0]
+        organisms.append((org_id, org_dict))
+
+    versions = list()
+    for i in range(record_count):
+        version = 'AB%06d.1' % i
+        rec_id = db.db_insert('records', {
+            'org_id': organisms[i % len(organisms)][0], 'active': 1,
+            'ncbi_gi': str(100000 + i), 'ncbi_version': version,
+            'internal_reference': None, 'description': 'record ' + str(i)},
+            check_exists=False)[0]
+        for j in range(3):
+            db.db_insert('record_features', {
+                'type': 'gene', 'rec_id': rec_id,
+                'location': '[' + str(j) + ':' + str(j + 100) + '](+)'},
+                check_exists=False)
+        versions.append(version)
+
+    db.save()
+
+    return (db, versions, [x[1] for x in organisms])
+
+
+def time_lookups(db, select, lookups):
+
+    start = time.time()
+    for table_name_list, column_list, where_dict in lookups:
+        select(db, table_name_list, column_list, where_dict)
+    return (time.time() - start) / len(lookups) * 1000000.0
+
+
+def main(record_count=10000, lookup_count=20000, repeats=5):
+
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        db, versions, organisms = build_database(
+            os.path.join(temp_dir, 'bench.db'), record_count)
+
+        random.seed(1)
+
+        benchmarks = [
+            ('record id by version', [
+                (['records'], ['id'],
+                 {'ncbi_version': random.choice(versions)})
+                for i in range(lookup_count)]),
+            ('record by id', [
+                (['records'], ['ncbi_version', 'description'],
+                 {'id': random.randint(1, record_count)})
+                for i in range(lookup_count)]),
+            ('organism id by name', [
+                (['organisms'], ['id'], dict(random.choice(organisms)))
+                for i in range(lookup_count)]),
+            ('features by record', [
+                (['record_features'], ['id', 'type', 'location'],
+                 {'rec_id': random.randint(1, record_count)})
+                for i in range(lookup_count)])]
+
+        print('%d records, %d lookups, best of %d, microseconds per lookup'
+              % (record_count, lookup_count, repeats))
+        print('%-24s %10s %10s' % ('', 'IS', '_db_where'))
+
+        for name, lookups in benchmarks:
+            # Alternated, so neither form always runs on a warmer cache
+            times = [list(), list()]
+            for i in range(repeats):
+                times[0].append(time_lookups(db, _select_with_is_, lookups))
+                times[1].append(
+                    time_lookups(db, _select_with_db_where_, lookups))
+            print('%-24s %10.1f %10.1f' % (name, min(times[0]),
+                                           min(times[1])))
+
+        db.close()
+
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+    args = [int(x) for x in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+# from __future__ import unicode_literals
+
+'''
+EXPLAIN QUERY PLAN checks for the KRSequenceDatabase getters: every table
+has to be searched through an index or the integer primary key, never
+scanned. The database is created through KRSequenceDatabase, so all schema
+migrations are applied.
+
+Run with: python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import Bio
+    _HAS_BIOPYTHON = True
+except ImportError:
+    _HAS_BIOPYTHON = False
+
+from krpy.KRSequenceDatabase import KRSequenceDatabase
+
+
+class _RecordingCursor():
+
+    '''
+    Passes everything to the real cursor and keeps the SQL and parameters of
+    every execute call.
+    '''
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.statements = list()
+
+    def execute(self, sql, parameters=()):
+        self.statements.append((sql, parameters))
+        return self._cursor.execute(sql, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = KRSequenceDatabase(os.path.join(self.temp_dir, 'test.db'))
+
+        tax_id = self.db.db_insert(
+            'taxonomies', {'taxonomy': 'Solanaceae,Solanum'})[0]
+        org_id = self.db.db_insert('organisms', {
+            'active': 1, 'taxonomy_id': tax_id, 'genus': 'Solanum',
+            'species': 'lycopersicum', 'subspecies': None, 'variety': None,
+            'hybrid': None, 'other': None, 'authority': None,
+            'common_name': 'tomato', 'synonymy_check_done': 0,
+            'taxonomy_check_done': 0})[0]
+        self.db.db_insert('ncbi_tax_ids', {
+            'org_id': org_id, 'ncbi_tax_id': 4081})
+        rec_id = self.db.db_insert('records', {
+            'org_id': org_id, 'active': 1, 'ncbi_gi': '123',
+            'ncbi_version': 'AB000001.1', 'internal_reference': None,
+            'description': 'test'})[0]
+        parent_rec_id = self.db.db_insert('records', {
+            'org_id': org_id, 'active': 1, 'ncbi_gi': '456',
+            'ncbi_version': 'AB000002.1', 'internal_reference': 'parent',
+            'description': 'parent'})[0]
+        self.db.db_insert('record_ancestry', {
+            'rec_id': rec_id, 'parent_rec_id': parent_rec_id})
+        seq_id = self.db.add_sequence(rec_id, 'ACGT', 'DNA')[0]
+        seq_rep_id = self.db.add_sequence_representation(
+            seq_id, self.db._KRSeqEdits([(('equal', 0, 4, 0, 4), '', 1)]),
+            rec_id=rec_id)[0]
+        self.db.add_alignment('locus', [seq_rep_id])
+        self.aln_id = self.db.db_get_row_ids(
+            'alignments', {'name': 'locus'})[0]
+        self.db.save()
+
+        self.cursor = _RecordingCursor(self.db._DB_CURSOR)
+        self.db._DB_CURSOR = self.cursor
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def assert_uses_indexes(self, sql, parameters=()):
+
+        cursor = self.cursor._cursor
+        plan = cursor.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+
+        for row in plan.fetchall():
+            detail = row[3]
+            if not detail.startswith('SCAN '):
+                continue
+            if ('USING INDEX' in detail or 'USING COVERING INDEX' in detail or
+                    'INTEGER PRIMARY KEY' in detail):
+                continue
+            self.fail('Table scan: ' + detail + '\n' + sql)
+
+    def assert_calls_use_indexes(self, function, *args, **kwargs):
+
+        self.cursor.statements = list()
+        function(*args, **kwargs)
+        self.assertTrue(self.cursor.statements)
+        for sql, parameters in self.cursor.statements:
+            self.assert_uses_indexes(sql, parameters)
+
+    def test_iter_records(self):
+        for key in ['ncbi_gi', 'ncbi_version', 'internal_reference', 'id']:
+            self.assert_uses_indexes(
+                self.db._record_chunk_sql(key, 3), ['1', '2', '3'])
+        for sql in self.db._record_features_sql(3):
+            self.assert_uses_indexes(sql, [1, 2, 3])
+
+    def test_get_organisms(self):
+        self.assert_calls_use_indexes(
+            self.db.get_organisms, where_dict={'organisms.id': 1})
+        self.assert_calls_use_indexes(
+            self.db.get_organisms,
+            where_dict={'genus': 'Solanum', 'species': 'lycopersicum'})
+
+    def test_in_blacklist(self):
+        for reference_type in ['gi', 'version', 'internal']:
+            self.assert_calls_use_indexes(
+                self.db.in_blacklist, 'AB000001.1', reference_type)
+
+    def test_get_records_with_annotations(self):
+        self.assert_uses_indexes(
+            self.db._DB_ANNOTATION_SQL, ['locus', 'rbcL'])
+
+    @unittest.skipUnless(_HAS_BIOPYTHON, 'Biopython is not installed')
+    def test_get_records_with_annotations_call(self):
+        self.assert_calls_use_indexes(
+            self.db.get_records_with_annotations, 'locus', 'rbcL')
+
+    def test_get_alignment(self):
+        self.assert_uses_indexes(self.db._DB_ALIGNMENT_SQL, [self.aln_id])
+
+    @unittest.skipUnless(_HAS_BIOPYTHON, 'Biopython is not installed')
+    def test_get_alignment_call(self):
+        self.assert_calls_use_indexes(self.db.get_alignment, self.aln_id)
+
+    @unittest.skipUnless(_HAS_BIOPYTHON, 'Biopython is not installed')
+    def test_get_sequences_for_records(self):
+        self.assert_calls_use_indexes(
+            self.db.get_sequence_for_record, 'AB000001.1', 'version')
+        self.assert_calls_use_indexes(
+            self.db.get_sequences_for_records, ['123'], 'gi')
+
+    def test_get_parent_rec_ids(self):
+        self.assert_calls_use_indexes(self.db.get_parent_rec_ids, 1)
+
+    def test_in_db(self):
+        self.assert_calls_use_indexes(self.db.in_db, '123', 'gi')
+        self.assert_calls_use_indexes(self.db.in_db, 'AB000001.1', 'version')
+        self.assert_calls_use_indexes(self.db.in_db, 'parent', 'internal')
+
+    def test_record_lookups(self):
+        self.assert_calls_use_indexes(
+            self.db.db_get_row_ids, 'records', {'ncbi_version': 'AB000001.1'})
+        self.assert_calls_use_indexes(
+            self.db.db_get_row_ids, 'records', {'ncbi_gi': '123'})
+        self.assert_calls_use_indexes(
+            self.db.get_seq_rep_id_for_record, 'AB000001.1', 'version')
+        self.assert_calls_use_indexes(
+            self.db.get_seq_rep_id_for_record, '123', 'gi')
+
+    def test_tax_id_lookups(self):
+        self.assert_calls_use_indexes(
+            self.db.db_get_row_ids, 'ncbi_tax_ids', {'ncbi_tax_id': 4081})
+        self.assert_calls_use_indexes(
+            self.db.db_get_row_ids, 'ncbi_tax_ids',
+            {'org_id': 1, 'ncbi_tax_id': 4081})
+
+
+if __name__ == '__main__':
+    unittest.main()